@@ -0,0 +1,185 @@
+"""
+The purpose of this module is to:
+* allocate the coupons under a global budget for the discount cost, caps on the coupons per product and caps on the coupons per discount
+* report how close the allocation is to the optimum (duality gap)
+
+coupon_assignment (module_coupon_assignment) picks the top 5 coupons of every shopper by expected revenue independently. Here the constraints
+are priced in with Lagrange multipliers (dual prices): the adjusted value of a coupon is
+
+    expected revenue - lambda * expected discount cost - mu[product] - nu[discount]
+
+and for given prices the problem decomposes into the top 5 coupons with a positive adjusted value per shopper (top_coupons).
+The prices are updated with subgradient steps (Polyak step size) on the violated constraints. Every relaxed solution is repaired into
+a feasible one (in the order of the adjusted value, a coupon is dropped if it exceeds a cap or no longer fits into the budget), the best
+feasible one is kept.
+The relaxed objective is an upper bound of the optimum, so gap = (upper bound - revenue) / upper bound bounds the distance to the optimum.
+
+Prerequisite:
+* Purchase probabilities under the discounts, e.g. module_coupon_assignment.predict_discounts on a scoring set of week 90
+"""
+
+import time
+import numpy as np
+import pandas as pd
+
+from module_candidates import rank_within_shopper
+from module_coupon_assignment import DISCOUNTS, top_coupons
+from module_profiling import stage
+
+
+def _caps(caps, keys):
+    """
+    returns the caps per key (np.inf = no cap) from None, a number (same cap for every key), a dict or a Series key -> cap
+    """
+    if caps is None:
+        return np.full(len(keys), np.inf)
+    if np.isscalar(caps):
+        return np.full(len(keys), float(caps))
+    caps = pd.Series(caps, dtype = np.float64)
+    return caps.reindex(keys).fillna(np.inf).values
+
+
+def _repair(row, level, value, product_idx, cost, product_caps, discount_caps, budget):
+    """
+    returns the mask of the coupons that are kept: in the order of the adjusted value, a coupon is dropped if its product or its discount
+    has already reached its cap or if its discount cost does not fit into the rest of the budget (greedy knapsack: the cheaper coupons after
+    it are still taken)
+    """
+    keep = np.ones(len(row), dtype = bool)
+    for group, caps in [(product_idx[row], product_caps), (level, discount_caps)]:
+        if np.isfinite(caps).any():
+            rank = rank_within_shopper(group, np.where(keep, value, -np.inf), row)
+            keep &= rank < caps[group]
+    if np.isfinite(budget):
+        order = np.lexsort((row, -value))
+        order = order[keep[order]]
+        keep[order] = False
+        rest = budget
+        #the coupons up to the first one that overflows are taken at once, the overflowing one is skipped; coupons that are more expensive
+        #than the rest of the budget can never fit again
+        while len(order):
+            order = order[cost[order] <= rest]
+            cumulated = np.cumsum(cost[order])
+            fits = np.searchsorted(cumulated, rest, side = 'right')
+            keep[order[:fits]] = True
+            rest -= cumulated[fits - 1] if fits else 0.0
+            order = order[fits + 1:]
+    return keep
+
+
+@stage()
+def allocate_coupons(scoring_set, proba, discounts = DISCOUNTS, budget = None, product_caps = None, discount_caps = None, no_coupons = 5,
+                     max_iter = 30, tol = 1e-3, week = None):
+
+    """
+    input:
+        scoring_set: DataFrame with shopper, product, max_price (and week) in the row order of proba, sorted by shopper and product
+        proba: np.ndarray rows x discounts with the purchase probabilities (output of module_coupon_assignment.predict_discounts)
+        discounts: default = DISCOUNTS, discount levels of the columns of proba
+        budget: default = None (no budget), max. expected discount cost of all coupons (sum of probability x max_price x discount)
+        product_caps: default = None (no caps), max. number of coupons per product: a number or a dict/Series product -> cap
+        discount_caps: default = None (no caps), max. number of coupons per discount level: a number or a dict/Series discount -> cap
+        no_coupons: default = 5, coupons per shopper
+        max_iter: default = 30, max. number of subgradient iterations
+        tol: default = 1e-3, stops once the duality gap is below tol
+        week: default = None (week column of the scoring set), week of the coupons
+    output:
+        coupons: DataFrame with shopper, week, coupon, product, discount (same as coupon_assignment)
+        report: dict with revenue, cost, upper_bound, gap, iterations, coupons, the dual prices (lambda_budget, mu_product, nu_discount) and
+                the history of the iterations
+    """
+
+    start = time.time()
+    discounts = np.asarray(list(discounts))
+    shopper = scoring_set['shopper'].values
+    product = scoring_set['product'].values
+    max_price = scoring_set['max_price'].values.astype(np.float64)
+    proba = np.asarray(proba, dtype = np.float32)
+
+    #expected revenue and expected discount cost of every row under every discount (float32, as the probabilities)
+    revenue = proba * (max_price[:, None] * (1 - discounts / 100)).astype(np.float32)
+    cost = proba * (max_price[:, None] * (discounts / 100)).astype(np.float32)
+
+    products, product_idx = np.unique(product, return_inverse = True)
+    product_caps = _caps(product_caps, products)
+    discount_caps = _caps(discount_caps, discounts)
+    budget = np.inf if budget is None else float(budget)
+
+    lambda_budget = 0.0
+    mu = np.zeros(len(products))
+    nu = np.zeros(len(discounts))
+    step_scale = 1.0
+    upper_bound = np.inf
+    best = None
+    history = []
+    no_improvement = 0
+    adjusted = np.empty_like(revenue)
+
+    for iteration in range(max_iter):
+        #adjusted values computed in place in one buffer
+        np.multiply(cost, np.float32(-lambda_budget), out = adjusted)
+        adjusted += revenue
+        if mu.any():
+            adjusted -= mu.astype(np.float32)[product_idx][:, None]
+        if nu.any():
+            adjusted -= nu.astype(np.float32)[None, :]
+        #coupons without a positive adjusted value are not worth their constraints
+        adjusted[adjusted <= 0] = np.nan
+        row, level, _ = top_coupons(shopper, product, adjusted, no_coupons)
+        value = adjusted[row, level].astype(np.float64)
+        coupon_cost = cost[row, level].astype(np.float64)
+
+        #relaxed objective (upper bound of the optimum) and subgradient (violation of the constraints)
+        product_counts = np.bincount(product_idx[row], minlength = len(products))
+        discount_counts = np.bincount(level, minlength = len(discounts))
+        finite = [np.isfinite(budget), np.isfinite(product_caps), np.isfinite(discount_caps)]
+        bound = value.sum() + (lambda_budget * budget if finite[0] else 0) + (mu * np.where(finite[1], product_caps, 0)).sum() \
+                + (nu * np.where(finite[2], discount_caps, 0)).sum()
+        if bound < upper_bound - 1e-12:
+            upper_bound = bound
+            no_improvement = 0
+        else:
+            no_improvement += 1
+
+        keep = _repair(row, level, value, product_idx, coupon_cost, product_caps, discount_caps, budget)
+        feasible_revenue = revenue[row[keep], level[keep]].sum(dtype = np.float64)
+        if best is None or feasible_revenue > best[0]:
+            best = (feasible_revenue, row[keep], level[keep])
+
+        gap = (upper_bound - best[0]) / upper_bound if upper_bound > 0 else 0.0
+        history.append({'iteration': iteration, 'upper_bound': upper_bound, 'revenue': best[0], 'gap': gap, 'lambda_budget': lambda_budget,
+                        'cost': coupon_cost.sum(), 'coupons': len(row)})
+        if gap <= tol:
+            break
+
+        budget_violation = coupon_cost.sum() - budget if finite[0] else 0.0
+        product_violation = np.where(finite[1], product_counts - product_caps, 0)
+        discount_violation = np.where(finite[2], discount_counts - discount_caps, 0)
+        norm = budget_violation ** 2 + (product_violation ** 2).sum() + (discount_violation ** 2).sum()
+        if norm == 0:
+            break
+        #Polyak step towards the best feasible revenue; the scale is halved when the bound stalls
+        if no_improvement >= 3:
+            step_scale /= 2
+            no_improvement = 0
+        step = step_scale * (bound - best[0]) / norm
+        lambda_budget = max(0.0, lambda_budget + step * budget_violation)
+        mu = np.maximum(0.0, mu + step * product_violation)
+        nu = np.maximum(0.0, nu + step * discount_violation)
+
+    feasible_revenue, row, level = best
+    order = np.lexsort((-revenue[row, level], shopper[row]))
+    row, level = row[order], level[order]
+    coupon = rank_within_shopper(shopper[row], revenue[row, level], product[row])
+    weeks = scoring_set['week'].values[row] if week is None else np.full(len(row), week)
+    coupons = pd.DataFrame({'shopper': shopper[row], 'week': weeks, 'coupon': coupon, 'product': product[row], 'discount': discounts[level]})
+    coupons = coupons.sort_values(['shopper', 'coupon']).reset_index(drop = True)
+
+    report = {'revenue': feasible_revenue, 'cost': cost[row, level].sum(dtype = np.float64), 'upper_bound': upper_bound, 'gap': history[-1]['gap'],
+              'iterations': len(history), 'coupons': len(coupons), 'lambda_budget': lambda_budget, 'mu_product': pd.Series(mu, index = products),
+              'nu_discount': pd.Series(nu, index = discounts), 'history': pd.DataFrame(history), 'seconds': time.time() - start}
+
+    print('Allocated %d coupons in %d iterations (%.2f seconds): expected revenue %.2f, discount cost %.2f, upper bound %.2f, gap %.2f%%'
+          % (report['coupons'], report['iterations'], report['seconds'], report['revenue'], report['cost'], upper_bound, 100 * report['gap']))
+
+    return coupons, report
@@ -19,14 +19,29 @@ Logic/Algorithm:
 5. Order the items descending by coupon redemption rate
 6. Return the top 5 products
 7. Assign a coupon to these products for the week t+1, here week 90
+
+heuristic_counters and heuristic_coupons implement the same logic on arrays: one pass over the baskets counts the purchases and the
+discounted purchases per shopper x product, the top 5 products per shopper are ranked on these counters. They run on the full population
+(no_shoppers = None) in seconds and do not need any of the model pipeline, so they are the fallback if the model is not available.
+OnlineHeuristic keeps these counters and the top 5 per shopper between runs and adds one week at a time (update, update_from_files).
 """
 
 
 # Libraries
+import time
 import pandas as pd
 import numpy as np
 
+from module_candidates import rank_within_shopper
+from module_profiling import stage
+
+#discount of the coupons by rank (coupon 0 gets the highest discount)
+HEURISTIC_DISCOUNTS = [30, 25, 20, 15, 15]
+#max. number of shopper x product cells that are counted in dense arrays
+_DENSE_LIMIT = 2 ** 27
+
 # generate dataset for heuristic model   
+@stage()
 def generate_heuristic_data(path_datasets):
     baskets = pd.read_parquet(path_datasets + "/baskets.parquet")
     baskets = baskets[baskets.shopper <2000]
@@ -53,6 +68,7 @@ def generate_heuristic_data(path_datasets):
     return bc_filtered_grouped
 
 
+@stage()
 def heuristic_model(path_datasets, bc_filtered_grouped):
     """
     input: 
@@ -93,3 +109,226 @@ def heuristic_model(path_datasets, bc_filtered_grouped):
     # returning output dataset
     return heur_idx
 
+
+
+def heuristic_counters(path_datasets, no_shoppers = 2000, max_week = None):
+
+    """
+    input:
+        path_datasets: path to baskets.parquet and coupons.parquet
+        no_shoppers: default = 2000, only the shoppers 0..no_shoppers-1 are used; None = all shoppers
+        max_week: default = None (all weeks), last week of the history that is counted
+    output:
+        counters: DataFrame with shopper, product, product_buys, product_discount_buys and dis_prod_share (product_discount_buys / product_buys)
+                  for every bought shopper x product pair, sorted by shopper and product
+    """
+
+    filters = [('shopper', '<', no_shoppers)] if no_shoppers is not None else []
+    filters += [('week', '<=', max_week)] if max_week is not None else []
+    baskets = pd.read_parquet(path_datasets + '/baskets.parquet', columns = ['week', 'shopper', 'product'], filters = filters or None)
+    coupons = pd.read_parquet(path_datasets + '/coupons.parquet', columns = ['week', 'shopper', 'product', 'discount'], filters = filters or None)
+    coupons = coupons[coupons['discount'] > 0]
+
+    week, shopper, product = [baskets[column].values.astype(np.int64) for column in ['week', 'shopper', 'product']]
+    no_products = int(max(product.max(initial = -1), coupons['product'].max() if len(coupons) else -1)) + 1
+    no_shoppers_seen = int(max(shopper.max(initial = -1), coupons['shopper'].max() if len(coupons) else -1)) + 1
+
+    #a purchase is discounted if a coupon with a discount was offered for the same week, shopper and product
+    def event_key(week, shopper, product):
+        return (week * no_shoppers_seen + shopper) * no_products + product
+    #sorted keys are enough for the lookup, duplicates do not matter
+    offered = np.sort(event_key(coupons['week'].values.astype(np.int64), coupons['shopper'].values.astype(np.int64), coupons['product'].values.astype(np.int64)))
+    keys = event_key(week, shopper, product)
+    position = np.minimum(np.searchsorted(offered, keys), max(len(offered) - 1, 0))
+    discounted = (offered[position] == keys) if len(offered) else np.zeros(len(keys), dtype = bool)
+
+    #one aggregation into the shopper x product counters
+    pair = shopper * no_products + product
+    if no_shoppers_seen * no_products <= _DENSE_LIMIT:
+        product_buys = np.bincount(pair, minlength = no_shoppers_seen * no_products)
+        product_discount_buys = np.bincount(pair, weights = discounted, minlength = no_shoppers_seen * no_products)
+        pairs = np.flatnonzero(product_buys)
+        product_buys, product_discount_buys = product_buys[pairs], product_discount_buys[pairs]
+    else:
+        pairs = np.sort(pair)
+        pairs = pairs[np.r_[True, pairs[1:] != pairs[:-1]]]
+        inverse = np.searchsorted(pairs, pair)
+        product_buys = np.bincount(inverse, minlength = len(pairs))
+        product_discount_buys = np.bincount(inverse, weights = discounted, minlength = len(pairs))
+
+    return pd.DataFrame({'shopper': pairs // no_products, 'product': pairs % no_products, 'product_buys': product_buys,
+                         'product_discount_buys': product_discount_buys.astype(np.int64),
+                         'dis_prod_share': product_discount_buys / product_buys})
+
+
+def heuristic_coupons(counters, week = 90, no_coupons = 5, discounts = HEURISTIC_DISCOUNTS):
+
+    """
+    input:
+        counters: output of heuristic_counters (or any DataFrame with shopper, product and dis_prod_share)
+        week: default = 90, week the coupons are assigned for
+        no_coupons: default = 5, coupons per shopper
+        discounts: default = HEURISTIC_DISCOUNTS, discount per coupon rank
+    output:
+        coupons: DataFrame with shopper, week, coupon, product, discount: the top no_coupons products per shopper by dis_prod_share
+                 (ties: lower product first, as nlargest in heuristic_model)
+    """
+
+    shopper = counters['shopper'].values
+    rank = rank_within_shopper(shopper, counters['dis_prod_share'].values, counters['product'].values)
+    top = np.flatnonzero(rank < no_coupons)
+    top = top[np.lexsort((rank[top], shopper[top]))]
+    return pd.DataFrame({'shopper': shopper[top], 'week': week, 'coupon': rank[top], 'product': counters['product'].values[top],
+                         'discount': np.asarray(discounts)[rank[top]]})
+
+
+@stage()
+def fast_heuristic_model(path_datasets, no_shoppers = 2000, week = 90, max_week = None, no_coupons = 5):
+
+    """
+    input:
+        path_datasets: path to baskets.parquet and coupons.parquet
+        no_shoppers: default = 2000, see heuristic_counters; None = all shoppers
+        week: default = 90, week the coupons are assigned for
+        max_week: default = None (all weeks), last week of the history
+        no_coupons: default = 5, coupons per shopper
+    output:
+        top5coupons: coupon recommendation dataset with shopper, week, coupon, product, discount
+    """
+
+    start = time.time()
+    counters = heuristic_counters(path_datasets, no_shoppers, max_week)
+    top5coupons = heuristic_coupons(counters, week, no_coupons)
+    print('Heuristic coupons for %d shoppers in %.2f seconds' % (top5coupons['shopper'].nunique(), time.time() - start))
+    return top5coupons
+
+
+class OnlineHeuristic:
+
+    """
+    heuristic model that is updated week by week: the purchase and discounted purchase counters per shopper x product are kept in dense
+    arrays and a table with the top no_coupons products per shopper by dis_prod_share is kept up to date. An update only touches the pairs
+    of the new week and re-ranks only the shoppers with a purchase in that week, so the coupons of the next week cost only the new week's data.
+    """
+
+    def __init__(self, no_coupons = 5, discounts = HEURISTIC_DISCOUNTS):
+        self.no_coupons = no_coupons
+        self.discounts = list(discounts)
+        self.product_buys = np.zeros((0, 0), dtype = np.int32)
+        self.product_discount_buys = np.zeros((0, 0), dtype = np.int32)
+        #top products per shopper (-1 = no product) and their dis_prod_share, ordered by coupon
+        self.top_products = np.zeros((0, no_coupons), dtype = np.int32)
+        self.top_shares = np.zeros((0, no_coupons), dtype = np.float64)
+        self.last_week = -1
+
+    def _grow(self, no_shoppers, no_products):
+        """
+        enlarges the arrays to at least no_shoppers x no_products
+        """
+        old_shoppers, old_products = self.product_buys.shape
+        if no_shoppers <= old_shoppers and no_products <= old_products:
+            return
+        no_shoppers, no_products = max(no_shoppers, old_shoppers), max(no_products, old_products)
+        assert no_shoppers * no_products <= _DENSE_LIMIT, 'too many shopper x product cells for the dense counters'
+        for name in ['product_buys', 'product_discount_buys']:
+            grown = np.zeros((no_shoppers, no_products), dtype = np.int32)
+            grown[:old_shoppers, :old_products] = getattr(self, name)
+            setattr(self, name, grown)
+        self.top_products = np.vstack([self.top_products, np.full((no_shoppers - old_shoppers, self.no_coupons), -1, dtype = np.int32)])
+        self.top_shares = np.vstack([self.top_shares, np.full((no_shoppers - old_shoppers, self.no_coupons), np.nan)])
+
+    def update(self, baskets, coupons):
+
+        """
+        input:
+            baskets: DataFrame with week, shopper, product of the purchases of the new week(s)
+            coupons: DataFrame with week, shopper, product, discount of the coupons of the same week(s)
+        output:
+            self; the weeks must come after the last week of the previous update
+        """
+
+        if len(baskets) == 0:
+            return self
+        assert baskets['week'].min() > self.last_week, 'week %d was already counted' % baskets['week'].min()
+        week, shopper, product = [baskets[column].values.astype(np.int64) for column in ['week', 'shopper', 'product']]
+        coupons = coupons[coupons['discount'] > 0]
+        self._grow(int(shopper.max()) + 1, int(max(product.max(), coupons['product'].max() if len(coupons) else -1)) + 1)
+
+        no_shoppers, no_products = self.product_buys.shape
+        def event_key(week, shopper, product):
+            return (week * no_shoppers + shopper) * no_products + product
+        offered = np.sort(event_key(coupons['week'].values.astype(np.int64), coupons['shopper'].values.astype(np.int64), coupons['product'].values.astype(np.int64)))
+        keys = event_key(week, shopper, product)
+        position = np.minimum(np.searchsorted(offered, keys), max(len(offered) - 1, 0))
+        discounted = (offered[position] == keys) if len(offered) else np.zeros(len(keys), dtype = bool)
+
+        np.add.at(self.product_buys, (shopper, product), 1)
+        np.add.at(self.product_discount_buys, (shopper[discounted], product[discounted]), 1)
+
+        #only the shoppers with a purchase in the new week can have a new top list
+        touched = np.unique(shopper)
+        buys = self.product_buys[touched]
+        shares = np.where(buys > 0, self.product_discount_buys[touched] / np.maximum(buys, 1), -np.inf)
+        #stable sort: ties keep the lower product first (as nlargest in heuristic_model)
+        top = np.argsort(-shares, axis = 1, kind = 'stable')[:, :self.no_coupons]
+        top_shares = np.take_along_axis(shares, top, axis = 1)
+        valid = np.isfinite(top_shares)
+        width = top.shape[1]
+        self.top_products[touched] = -1
+        self.top_products[touched, :width] = np.where(valid, top, -1)
+        self.top_shares[touched] = np.nan
+        self.top_shares[touched, :width] = np.where(valid, top_shares, np.nan)
+
+        self.last_week = int(week.max())
+        return self
+
+    def update_from_files(self, path_datasets, weeks, no_shoppers = 2000):
+
+        """
+        input:
+            path_datasets: path to baskets.parquet and coupons.parquet
+            weeks: week or list of weeks that are added, in increasing order
+            no_shoppers: default = 2000, only the shoppers 0..no_shoppers-1 are used; None = all shoppers
+        output:
+            self
+        """
+
+        for week in np.atleast_1d(weeks):
+            filters = [('week', '==', int(week))] + ([('shopper', '<', no_shoppers)] if no_shoppers is not None else [])
+            baskets = pd.read_parquet(path_datasets + '/baskets.parquet', columns = ['week', 'shopper', 'product'], filters = filters)
+            coupons = pd.read_parquet(path_datasets + '/coupons.parquet', columns = ['week', 'shopper', 'product', 'discount'], filters = filters)
+            self.update(baskets, coupons)
+        return self
+
+    def coupon_index(self, week = None):
+
+        """
+        input:
+            week: default = None (week after the last update), week the coupons are assigned for
+        output:
+            top5coupons: DataFrame with shopper, week, coupon, product, discount (same as heuristic_coupons on the counters of all updated weeks)
+        """
+
+        shopper, coupon = np.nonzero(self.top_products >= 0)
+        return pd.DataFrame({'shopper': shopper, 'week': self.last_week + 1 if week is None else week, 'coupon': coupon,
+                             'product': self.top_products[shopper, coupon].astype(np.int64), 'discount': np.asarray(self.discounts)[coupon]})
+
+    def save(self, filename):
+        """
+        writes the counters, the top lists and the last week to filename (.npz)
+        """
+        np.savez(filename, product_buys = self.product_buys, product_discount_buys = self.product_discount_buys, top_products = self.top_products,
+                 top_shares = self.top_shares, last_week = self.last_week, discounts = self.discounts)
+        return self
+
+    @classmethod
+    def load(cls, filename):
+        """
+        returns the OnlineHeuristic saved with save
+        """
+        data = np.load(filename)
+        model = cls(data['top_products'].shape[1], list(data['discounts']))
+        for name in ['product_buys', 'product_discount_buys', 'top_products', 'top_shares']:
+            setattr(model, name, data[name])
+        model.last_week = int(data['last_week'])
+        return model
@@ -0,0 +1,187 @@
+"""
+The purpose of this module is to:
+* score the coupons of the whole population in shards of shoppers: per shard the candidate features are gathered from the as-of feature store,
+  the discount grid is scored and the top 5 coupons are written to one partition of the coupon index (batch_score)
+* read the partitioned coupon index back (load_coupon_index)
+
+The chain week90_generate_dataset -> get_test_discounts -> predictions -> merge_predictions -> coupon_assignment keeps several full size
+copies of the scoring set in memory. Here a shard is gathered, scored and written before the worker takes the next one, so the peak memory
+grows with shard_size x n_jobs and not with the population. The as-of aggregates (module_week90_generate_dataset.asof_feature_store) are
+built shard by shard as well: the raw data of a shard of shoppers is read with shopper filters, its shopper grains are appended to the
+store and the product aggregates are accumulated with bincounts. Only the product table and the shopper ids are held for the whole
+population; a worker reads the shopper grains of its shard (FeatureStore.shard).
+
+The candidates of a shard are chosen as in build_scoring_set: the rows of lags.parquet for the target week if it is not observed yet
+(e.g. the simulated week 90), otherwise the pairs bought at least min_frequency times up to the week before the target week.
+The shards split the shoppers with candidates; a candidate shopper without as-of aggregates raises a ValueError instead of being gathered
+as NaN and dropped.
+
+Prerequisite:
+* The data sets of build_scoring_set and a trained model (e.g. module_model_registry.load_model)
+
+Layout on disk:
+    <path>/coupon_index/week_<target_week>/shard_<shard>.parquet (shopper, week, coupon, product, discount)
+"""
+
+import glob
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+import module_candidates
+import module_week90_generate_dataset
+from module_coupon_assignment import DISCOUNTS, assign_coupons, predict_discounts
+from module_profiling import stage
+
+
+def shopper_shards(shoppers, shard_size):
+    """
+    returns the (first shopper, last shopper) bounds of the shards of shard_size shoppers each
+    """
+    shoppers = np.unique(shoppers)
+    return [(shoppers[start], shoppers[min(start + shard_size, len(shoppers)) - 1]) for start in range(0, len(shoppers), shard_size)]
+
+
+def _target_candidates(path, target_week, no_shoppers, columns, first = None, last = None):
+    """
+    returns the rows of lags.parquet of the shoppers first..last for the target week if it is not observed yet (e.g. the simulated week 90),
+    otherwise None
+    """
+    filters = [('week', '==', target_week)] + ([('shopper', '<', no_shoppers)] if no_shoppers is not None else [])
+    filters += [('shopper', '>=', first)] if first is not None else []
+    filters += [('shopper', '<=', last)] if last is not None else []
+    candidates = pd.read_parquet(path + '/lags.parquet', columns = columns + ['product_bought'], filters = filters)
+    return candidates[columns] if len(candidates) > 0 and candidates['product_bought'].isna().all() else None
+
+
+def candidate_shoppers(path, store, target_week, min_frequency = 3, no_shoppers = None):
+    """
+    returns the sorted shoppers that have candidates in the target week (see build_scoring_set); only the shopper column is read
+    """
+    candidates = _target_candidates(path, target_week, no_shoppers, ['shopper'])
+    if candidates is None:
+        candidates = pd.read_parquet(os.path.join(store.directory, 'shopper_product.parquet'), columns = ['shopper'],
+                                     filters = [('no_products_bought_per_product', '>=', min_frequency)])
+    return np.unique(candidates['shopper'].values)
+
+
+def _shard_candidates(path, store, target_week, first, last, min_frequency, no_shoppers):
+    """
+    returns the shopper x product candidates of the shoppers first..last (see build_scoring_set)
+    """
+    candidates = _target_candidates(path, target_week, no_shoppers, ['shopper', 'product'], first, last)
+    if candidates is not None:
+        return candidates
+
+    #store holds the shopper grains of the shard only (FeatureStore.shard)
+    pairs = store.tables['shopper_product']
+    return pairs[pairs['no_products_bought_per_product'] >= min_frequency][['shopper', 'product']]
+
+
+@stage()
+def score_shard(model, scoring_set, discounts = DISCOUNTS, no_coupons = 5, top_n = None):
+
+    """
+    input:
+        model: trained model, see module_coupon_assignment.predict_discounts
+        scoring_set: scoring set of one shard (27 columns of build_scoring_set)
+        discounts: default = DISCOUNTS, discount levels that are scored
+        no_coupons: default = 5, coupons per shopper
+        top_n: default = None (all candidates), candidates per shopper that are scored, see module_candidates.prune_candidates
+    output:
+        coupons: DataFrame with shopper, week, coupon, product, discount (same as coupon_assignment)
+    """
+
+    scoring_set = scoring_set.sort_values(by = ['shopper', 'product']).reset_index(drop = True)
+    if top_n is not None:
+        scoring_set = module_candidates.prune_candidates(scoring_set, top_n = top_n).sort_values(by = ['shopper', 'product']).reset_index(drop = True)
+    proba = predict_discounts(model, scoring_set, discounts)
+    return assign_coupons(scoring_set, proba, discounts, no_coupons)
+
+
+@stage()
+def batch_score(path, model = None, target_week = 90, shard_size = 1000, n_jobs = 2, top_n = None, min_frequency = 3, discounts = DISCOUNTS,
+                no_coupons = 5, output = None, model_name = 'lightgbm', version = 'latest', no_shoppers = None):
+
+    """
+    input:
+        path: path to the data sets (see module_week90_generate_dataset.build_scoring_set)
+        model: default = None (model_name and version of module_model_registry), trained model
+        target_week: default = 90, week the coupons are scored for
+        shard_size: default = 1000, shoppers per shard of the scoring and of the as-of aggregates if they are built
+        n_jobs: default = 2, number of shards that are scored at the same time (threads; LightGBM and NumPy release the GIL)
+        top_n: default = None (all candidates), candidates per shopper that are scored, see module_candidates.prune_candidates
+        min_frequency: default = 3, see build_scoring_set
+        discounts: default = DISCOUNTS, discount levels that are scored
+        no_coupons: default = 5, coupons per shopper
+        output: default = None (path/coupon_index/week_<target_week>), directory of the partitions; existing partitions are replaced
+        model_name, version: default = 'lightgbm', 'latest', model of module_model_registry if model is None
+        no_shoppers: default = None (all shoppers), only the shoppers with an id below this value are scored
+    output:
+        DataFrame with shard, first_shopper, last_shopper, shoppers (with coupons), rows, coupons, seconds and file per shard
+    """
+
+    start = time.time()
+    if model is None:
+        import module_model_registry
+        model, _ = module_model_registry.load_model(path, model_name, version)
+    output = output or os.path.join(path, 'coupon_index', 'week_%d' % target_week)
+    os.makedirs(output, exist_ok = True)
+    for filename in glob.glob(os.path.join(output, 'shard_*.parquet')):
+        os.remove(filename)
+
+    store = module_week90_generate_dataset.asof_feature_store(path, target_week, no_shoppers, shard_size)
+    shoppers = candidate_shoppers(path, store, target_week, min_frequency, no_shoppers)
+    #a candidate without aggregates would be gathered as NaN and silently get no coupons
+    aggregated = pd.read_parquet(os.path.join(store.directory, 'shopper.parquet'), columns = ['shopper'])['shopper'].values
+    missing = shoppers[~np.isin(shoppers, aggregated)]
+    if len(missing):
+        raise ValueError('%d candidate shoppers (e.g. %s) have no aggregates before week %d' % (len(missing), list(missing[:5]), target_week))
+    shards = shopper_shards(shoppers, shard_size)
+
+    def run(shard):
+        shard_start = time.time()
+        first, last = shards[shard]
+        shard_store = store.shard(first, last)
+        candidates = _shard_candidates(path, shard_store, target_week, first, last, min_frequency, no_shoppers)
+        scoring_set = module_week90_generate_dataset.gather_scoring_set(shard_store, candidates, target_week)
+        coupons = score_shard(model, scoring_set, discounts, no_coupons, top_n) if len(scoring_set) else None
+        filename = os.path.join(output, 'shard_%05d.parquet' % shard)
+        if coupons is not None:
+            #written to a temporary file first, so that a reader never sees a partial partition
+            coupons.to_parquet(filename + '.tmp', index = False)
+            os.replace(filename + '.tmp', filename)
+        return {'shard': shard, 'first_shopper': first, 'last_shopper': last, 'shoppers': 0 if coupons is None else coupons['shopper'].nunique(), 'rows': len(scoring_set),
+                'coupons': 0 if coupons is None else len(coupons), 'seconds': time.time() - shard_start,
+                'file': filename if coupons is not None else None}
+
+    #the pool only runs n_jobs shards at a time, finished shards only keep their summary
+    with ThreadPoolExecutor(max(1, n_jobs)) as executor:
+        summary = pd.DataFrame(list(executor.map(run, range(len(shards)))))
+
+    print('Scored %d shoppers (%d rows) in %d shards in %.2f seconds: %d coupons written to %s'
+          % (summary['shoppers'].sum(), summary['rows'].sum(), len(summary), time.time() - start, summary['coupons'].sum(), output))
+
+    return summary
+
+
+def load_coupon_index(path, target_week = 90, output = None, shoppers = None):
+
+    """
+    input:
+        path: path to the data sets
+        target_week: default = 90, week of the coupon index
+        output: default = None (path/coupon_index/week_<target_week>), directory of the partitions
+        shoppers: default = None (all shoppers), only the coupons of these shoppers are read
+    output:
+        coupons: DataFrame with shopper, week, coupon, product, discount sorted by shopper and coupon
+    """
+
+    output = output or os.path.join(path, 'coupon_index', 'week_%d' % target_week)
+    filters = [('shopper', 'in', list(np.atleast_1d(shoppers)))] if shoppers is not None else None
+    coupons = [pd.read_parquet(filename, filters = filters) for filename in sorted(glob.glob(os.path.join(output, 'shard_*.parquet')))]
+    if not coupons:
+        return pd.DataFrame(columns = ['shopper', 'week', 'coupon', 'product', 'discount'])
+    return pd.concat(coupons, ignore_index = True).sort_values(['shopper', 'coupon']).reset_index(drop = True)
@@ -0,0 +1,368 @@
+"""
+The purpose of this module is to:
+* time and memory-profile every stage of the pipeline on synthetic data (module_synthetic_data) at several scales (run_benchmark)
+* write the results machine-readable as JSON and CSV
+
+Stages (in the order of the final notebook):
+    lags: module_lags.LagCalculator.calculate_lags on the merged baskets, coupons and week 90 rows
+    negatives: module_negatives.NegativeSampleGenerator (calculate_frequencies, calculate_customer_preferences, generate)
+    p2v: module_p2v.p2v.train_p2v on the basket product lists
+    clustering: module_clustering.p2cluster (tsne_train, train_cluster, get_categories) on a p2v model trained before the measurement
+    dataset: module_feature_store.build_feature_store (train, test and week90 windows of all shoppers)
+    splitting: module_train_test_splitting.train_test_splitting from the feature store
+    training: module_lightgbm.predict_lightgbm (headless)
+    scoring: week 90 scoring set from the feature store and module_coupon_assignment.predict_discounts
+    assignment: module_coupon_assignment.assign_coupons
+The downstream stages read the created data sets of module_synthetic_data.derive_inputs, so every stage is measured on its own, even if an
+earlier stage fails or times out. The stages dataset, splitting, training, scoring and assignment depend on each other through the feature
+store and the trained model and are run in this order.
+
+Every stage runs in a fresh process, so the memory of one stage does not count for the next one. The process loads the inputs (setup, not
+measured), resets the peak RSS (Linux: /proc/self/clear_refs) and runs the stage. Per stage and scale the results hold:
+    status: ok, error, unavailable (missing optional dependency, e.g. gensim), timeout or killed (e.g. out of memory)
+    wall_seconds, cpu_seconds (all threads of the process), setup_seconds
+    rss_setup_mb (after the setup), peak_rss_mb (peak during the stage, None without the reset)
+    tracemalloc_peak_mb (optional, peak of the traced allocations)
+    rows_in, rows_out
+The output of the stages goes to <output>/logs/<scale>_<stage>.log.
+
+Prerequisite:
+* none; the synthetic data sets are generated if they do not exist yet
+
+Layout on disk:
+    <root>/synthetic_<scale>/ (data sets of module_synthetic_data, feature store and benchmark model)
+    <output>/benchmark_results.json (environment, parameters, results), <output>/benchmark_results.csv (results), <output>/logs/
+"""
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from module_profiling import _memory_mb, _reset_peak_rss
+
+STAGES = ['lags', 'negatives', 'p2v', 'clustering', 'dataset', 'splitting', 'training', 'scoring', 'assignment']
+SCALES = [2000, 20000, 100000]
+RESULT_COLUMNS = ['scale', 'stage', 'status', 'wall_seconds', 'cpu_seconds', 'setup_seconds', 'rss_setup_mb', 'peak_rss_mb', 'tracemalloc_peak_mb',
+                  'rows_in', 'rows_out', 'error']
+#weeks of the final notebook: training 0-88, testing 89, prediction 90
+TRAIN_WEEKS, TEST_WEEKS, TARGET_WEEK = (0, 88), (89, 89), 90
+MODEL_FILE = 'lightgbm_model_benchmark.pkl'
+
+
+def _read_baskets(path, columns = None):
+    return pd.read_parquet(path + '/baskets.parquet', columns = columns)
+
+
+def _product_lists(path):
+    """
+    returns the product list per shopper and week (create_baskets of the final notebook)
+    """
+    baskets = _read_baskets(path, ['week', 'shopper', 'product'])
+    baskets = baskets.groupby(['shopper', 'week'])['product'].agg(list).rename('products').reset_index()
+    baskets['basket_size'] = baskets['products'].apply(len)
+    return baskets
+
+
+def lag_input(path, no_shoppers = None):
+    """
+    returns the input of module_lags.LagCalculator as in the final notebook: the merged baskets and coupons plus the preferred products of
+    the target week (taken from lags.parquet), sorted by shopper, product and week; only the shoppers 0..no_shoppers-1 if given
+    """
+    filters = [('shopper', '<', no_shoppers)] if no_shoppers is not None else None
+    baskets = pd.read_parquet(path + '/baskets.parquet', columns = ['week', 'shopper', 'product', 'price'], filters = filters)
+    coupons = pd.read_parquet(path + '/coupons.parquet', filters = filters)
+    data = pd.merge(baskets, coupons, on = ['week', 'shopper', 'product'], how = 'outer')
+    data['product_bought'] = np.where(data['price'].isna(), 0, 1)
+    #the preferred products of the target week (create_week_90_products of the final notebook)
+    target = pd.read_parquet(path + '/lags.parquet', columns = ['shopper', 'product', 'week'], filters = [('week', '==', TARGET_WEEK)] + (filters or []))
+    data = pd.concat([data[['week', 'shopper', 'product', 'product_bought']], target.assign(product_bought = 0)], ignore_index = True)
+    return data[['shopper', 'product', 'week', 'product_bought']].sort_values(by = ['shopper', 'product', 'week']).reset_index(drop = True)
+
+
+def _setup_lags(path, params):
+    import module_lags
+    data = lag_input(path)
+    return lambda: len(module_lags.LagCalculator(data).calculate_lags()), len(data)
+
+
+def _setup_negatives(path, params):
+    import module_negatives
+    baskets = _product_lists(path)
+    no_customers = int(baskets['shopper'].max()) + 1
+    def run():
+        sampler = module_negatives.NegativeSampleGenerator(baskets, no_customers = no_customers, no_products = params['no_products'])
+        sampler.calculate_frequencies()
+        sampler.calculate_customer_preferences(min_frequency = 3)
+        return len(sampler.generate())
+    return run, len(baskets)
+
+
+def _train_p2v(baskets, params):
+    import module_p2v
+    model = module_p2v.p2v(baskets['products'])
+    model.create_product_list()
+    model.train_p2v(vec_dim = 30, epochs = params['p2v_epochs'])
+    return model
+
+
+def _setup_p2v(path, params):
+    import module_p2v
+    baskets = _product_lists(path)
+    return lambda: len(_train_p2v(baskets, params).p2v_model.wv.vocab), len(baskets)
+
+
+def _setup_clustering(path, params):
+    from module_clustering import p2cluster
+    model = _train_p2v(_product_lists(path), params)
+    def run():
+        clusters = p2cluster(model.p2v_model)
+        clusters.tsne_train()
+        clusters.train_cluster(25)
+        return len(clusters.get_categories())
+    return run, len(model.p2v_model.wv.vocab)
+
+
+def _setup_dataset(path, params):
+    import module_feature_store
+    no_shoppers = params['scale']
+    def run():
+        stores = module_feature_store.build_feature_store(path, no_shoppers = no_shoppers)
+        return sum(store.manifest['rows']['events'] for store in stores.values())
+    return run, params['basket_rows'] + params['coupon_rows']
+
+
+def _split(path):
+    from module_train_test_splitting import train_test_splitting
+    return train_test_splitting(path, TRAIN_WEEKS[0], TRAIN_WEEKS[1], TEST_WEEKS[0], TEST_WEEKS[1], feature_store = True, return_schema = True)
+
+
+def _setup_splitting(path, params):
+    rows = 0
+    for name in ['train', 'test']:
+        with open(os.path.join(path, 'feature_store', name, 'manifest.json')) as file:
+            rows += json.load(file)['rows']['events']
+    def run():
+        X_train, X_test, _, _, _, _ = _split(path)
+        return len(X_train) + len(X_test)
+    return run, rows
+
+
+def _setup_training(path, params):
+    from module_lightgbm import predict_lightgbm
+    X_train, X_test, y_train, y_test, feature_names, categorical_features = _split(path)
+    def run():
+        predict_lightgbm(X_train, X_test, y_train, y_test, n_estimators = params['n_estimators'], feature_names = feature_names,
+                         categorical_features = categorical_features, headless = True, run_record = os.path.join(path, 'lightgbm_run_record_benchmark.json'),
+                         model_file = os.path.join(path, MODEL_FILE))
+        return len(X_test)
+    return run, len(X_train)
+
+
+def _scoring_inputs(path):
+    """
+    returns the trained benchmark model and the candidates and feature store of the target week
+    """
+    import pickle
+    import module_feature_store
+    with open(os.path.join(path, MODEL_FILE), 'rb') as file:
+        model = pickle.load(file)
+    candidates = pd.read_parquet(path + '/lags.parquet', filters = [('week', '==', TARGET_WEEK)])
+    store = module_feature_store.FeatureStore(path, 'week90').load(grains = ['shopper', 'product', 'shopper_product'])
+    return model, candidates, store
+
+
+def _setup_scoring(path, params):
+    import module_week90_generate_dataset
+    from module_coupon_assignment import predict_discounts
+    model, candidates, store = _scoring_inputs(path)
+    def run():
+        scoring_set = module_week90_generate_dataset.gather_scoring_set(store, candidates, TARGET_WEEK)
+        return len(predict_discounts(model, scoring_set))
+    return run, len(candidates)
+
+
+def _setup_assignment(path, params):
+    import module_week90_generate_dataset
+    from module_coupon_assignment import assign_coupons, predict_discounts
+    model, candidates, store = _scoring_inputs(path)
+    scoring_set = module_week90_generate_dataset.gather_scoring_set(store, candidates, TARGET_WEEK)
+    proba = predict_discounts(model, scoring_set)
+    return lambda: len(assign_coupons(scoring_set, proba)), len(scoring_set)
+
+
+_SETUPS = {'lags': _setup_lags, 'negatives': _setup_negatives, 'p2v': _setup_p2v, 'clustering': _setup_clustering, 'dataset': _setup_dataset,
+           'splitting': _setup_splitting, 'training': _setup_training, 'scoring': _setup_scoring, 'assignment': _setup_assignment}
+
+
+def _measure_stage(path, stage, params, trace_memory, log_file, connection):
+    """
+    runs one stage in the current (child) process and sends the measurements through the connection
+    """
+    with open(log_file, 'w') as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+    sys.stdout = open(1, 'w', buffering = 1, closefd = False)
+    sys.stderr = open(2, 'w', buffering = 1, closefd = False)
+
+    result = {'status': 'ok', 'error': None}
+    stage_start = None
+    try:
+        start = time.time()
+        run, result['rows_in'] = _SETUPS[stage](path, params)
+        result['setup_seconds'] = time.time() - start
+        result['rss_setup_mb'] = _memory_mb('VmRSS')
+        peak_reset = _reset_peak_rss()
+        if trace_memory:
+            tracemalloc.start()
+        stage_start, cpu_start = time.perf_counter(), time.process_time()
+        result['rows_out'] = run()
+    except ImportError as error:
+        result.update(status = 'unavailable', error = '%s: %s' % (type(error).__name__, error))
+    except Exception as error:
+        result.update(status = 'error', error = '%s: %s' % (type(error).__name__, error))
+
+    #a stage that fails is measured up to the error
+    if stage_start is not None:
+        result['wall_seconds'] = time.perf_counter() - stage_start
+        result['cpu_seconds'] = time.process_time() - cpu_start
+        if trace_memory:
+            result['tracemalloc_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+        #without the reset the peak of the process would include the setup, so it is not reported
+        result['peak_rss_mb'] = _memory_mb('VmHWM') if peak_reset else None
+    connection.send(result)
+
+
+def run_stage(path, stage, params, timeout = 3600, trace_memory = False, log_file = os.devnull):
+
+    """
+    input:
+        path: path to the data sets of the scale
+        stage: name of the stage, one of STAGES
+        params: dict with scale, no_products, basket_rows, coupon_rows, n_estimators and p2v_epochs
+        timeout: default = 3600, seconds after which the stage is stopped (status timeout)
+        trace_memory: default = False, whether to trace the Python allocations with tracemalloc (slows down the stage)
+        log_file: default = os.devnull, file the output of the stage is written to
+    output:
+        dict with the measurements of the stage (RESULT_COLUMNS without scale and stage)
+    """
+
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex = False)
+    process = context.Process(target = _measure_stage, args = (path, stage, params, trace_memory, log_file, sender))
+    start = time.time()
+    process.start()
+    sender.close()
+    result = None
+    if receiver.poll(timeout):
+        try:
+            result = receiver.recv()
+        except EOFError:
+            pass
+    if result is None:
+        if process.is_alive():
+            process.kill()
+            process.join()
+            result = {'status': 'timeout', 'error': 'stopped after %d seconds' % timeout}
+        else:
+            process.join()
+            result = {'status': 'killed', 'error': 'process exited with code %s' % process.exitcode}
+        result['wall_seconds'] = time.time() - start
+    process.join()
+    return result
+
+
+def environment():
+    """
+    returns the versions and resources the benchmark ran with
+    """
+    import lightgbm
+    memory = None
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2 ** 30
+    except (ValueError, OSError, AttributeError):
+        pass
+    return {'timestamp': datetime.datetime.now().isoformat(timespec = 'seconds'), 'python': platform.python_version(), 'platform': platform.platform(),
+            'cpu_count': os.cpu_count(), 'memory_gb': memory, 'numpy': np.__version__, 'pandas': pd.__version__, 'lightgbm': lightgbm.__version__}
+
+
+def run_benchmark(root, scales = SCALES, stages = STAGES, timeout = 3600, trace_memory = False, n_estimators = 300, p2v_epochs = 100, output = None, seed = 0):
+
+    """
+    input:
+        root: directory of the synthetic data sets of every scale (<root>/synthetic_<scale>)
+        scales: default = SCALES (2000, 20000 and 100000 shoppers), numbers of shoppers
+        stages: default = STAGES (all stages), stages that are measured; they are run in the order of STAGES
+        timeout: default = 3600, seconds after which a stage is stopped
+        trace_memory: default = False, whether to measure the peak of the Python allocations with tracemalloc as well
+        n_estimators: default = 300, boosting iterations of the training stage
+        p2v_epochs: default = 100, epochs of the p2v stage
+        output: default = None (root), directory of benchmark_results.json, benchmark_results.csv and the logs
+        seed: default = 0, seed of the synthetic data
+    output:
+        results: DataFrame with RESULT_COLUMNS, one row per scale and stage
+    """
+
+    import module_synthetic_data
+    output = output or root
+    os.makedirs(os.path.join(output, 'logs'), exist_ok = True)
+    stages = [stage for stage in STAGES if stage in stages]
+    report = {'environment': environment(),
+              'parameters': {'scales': list(scales), 'stages': stages, 'timeout': timeout, 'trace_memory': trace_memory, 'n_estimators': n_estimators,
+                             'p2v_epochs': p2v_epochs, 'seed': seed},
+              'data': {}, 'results': []}
+
+    def save():
+        filename = os.path.join(output, 'benchmark_results')
+        with open(filename + '.json.tmp', 'w') as file:
+            json.dump(report, file, indent = 2)
+        os.replace(filename + '.json.tmp', filename + '.json')
+        pd.DataFrame(report['results'], columns = RESULT_COLUMNS).to_csv(filename + '.csv', index = False)
+
+    for scale in scales:
+        path = os.path.join(root, 'synthetic_%d' % scale)
+        summary_file = os.path.join(path, 'synthetic_data.json')
+        summary = None
+        if os.path.exists(summary_file):
+            with open(summary_file) as file:
+                summary = json.load(file)
+        if summary is None or summary['no_shoppers'] != scale or summary['seed'] != seed or 'derived' not in summary:
+            summary = module_synthetic_data.generate_synthetic_data(path, no_shoppers = scale, seed = seed)
+        report['data'][str(scale)] = summary
+
+        params = {'scale': scale, 'no_products': summary['no_products'], 'basket_rows': summary['basket_rows'], 'coupon_rows': summary['coupon_rows'],
+                  'n_estimators': n_estimators, 'p2v_epochs': p2v_epochs}
+        for stage in stages:
+            result = run_stage(path, stage, params, timeout, trace_memory, os.path.join(output, 'logs', '%d_%s.log' % (scale, stage)))
+            result = dict({column: None for column in RESULT_COLUMNS}, scale = scale, stage = stage, **result)
+            report['results'].append(result)
+            save()
+            print('%7d shoppers  %-10s %-11s %9.2f s  peak RSS %s MB%s' % (scale, stage, result['status'], result['wall_seconds'] or 0,
+                  '%.0f' % result['peak_rss_mb'] if result['peak_rss_mb'] is not None else '-', '  (%s)' % result['error'] if result['error'] else ''))
+
+    save()
+    return pd.DataFrame(report['results'], columns = RESULT_COLUMNS)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Time and memory-profile the pipeline stages on synthetic data')
+    parser.add_argument('root', help = 'directory of the synthetic data sets')
+    parser.add_argument('--scales', type = int, nargs = '+', default = SCALES)
+    parser.add_argument('--stages', nargs = '+', default = STAGES, choices = STAGES)
+    parser.add_argument('--timeout', type = int, default = 3600)
+    parser.add_argument('--trace-memory', action = 'store_true')
+    parser.add_argument('--n-estimators', type = int, default = 300)
+    parser.add_argument('--p2v-epochs', type = int, default = 100)
+    parser.add_argument('--output', default = None)
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    run_benchmark(args.root, args.scales, args.stages, args.timeout, args.trace_memory, args.n_estimators, args.p2v_epochs, args.output, args.seed)
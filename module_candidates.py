@@ -0,0 +1,143 @@
+"""
+The purpose of this module is to:
+* narrow the shopper x product pairs of a scoring set (e.g. week 90) down to a top-N per shopper before the model scores them
+* measure the recall of the pruned candidates against the coupons of the unpruned ranking
+
+Only 5 coupons per shopper are kept by module_coupon_assignment, but every pair of the scoring set is scored under four discounts.
+The candidates are ranked with cheap signals that are already computed by the pipeline:
+    * preference: purchase frequency of the product by the shopper (NegativeSampleGenerator.total_frequency_without89 or no_products_bought_per_product)
+    * recency: weeks since the last purchase (lag_weeks_of_product_per_customer from module_lags)
+    * category: share of the shopper's purchases in the p2v category of the product (category_label from module_clustering)
+
+Prerequisite:
+* A scoring set with the columns of module_week90_generate_dataset
+"""
+
+import numpy as np
+import pandas as pd
+from module_profiling import stage
+
+#weights of the (scaled) signals in the candidate score
+DEFAULT_WEIGHTS = {'preference': 1.0, 'recency': 1.0, 'category': 0.5}
+
+
+def candidate_scores(scoring_set, frequency = None, weights = None):
+
+    """
+    input:
+        scoring_set: DataFrame with shopper, product, lag_weeks_of_product_per_customer and category_label (e.g. output of build_scoring_set)
+        frequency: default = None, np.ndarray shopper x product with purchase counts (e.g. NegativeSampleGenerator.get_total_frequency_without89());
+                   by default no_products_bought_per_product of the scoring set is used
+        weights: default = None (DEFAULT_WEIGHTS), dict with the weights of the preference, recency and category signal
+    output:
+        np.ndarray with one score per row of the scoring set, higher = more promising candidate
+    """
+
+    weights = weights or DEFAULT_WEIGHTS
+    shopper = scoring_set['shopper'].values.astype(np.int64)
+    product = scoring_set['product'].values.astype(np.int64)
+
+    #preference: purchase counts, log-scaled so that heavy buyers do not dominate the other signals
+    if frequency is not None:
+        counts = np.asarray(frequency)[shopper, product].astype(np.float64)
+    else:
+        counts = np.maximum(scoring_set['no_products_bought_per_product'].values.astype(np.float64), 0)
+    preference = np.log1p(counts)
+
+    #recency: 1 for a purchase in the last week, decaying with the number of weeks since; 0 if never bought
+    lag = scoring_set['lag_weeks_of_product_per_customer'].values.astype(np.float64)
+    recency = np.where(lag > 0, 1 / np.maximum(lag, 1), 0)
+
+    #category: share of the shopper's purchases (among the candidates) that fall into the category of the product
+    category = scoring_set['category_label'].values
+    category = np.where(np.isnan(category.astype(np.float64)), -1, category).astype(np.int64) + 1
+    no_categories = int(category.max()) + 1 if len(category) else 1
+    shopper_category = shopper * no_categories + category
+    category_counts = np.bincount(shopper_category, weights = counts)
+    shopper_counts = np.bincount(shopper, weights = counts)
+    category_share = category_counts[shopper_category] / np.maximum(shopper_counts[shopper], 1)
+
+    return weights['preference'] * preference + weights['recency'] * recency + weights['category'] * category_share
+
+
+def rank_within_shopper(shopper, scores, product = None):
+
+    """
+    input:
+        shopper: np.ndarray with the shopper of every row
+        scores: np.ndarray with the score of every row
+        product: default = None, np.ndarray used to break ties deterministically (lower product first)
+    output:
+        np.ndarray with the 0-based rank of every row within its shopper (0 = highest score)
+    """
+
+    keys = (-scores, shopper) if product is None else (product, -scores, shopper)
+    order = np.lexsort(keys)
+    sorted_shopper = shopper[order]
+    #position of the first row of every shopper in the sorted order
+    group_start = np.r_[0, np.flatnonzero(sorted_shopper[1:] != sorted_shopper[:-1]) + 1]
+    group_sizes = np.diff(np.r_[group_start, len(order)])
+    rank = np.empty(len(order), dtype = np.int64)
+    rank[order] = np.arange(len(order)) - np.repeat(group_start, group_sizes)
+    return rank
+
+
+@stage()
+def prune_candidates(scoring_set, top_n = 25, frequency = None, weights = None):
+
+    """
+    input:
+        scoring_set: DataFrame with the columns of module_week90_generate_dataset
+        top_n: default = 25, number of candidates kept per shopper
+        frequency: default = None, see candidate_scores
+        weights: default = None, see candidate_scores
+    output:
+        pruned scoring set (same columns, same order) with at most top_n rows per shopper
+    """
+
+    scores = candidate_scores(scoring_set, frequency, weights)
+    rank = rank_within_shopper(scoring_set['shopper'].values, scores, scoring_set['product'].values)
+    pruned = scoring_set[rank < top_n].reset_index(drop = True)
+
+    print('Candidate pruning (top %d): %d of %d rows kept (%.1f%%)' % (top_n, len(pruned), len(scoring_set), 100 * len(pruned) / max(len(scoring_set), 1)))
+
+    return pruned
+
+
+def candidate_recall(coupons, candidates):
+
+    """
+    input:
+        coupons: coupon assignment of the unpruned scoring set (columns shopper, product), e.g. output of coupon_assignment
+        candidates: pruned candidates (columns shopper, product)
+    output:
+        share of the coupons whose shopper x product pair is still among the candidates
+    """
+
+    coupon_keys = coupons['shopper'].values.astype(np.int64) * 2 ** 32 + coupons['product'].values.astype(np.int64)
+    candidate_keys = np.unique(candidates['shopper'].values.astype(np.int64) * 2 ** 32 + candidates['product'].values.astype(np.int64))
+    return float(np.isin(coupon_keys, candidate_keys).mean()) if len(coupon_keys) else 1.0
+
+
+def evaluate_pruning(scoring_set, coupons, top_ns = (5, 10, 25, 50), frequency = None, weights = None):
+
+    """
+    input:
+        scoring_set: unpruned scoring set
+        coupons: coupon assignment of the unpruned scoring set (see candidate_recall)
+        top_ns: default = (5, 10, 25, 50), candidate list lengths that are evaluated
+        frequency, weights: see candidate_scores
+    output:
+        DataFrame with top_n, rows, row_share (share of the unpruned rows that still has to be scored) and recall
+    """
+
+    scores = candidate_scores(scoring_set, frequency, weights)
+    rank = rank_within_shopper(scoring_set['shopper'].values, scores, scoring_set['product'].values)
+
+    results = []
+    for top_n in top_ns:
+        candidates = scoring_set.loc[rank < top_n, ['shopper', 'product']]
+        results.append({'top_n': top_n, 'rows': len(candidates), 'row_share': len(candidates) / max(len(scoring_set), 1),
+                        'recall': candidate_recall(coupons, candidates)})
+
+    return pd.DataFrame(results)
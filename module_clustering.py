@@ -12,6 +12,7 @@ import seaborn as sns
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+from module_profiling import stage
 
 class p2cluster():
     """
@@ -27,6 +28,7 @@ class p2cluster():
         self.x = []
         self.y = []
     
+    @stage()
     def tsne_train(self, perplexity=2, no_iterations=5000):
         """
         Creates TSNE model
@@ -79,6 +81,7 @@ class p2cluster():
         visualizer.fit(np.column_stack((self.x, self.y)))  # Fit the data to the visualizer
         visualizer.show()
         
+    @stage(rows_in=lambda self, *args, **kwargs: len(self.x))
     def train_cluster(self, nclut=25):
         """
         Train kmeans clustering
@@ -93,6 +96,7 @@ class p2cluster():
         p.legend_.remove()
         plt.show()
         
+    @stage()
     def get_categories(self):
         """
         Return DF with product categories
@@ -5,6 +5,9 @@ The purpose of this module is to:
 * load a trained model
 * make predictions under various discounts d e {15,20,25,30}
 * get top 5 coupons for every shopper based on expected revenue
+* score any grid of discounts (including 0 = no coupon) in one stacked prediction pass per chunk (predict_discounts, discount_cube)
+* select the top coupons per shopper on arrays (top_coupons, assign_coupons)
+* keep the predictions as a struct of arrays (Predictions) instead of one full-width dataset per discount
 """
 
 
@@ -17,6 +20,11 @@ import pickle
 
 import module_week90_generate_dataset
 from module_week90_generate_dataset import week90_generate_dataset 
+from module_train_test_splitting import FEATURE_COLUMNS
+from module_profiling import stage
+
+#discounts of the coupons in percent
+DISCOUNTS = [15, 20, 25, 30]
 
 
 # load the trained LightGBM model 
@@ -41,6 +49,7 @@ def load_model(filename):
 
 # create prediction datasets 
 
+@stage()
 def get_test_discounts(X_test_90):
     """
     generate test data sets for various discounts d e {15,20,25,30}
@@ -70,6 +79,7 @@ def get_test_discounts(X_test_90):
     
 
 # create predictions using the trained LightGBM model 
+@stage()
 def predictions(model, X_test_d15, X_test_d20, X_test_d25, X_test_d30):
     pred_d15 = model.predict_proba(X_test_d15.values)
     pred_d20 = model.predict_proba(X_test_d20.values)
@@ -77,70 +87,229 @@ def predictions(model, X_test_d15, X_test_d20, X_test_d25, X_test_d30):
     pred_d30 = model.predict_proba(X_test_d30.values)
     return pred_d15, pred_d20, pred_d25, pred_d30
 
+class Predictions:
+    
+    """
+    lean prediction result as a struct of arrays; the rows are the shopper x product pairs, the columns of price and proba the discount levels
+        shopper, product, week: np.ndarray with one value per row
+        discount: np.ndarray with one value per discount level
+        price, proba: np.ndarray rows x discount levels
+    the key arrays are views of the columns they are built from, the feature matrices are not copied
+    """
+    
+    __slots__ = ['shopper', 'product', 'week', 'discount', 'price', 'proba']
+    
+    def __init__(self, shopper, product, week, discount, price, proba):
+        self.shopper = np.asarray(shopper)
+        self.product = np.asarray(product)
+        self.week = np.asarray(week) if np.ndim(week) else np.full(len(self.shopper), week)
+        self.discount = np.asarray(discount)
+        self.price = np.asarray(price)
+        self.proba = np.asarray(proba)
+        assert len(self.product) == len(self.week) == len(self.shopper)
+        assert self.price.shape == self.proba.shape == (len(self.shopper), len(self.discount))
+    
+    @classmethod
+    def from_scoring_set(cls, scoring_set, proba, discounts = DISCOUNTS, week = None):
+        """
+        returns the predictions of a scoring set (shopper, product, max_price and week) and the output of predict_discounts
+        """
+        discounts = np.asarray(list(discounts))
+        price = scoring_set['max_price'].values[:, None] * (1 - discounts / 100)
+        week = scoring_set['week'].values if week is None else week
+        return cls(scoring_set['shopper'].values, scoring_set['product'].values, week, discounts, price, proba)
+    
+    def __len__(self):
+        return len(self.shopper)
+    
+    @property
+    def e_revenue(self):
+        """
+        expected revenue: adjusted price * purchase probability, rows x discount levels
+        """
+        return self.price * self.proba
+    
+    def to_frame(self):
+        """
+        returns the long format with one row per shopper x product x discount (week, shopper, product, price, discount, proba)
+        """
+        no_levels = len(self.discount)
+        return pd.DataFrame({'week': np.repeat(self.week, no_levels), 'shopper': np.repeat(self.shopper, no_levels),
+                             'product': np.repeat(self.product, no_levels), 'price': self.price.reshape(-1),
+                             'discount': np.tile(self.discount, len(self)), 'proba': self.proba.reshape(-1)})
+
+
+def _proba_column(pred):
+    """
+    returns the purchase probabilities of the output of predict_proba (rows x classes) or of a booster (rows)
+    """
+    pred = np.asarray(pred)
+    return pred[:, 1] if pred.ndim == 2 else pred
+
+
+@stage()
 def merge_predictions(X_test_90, X_test_d15, X_test_d20, X_test_d25, X_test_d30, pred_d15, pred_d20, pred_d25, pred_d30):
     """
-    data structure: 
-        week [optional]
-        shopper
-        product
-        price
-        discount
-        proba (y_hat)
-    """
-    # add product and shopper
-    X_test_d15['product'] = X_test_90['product']
-    X_test_d15['shopper'] = X_test_90['shopper']
-    # add product and shopper
-    X_test_d20['product'] = X_test_90['product']
-    X_test_d20['shopper'] = X_test_90['shopper']
-    # add product and shopper
-    X_test_d25['product'] = X_test_90['product']
-    X_test_d25['shopper'] = X_test_90['shopper']
-    # add product and shopper
-    X_test_d30['product'] = X_test_90['product']
-    X_test_d30['shopper'] = X_test_90['shopper']
-    
-    # add predicitons to respective test data sets 
-    X_test_d15['proba'] = pred_d15[::,1]
-    X_test_d20['proba'] = pred_d20[::,1]
-    X_test_d25['proba'] = pred_d25[::,1]
-    X_test_d30['proba'] = pred_d30[::,1]
+    input: 
+        X_test_90: dataset with shopper and product (and week) in the row order of the prediction datasets
+        X_test_d15, X_test_d20, X_test_d25, X_test_d30: prediction datasets (output of get_test_discounts)
+        pred_d15, pred_d20, pred_d25, pred_d30: predictions (output of predictions)
+    output: 
+        Predictions with the data structure: 
+            week
+            shopper
+            product
+            price
+            discount
+            proba (y_hat)
+    """
+    frames = [X_test_d15, X_test_d20, X_test_d25, X_test_d30]
+    week = X_test_90['week'].values if 'week' in X_test_90.columns else X_test_d15['week'].values
     
-    return X_test_d15, X_test_d20, X_test_d25, X_test_d30
+    # only the price column of every prediction dataset and the probabilities of a purchase are kept
+    price = np.column_stack([X_test_d['price'].values for X_test_d in frames])
+    proba = np.column_stack([_proba_column(pred) for pred in [pred_d15, pred_d20, pred_d25, pred_d30]])
+    
+    return Predictions(X_test_90['shopper'].values, X_test_90['product'].values, week, DISCOUNTS, price, proba)
 
-def coupon_assignment(X_test_d15, X_test_d20, X_test_d25, X_test_d30):
+def top_coupons(shopper, product, e_revenue, no_coupons = 5):
+    
     """
     input: 
-        X_test_d15: prediction dataset for d = 15
-        X_test_d20: prediction dataset for d = 20
-        X_test_d25: prediction dataset for d = 25
-        X_test_d30: prediction dataset for d = 30
+        shopper: np.ndarray with the shopper of every row
+        product: np.ndarray with the product of every row
+        e_revenue: np.ndarray rows x discount levels with the expected revenue (price x probability) of every row under every discount
+        no_coupons: default = 5, coupons per shopper
     output: 
-        top5coupons: coupon recommendation dataset
+        row: np.ndarray with the row of every coupon
+        level: np.ndarray with the discount level of every coupon
+        coupon: np.ndarray with the 0-based coupon number within the shopper
+        the coupons are sorted by shopper and coupon
+    
+    same selection and tie-breaking as groupby(['shopper', 'product']).apply(nlargest(1)) over the discounts followed by
+    groupby('shopper').apply(nlargest(no_coupons)): on ties the lower discount level and the lower product win; NaN revenues are skipped
     """
-    # concat the various prediction files 
-    preds = pd.concat([X_test_d15,X_test_d20,X_test_d25,X_test_d30], axis=0)
     
-    # subset the data to only required columns
-    preds = preds[['week', 'shopper', 'product', 'price', 'discount', 'proba']]
+    shopper = np.asarray(shopper)
+    product = np.asarray(product)
+    e_revenue = np.asarray(e_revenue, dtype = np.float64)
+    if e_revenue.ndim == 1:
+        e_revenue = e_revenue[:, None]
     
-    # calculate expected revenue
-    # adjusted price * purchase probability|coupon d e {15,20,25,30}
-    preds['e_revenue'] = preds['price'] * preds['proba']
+    #best expected revenue per row over the discounts (fmax skips NaN; rows without any revenue stay NaN and are dropped)
+    best = e_revenue[:, 0].copy()
+    for level in range(1, e_revenue.shape[1]):
+        np.fmax(best, e_revenue[:, level], out = best)
+    best[np.isnan(best)] = -np.inf
     
-    # finding top-k (here, 1) discount on a product-shopper pair 
-    topdiscount = 1
-    top1discount = preds.groupby(['shopper', 'product']).apply(lambda x: x.nlargest(topdiscount, ['e_revenue'])).reset_index(drop=True)
+    def best_level(rows):
+        #first (= lowest) discount level with the best revenue, as nlargest keeps the first of equal rows
+        revenue = e_revenue[rows]
+        return np.argmax(np.where(np.isnan(revenue), -np.inf, revenue), axis = 1)
     
-    # finding top-k (here, 5) best products of a shopper by expected revenue
-    topcoupons = 5
-    top5coupons = top1discount.groupby(['shopper']).apply(lambda x: x.nlargest(topcoupons, ['e_revenue'])).reset_index(drop=True)
+    #one row per shopper x product pair in the order shopper, product; duplicated pairs keep their best row (lower level, then earlier row on ties)
+    order = None
+    if len(shopper) > 1 and not (np.all(shopper[1:] >= shopper[:-1]) and np.all((product[1:] > product[:-1]) | (shopper[1:] != shopper[:-1]))):
+        key = shopper.astype(np.int64) * 2 ** 32 + product.astype(np.int64)
+        order = np.lexsort((np.arange(len(shopper)), best_level(slice(None)), -best, product, shopper))
+        order = order[np.r_[True, key[order][1:] != key[order][:-1]]]
+    valid = best > -np.inf if order is None else best[order] > -np.inf
+    if not valid.all():
+        order = np.flatnonzero(valid) if order is None else order[valid]
+    pair_shopper = shopper if order is None else shopper[order]
+    pair_best = best if order is None else best[order]
+    no_pairs = len(pair_shopper)
+    if no_pairs == 0:
+        empty = np.zeros(0, dtype = np.int64)
+        return empty, empty, empty
     
-    # assinging coupons 
-    top5coupons['coupon'] = top5coupons.groupby("shopper").cumcount()
+    #rows grouped by shopper as a padded matrix shopper x position (position = product order within the shopper)
+    group_start = np.r_[0, np.flatnonzero(pair_shopper[1:] != pair_shopper[:-1]) + 1]
+    group_sizes = np.diff(np.r_[group_start, no_pairs])
+    width = int(group_sizes.max())
+    if (group_sizes == width).all():
+        #every shopper has the same number of candidates: the matrix is a reshape
+        matrix = pair_best.reshape(len(group_start), width)
+    else:
+        matrix = np.full((len(group_start), width), -np.inf)
+        matrix[np.repeat(np.arange(len(group_start)), group_sizes), np.arange(no_pairs) - np.repeat(group_start, group_sizes)] = pair_best
+    
+    if width > no_coupons:
+        #value of the no_coupons-th largest revenue per shopper; of the rows with exactly this value the lower positions are kept
+        kth = np.partition(matrix, width - no_coupons, axis = 1)[:, width - no_coupons:width - no_coupons + 1]
+        selected = matrix >= kth
+        #shoppers with more ties at the kth value than free coupons keep only the first ones
+        excess = np.flatnonzero(np.count_nonzero(selected, axis = 1) > no_coupons)
+        if len(excess):
+            greater = matrix[excess] > kth[excess]
+            equal = matrix[excess] == kth[excess]
+            selected[excess] = greater | (equal & (np.cumsum(equal, axis = 1) <= no_coupons - greater.sum(axis = 1, keepdims = True)))
+        #shoppers with less than no_coupons candidates
+        short = np.flatnonzero(kth[:, 0] == -np.inf)
+        if len(short):
+            selected[short] &= matrix[short] > -np.inf
+    else:
+        selected = matrix > -np.inf
+    
+    #selected pairs (at most no_coupons per shopper) in a matrix shopper x slot, ordered by revenue (descending); the stable sort keeps
+    #the lower position first on ties
+    selected = np.flatnonzero(selected)
+    sel_group, sel_position = np.divmod(selected, width)
+    counts = np.bincount(sel_group, minlength = len(group_start))
+    slot_start = np.r_[0, np.cumsum(counts)[:-1]].astype(np.int64)
+    slot = np.arange(len(selected)) - np.repeat(slot_start, counts)
+    values = np.full((len(group_start), no_coupons), np.inf)
+    values[sel_group, slot] = -matrix.reshape(-1)[selected]
+    ranking = np.argsort(values, axis = 1, kind = 'stable')
+    coupon_group, coupon = np.nonzero(np.arange(no_coupons)[None, :] < counts[:, None])
+    row = group_start[coupon_group] + sel_position[slot_start[coupon_group] + ranking[coupon_group, coupon]]
+    if order is not None:
+        row = order[row]
+    
+    return row, best_level(row), coupon
+
+
+def _frames_to_predictions(predictions):
+    """
+    returns the Predictions of prediction datasets with shopper, product, week, price, discount and proba columns (one dataset per discount)
+    """
+    shopper = predictions[0]['shopper'].values
+    product = predictions[0]['product'].values
+    for preds in predictions[1:]:
+        assert np.array_equal(preds['shopper'].values, shopper) and np.array_equal(preds['product'].values, product)
+    discount = [preds['discount'].values[0] if len(preds) else np.nan for preds in predictions]
+    price = np.column_stack([preds['price'].values for preds in predictions])
+    proba = np.column_stack([preds['proba'].values for preds in predictions])
+    return Predictions(shopper, product, predictions[0]['week'].values, discount, price, proba)
+
+
+def _assign(predictions, no_coupons):
+    """
+    returns the top no_coupons coupons per shopper of the Predictions by expected revenue
+    """
+    row, level, coupon = top_coupons(predictions.shopper, predictions.product, predictions.e_revenue, no_coupons)
+    return pd.DataFrame({'shopper': predictions.shopper[row], 'week': predictions.week[row], 'coupon': coupon,
+                         'product': predictions.product[row], 'discount': predictions.discount[level]})
+
+
+@stage()
+def coupon_assignment(predictions, *further_predictions):
+    """
+    input: 
+        predictions: Predictions (output of merge_predictions or Predictions.from_scoring_set)
+        -> the prediction datasets of the discounts d e {15,20,25,30} (and further discounts) with shopper, product, week, price, discount
+           and proba columns and the same rows in the same order are accepted as well
+    output: 
+        top5coupons: coupon recommendation dataset
+    """
+    if not isinstance(predictions, Predictions):
+        predictions = _frames_to_predictions([predictions] + list(further_predictions))
     
-    #resorting the final dataframe
-    top5coupons_final = top5coupons[['shopper', 'week', 'coupon', 'product', 'discount']]
+    # calculate expected revenue
+    # adjusted price * purchase probability|coupon d e {15,20,25,30}
+    # finding top-k (here, 1) discount on a product-shopper pair and top-k (here, 5) best products of a shopper by expected revenue
+    topcoupons = 5
+    top5coupons_final = _assign(predictions, topcoupons)
     
     # unit test 
     #assert top5coupons_final.shape[0] == 10000 #10.000 = 2000*5
@@ -154,3 +323,108 @@ def coupon_assignment(X_test_d15, X_test_d20, X_test_d25, X_test_d30):
     # returning output dataset
     return top5coupons_final
 
+
+@stage()
+def assign_coupons(scoring_set, proba, discounts = DISCOUNTS, no_coupons = 5, week = None):
+    
+    """
+    input: 
+        scoring_set: DataFrame with shopper, product, max_price (and week) in the row order of proba
+        proba: output of predict_discounts
+        discounts: default = DISCOUNTS, discount levels of the columns of proba
+        no_coupons: default = 5, coupons per shopper
+        week: default = None (week column of the scoring set), week of the coupons
+    output: 
+        coupons: DataFrame with shopper, week, coupon, product, discount (same as coupon_assignment)
+    """
+    
+    return _assign(Predictions.from_scoring_set(scoring_set, proba, discounts, week), no_coupons)
+
+
+def _predict_proba(model, X):
+    """
+    returns the purchase probabilities of a LGBMClassifier or lgbm.Booster (e.g. module_model_registry)
+    """
+    if hasattr(model, 'predict_proba'):
+        return model.predict_proba(X)[:, 1]
+    return model.predict(X)
+
+
+#columns that are set per discount level and may be missing in a scoring set
+DISCOUNT_COLUMNS = ['discount', 'price']
+
+
+def feature_matrix(frame):
+    """
+    returns the float32 matrix rows x FEATURE_COLUMNS of a DataFrame; the columns are selected by name (the scoring sets of week 90 have another
+    column order than the training set); only the DISCOUNT_COLUMNS may be missing (filled with 0), any other missing column raises a KeyError
+    """
+    missing = [column for column in FEATURE_COLUMNS if column not in frame.columns and column not in DISCOUNT_COLUMNS]
+    if missing:
+        raise KeyError('The scoring set misses the feature columns %s' % ', '.join(missing))
+    base = np.zeros((len(frame), len(FEATURE_COLUMNS)), dtype = np.float32)
+    for idx, column in enumerate(FEATURE_COLUMNS):
+        if column in frame.columns:
+            base[:, idx] = frame[column].values
+    return base
+
+
+@stage()
+def predict_discounts(model, X_base, discounts = DISCOUNTS, chunk_size = 2 ** 18):
+    
+    """
+    input: 
+        model: trained model, see _predict_proba; it expects the columns FEATURE_COLUMNS (module_train_test_splitting)
+        X_base: DataFrame with the feature columns (e.g. output of week90_generate_dataset or build_scoring_set; only discount and price may be
+                missing, see feature_matrix) or np.ndarray with the columns FEATURE_COLUMNS
+        discounts: default = DISCOUNTS, discount levels in percent; 0 is the no-coupon baseline
+        chunk_size: default = 2 ** 18, rows of the stacked prediction buffer; the buffer holds chunk_size / len(discounts) base rows
+                    under every discount, so the memory does not grow with the number of discounts
+    output: 
+        proba: np.ndarray float32 rows x discounts with the purchase probability of every row under every discount
+    """
+    
+    discounts = list(discounts)
+    discount_col, price_col, max_price_col = [FEATURE_COLUMNS.index(column) for column in ['discount', 'price', 'max_price']]
+    if isinstance(X_base, pd.DataFrame):
+        base = feature_matrix(X_base)
+    else:
+        base = np.asarray(X_base)
+        assert base.ndim == 2 and base.shape[1] == len(FEATURE_COLUMNS)
+    
+    no_levels = len(discounts)
+    rows_per_chunk = max(1, chunk_size // no_levels)
+    buffer = np.empty((rows_per_chunk * no_levels, len(FEATURE_COLUMNS)), dtype = np.float32)
+    proba = np.empty((len(base), no_levels), dtype = np.float32)
+    
+    for start in range(0, len(base), rows_per_chunk):
+        chunk = base[start:start + rows_per_chunk]
+        no_rows = len(chunk)
+        #level-major stacking: rows [level * no_rows, (level + 1) * no_rows) hold the chunk under discounts[level]
+        stacked = buffer[:no_rows * no_levels].reshape(no_levels, no_rows, len(FEATURE_COLUMNS))
+        stacked[:] = chunk
+        for level, discount in enumerate(discounts):
+            stacked[level, :, discount_col] = discount
+            stacked[level, :, price_col] = chunk[:, max_price_col] * (1 - discount / 100)
+        proba[start:start + no_rows] = _predict_proba(model, buffer[:no_rows * no_levels]).reshape(no_levels, no_rows).T
+    
+    return proba
+
+
+def discount_cube(scoring_set, proba):
+    
+    """
+    input: 
+        scoring_set: DataFrame with shopper and product, in the row order of proba
+        proba: output of predict_discounts
+    output: 
+        cube: np.ndarray float32 shoppers x products x discounts (NaN for shopper x product pairs that are not in the scoring set)
+        shoppers: np.ndarray with the shopper of every first index
+        products: np.ndarray with the product of every second index
+    """
+    
+    shoppers, shopper_idx = np.unique(scoring_set['shopper'].values, return_inverse = True)
+    products, product_idx = np.unique(scoring_set['product'].values, return_inverse = True)
+    cube = np.full((len(shoppers), len(products), proba.shape[1]), np.nan, dtype = np.float32)
+    cube[shopper_idx, product_idx] = proba
+    return cube, shoppers, products
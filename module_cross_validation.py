@@ -0,0 +1,249 @@
+"""
+The purpose of this module is to:
+* validate the lightGBM of module_lightgbm on several expanding-window (rolling-origin) folds instead of the single week 89
+* train the folds in parallel worker processes and aggregate auc, binary logloss and the coupon hit rate of the notebook
+
+Fold k tests the week t_k and is trained on all weeks before it (0, ..., t_k - 1); the last fold is the split train 0-88 / test 89.
+By default (asof = True) every fold has its own aggregates (fold_split), built as the single split is built for week 89:
+    * cv_train_<t_k>: window 0..t_k-1 of module_feature_store, the training rows only see the weeks before the test week
+    * cv_test_<t_k>: window 1..t_k, the test week is part of its aggregates as week 89 is in the test set of the single split
+    * min_price, the temporal distribution and the average time between purchases are computed from the weeks up to t_k as well
+So the last fold equals the single split. Each fold split is materialized once (module_train_test_splitting.materialize_split) and
+memory-mapped read-only by the workers.
+With asof = False all folds are cut from the single split train 0..last_week-1 / test 1..last_week: the aggregates of the training rows
+cover the weeks up to last_week - 1, i.e. the test week of every fold but the last one and the weeks after it. These folds leak the test
+weeks into the training set; the column aggregate_end of the output (last week of the training aggregates) shows it.
+
+Coupon hit rate (see final_notebook): share of the shopper x product pairs that were offered a discount in the test week
+and are among the top 5 coupons per shopper assigned by expected revenue (price x probability under the discounts 15, 20, 25, 30).
+
+Prerequisite:
+* asof = True: the data sets of module_feature_store.load_merged_data
+* asof = False: a feature-engineered train and test set (module_generate_dataset) or the 'train' and 'test' windows of module_feature_store
+
+Layout on disk:
+    path/feature_store/cv_train_<week>, path/feature_store/cv_test_<week> (asof = True)
+"""
+
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import lightgbm as lgbm
+import numpy as np
+import pandas as pd
+from sklearn.metrics import log_loss, roc_auc_score
+
+import module_feature_store
+import module_lags
+from module_candidates import candidate_recall, rank_within_shopper
+from module_dataset_cache import DATASET_PARAMS
+from module_lightgbm import train_lightgbm
+from module_train_test_splitting import FEATURE_COLUMNS, load_split, materialize_split
+from module_profiling import stage
+
+#discounts the coupons are assigned from (module_coupon_assignment.get_test_discounts)
+DISCOUNTS = [15, 20, 25, 30]
+
+
+def _week_rows(week, first, last):
+    """
+    returns the rows of the weeks first, ..., last: a slice if the weeks are sorted (views of a memory map), otherwise a boolean mask
+    """
+    if np.all(week[1:] >= week[:-1]):
+        return slice(int(np.searchsorted(week, first, 'left')), int(np.searchsorted(week, last, 'right')))
+    return (week >= first) & (week <= last)
+
+
+def _fit_fold(directory, test_week, params, n_estimators, early_stopping_rounds):
+    """
+    trains one fold in a worker process and returns its metrics and the probabilities of the test week under DISCOUNTS
+    """
+    start = time.time()
+    sets, schema = load_split(directory)
+    X_train, y_train, week_train = sets['train']
+    X_test, y_test, week_test = sets['test']
+    train_rows = _week_rows(week_train, 0, test_week - 1)
+    test_rows = _week_rows(week_test, test_week, test_week)
+
+    kwargs = {'feature_name': schema['feature_names'], 'categorical_feature': schema['categorical_features'], 'params': DATASET_PARAMS}
+    train = lgbm.Dataset(X_train[train_rows], label = y_train[train_rows], **kwargs).construct()
+    test = lgbm.Dataset(X_test[test_rows], label = y_test[test_rows], reference = train, **kwargs).construct()
+    booster, _ = train_lightgbm({'train': train, 'test': test}, n_estimators = n_estimators, early_stopping_rounds = early_stopping_rounds, **params)
+
+    X = np.array(X_test[test_rows])
+    y = np.asarray(y_test[test_rows])
+    proba = booster.predict(X)
+    #probabilities of the test week under every coupon discount (the discount and the price are the only features that change)
+    discount_col, price_col, max_price_col = [FEATURE_COLUMNS.index(column) for column in ['discount', 'price', 'max_price']]
+    max_price = X[:, max_price_col].copy()
+    discount_proba = np.empty((len(X), len(DISCOUNTS)), dtype = np.float32)
+    for idx, discount in enumerate(DISCOUNTS):
+        X[:, discount_col] = discount
+        X[:, price_col] = max_price * (1 - discount / 100)
+        discount_proba[:, idx] = booster.predict(X)
+
+    metrics = {'test_week': test_week, 'train_rows': len(train.get_label()), 'test_rows': len(y), 'auc': roc_auc_score(y, proba),
+               'binary_logloss': log_loss(y, proba), 'best_iteration': booster.best_iteration or booster.current_iteration(), 'seconds': time.time() - start}
+    return metrics, discount_proba
+
+
+def _fold_stores(path, test_week, no_shoppers, sources):
+    """
+    returns the names of the train and test window of the fold and the FeatureStores that are missing or out of date
+    """
+    names = ('cv_train_%d' % test_week, 'cv_test_%d' % test_week)
+    windows = [(0, test_week - 1), (1, test_week)]
+    stale = []
+    for name, (start, end) in zip(names, windows):
+        store = module_feature_store.FeatureStore(path, name)
+        try:
+            with open(os.path.join(store.directory, 'manifest.json')) as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            manifest = {}
+        if (manifest.get('version') != module_feature_store.FEATURE_STORE_VERSION or manifest.get('sources') != sources
+                or [manifest.get('start'), manifest.get('end')] != [start, end] or manifest.get('no_shoppers', -1) != no_shoppers):
+            stale.append((store, start, end))
+    return names, stale
+
+
+def fold_split(path, test_week, no_shoppers = 2000, merged = None):
+
+    """
+    input:
+        path: path to the data sets of module_feature_store.load_merged_data
+        test_week: test week t of the fold
+        no_shoppers: default = 2000, only shoppers with an id below this value are kept; None = all shoppers
+        merged: default = None (read when a store has to be built), output of module_feature_store.load_merged_data
+    output:
+        directory of the materialized split: train rows of the weeks 0..t-1 with the aggregates of these weeks (cv_train_<t>), test rows
+        of the week t with the aggregates of the weeks 1..t (cv_test_<t>); the stores are only built if they are missing or out of date
+    """
+
+    names, stale = _fold_stores(path, test_week, no_shoppers, module_feature_store.source_fingerprint(path))
+    if stale:
+        print('Building the aggregates of the fold with test week %d' % test_week)
+        data, inputs = merged or module_feature_store.load_merged_data(path, no_shoppers)
+        data = data[data['week'] <= test_week]
+        #only the weeks up to the test week, as for week 89 in the single split (see module_lags)
+        lags = pd.read_parquet(path + '/lags.parquet', columns = ['shopper', 'product', 'week', 'product_bought', 'lag_weeks_of_product_per_customer'])
+        lag_calculator = module_lags.LagCalculator(lags)
+        inputs = dict(inputs, min_price = data[data['product_bought'] == 1].groupby('product')['price'].agg(min).rename('min_price'),
+                      purchase_temporal_distribution = lag_calculator.calculate_purchase_temporal_distribution(lags, max_week = test_week),
+                      avg_no_weeks_between_two_purchases = lag_calculator.calculate_avg_no_weeks_between_two_purchases(lags, max_week = test_week))
+        for store, start, end in stale:
+            store.build(data, inputs, start, end)
+            store.manifest['no_shoppers'] = no_shoppers
+            store.save()
+    return materialize_split(path, 0, test_week - 1, test_week, test_week, feature_store = names)
+
+
+def _test_keys(path, first, last, feature_store):
+    """
+    returns week, shopper, product and discount of the test weeks first, ..., last in the row order of the split
+    """
+    columns = ['week', 'shopper', 'product', 'discount']
+    if feature_store:
+        keys = module_feature_store.FeatureStore(path, 'test' if feature_store is True else feature_store[1]).assemble(columns)
+    else:
+        keys = pd.read_parquet(path + '/test_s2000_final.parquet', columns = columns)
+    return keys[((keys['week'] >= first) & (keys['week'] <= last)).values].reset_index(drop = True)
+
+
+def coupon_hit_rate(keys, discount_proba, max_price, no_coupons = 5):
+
+    """
+    input:
+        keys: DataFrame with shopper, product and discount (offered in the test week) of the scored rows
+        discount_proba: np.ndarray rows x DISCOUNTS with the purchase probabilities under every coupon discount
+        max_price: np.ndarray with the max_price of every row
+        no_coupons: default = 5, coupons per shopper
+    output:
+        share of the offered shopper x product pairs (discount > 0) that are among the assigned coupons
+    """
+
+    #best discount per shopper x product pair and the top coupons per shopper by expected revenue
+    revenue = discount_proba * (max_price[:, None] * (1 - np.array(DISCOUNTS) / 100))
+    best_revenue = revenue.max(axis = 1)
+    rank = rank_within_shopper(keys['shopper'].values, best_revenue, keys['product'].values)
+    coupons = keys.loc[rank < no_coupons, ['shopper', 'product']]
+    offered = keys.loc[keys['discount'].values > 0, ['shopper', 'product']]
+    return candidate_recall(offered, coupons)
+
+
+@stage()
+def rolling_origin_cv(path, n_folds = 5, last_week = 89, n_jobs = None, feature_store = False, n_estimators = 300, early_stopping_rounds = None, asof = True,
+                      no_shoppers = 2000, **params):
+
+    """
+    input:
+        path: path to the feature engineered train and test dataset
+        n_folds: default = 5, number of folds; the folds test the weeks last_week - n_folds + 1, ..., last_week
+        last_week: default = 89, test week of the last fold
+        n_jobs: default = None (min(n_folds, number of cores)), number of worker processes; the cores are split evenly between them
+        feature_store: default = False, asof = False only: whether to take the split from module_feature_store instead of the wide parquet files
+        n_estimators: default = 300, number of boosting iterations
+        early_stopping_rounds: default = None, early stopping on the test week of the fold (off: it would select on the week that is scored)
+        asof: default = True, whether every fold gets its own aggregates (fold_split); False cuts all folds from one split whose training
+              aggregates include the test weeks of the earlier folds (see above)
+        no_shoppers: default = 2000, asof = True only: only shoppers with an id below this value are kept; None = all shoppers
+        params: num_leaves, reg_alpha, reg_lambda, subsample, learning_rate (same defaults as predict_lightgbm) or further lightgbm parameters
+    output:
+        folds: DataFrame with one row per fold: fold, test_week, aggregate_end, train_rows, test_rows, auc, binary_logloss, coupon_hit,
+               best_iteration, seconds
+    """
+
+    start = time.time()
+    first_week = last_week - n_folds + 1
+    test_weeks = list(range(first_week, last_week + 1))
+    if asof:
+        merged = None
+        if any(_fold_stores(path, week, no_shoppers, module_feature_store.source_fingerprint(path))[1] for week in test_weeks):
+            merged = module_feature_store.load_merged_data(path, no_shoppers)
+        directories = [fold_split(path, week, no_shoppers, merged) for week in test_weeks]
+        del merged
+        stores = [('cv_train_%d' % week, 'cv_test_%d' % week) for week in test_weeks]
+        aggregate_end = [week - 1 for week in test_weeks]
+    else:
+        #one split holds all folds: the training weeks of the last fold and the test weeks of all folds
+        directories = [materialize_split(path, 0, last_week - 1, first_week, last_week, feature_store = feature_store)] * n_folds
+        stores = [feature_store] * n_folds
+        aggregate_end = [last_week - 1] * n_folds
+        print('Warning: the training aggregates of all folds cover the weeks up to %d, so the folds with the test weeks %d-%d leak them '
+              '(asof = True builds the aggregates per fold)' % (last_week - 1, first_week, last_week - 1))
+    tests = []
+    for directory, week, store in zip(directories, test_weeks, stores):
+        sets, _ = load_split(directory)
+        rows = _week_rows(np.asarray(sets['test'][2]), week, week)
+        keys = _test_keys(path, week, week, store)
+        assert len(keys) == len(sets['test'][2][rows]) and np.all(keys['week'].values == week)
+        tests.append((keys, np.asarray(sets['test'][0][rows, FEATURE_COLUMNS.index('max_price')])))
+
+    cores = os.cpu_count() or 1
+    n_jobs = n_jobs or min(n_folds, cores)
+    params = dict(params, num_threads = max(1, cores // n_jobs))
+
+    print('Rolling-origin cross-validation: %d folds (test weeks %d-%d), %d worker processes with %d threads each'
+          % (n_folds, first_week, last_week, n_jobs, params['num_threads']))
+
+    results = []
+    with ProcessPoolExecutor(n_jobs) as executor:
+        futures = [executor.submit(_fit_fold, directory, test_week, params, n_estimators, early_stopping_rounds)
+                   for directory, test_week in zip(directories, test_weeks)]
+        for fold, future in enumerate(futures):
+            metrics, discount_proba = future.result()
+            keys, max_price = tests[fold]
+            metrics['coupon_hit'] = coupon_hit_rate(keys, discount_proba, max_price)
+            results.append(dict(fold = fold, aggregate_end = aggregate_end[fold], **metrics))
+            print('Fold %d (week %d): auc = %.5f, binary_logloss = %.5f, coupon_hit = %.4f' % (fold, metrics['test_week'], metrics['auc'],
+                                                                                            metrics['binary_logloss'], metrics['coupon_hit']))
+
+    folds = pd.DataFrame(results)[['fold', 'test_week', 'aggregate_end', 'train_rows', 'test_rows', 'auc', 'binary_logloss', 'coupon_hit', 'best_iteration', 'seconds']]
+
+    print('\nMean (std) over %d folds: auc = %.5f (%.5f), binary_logloss = %.5f (%.5f), coupon_hit = %.4f (%.4f)'
+          % (n_folds, folds['auc'].mean(), folds['auc'].std(), folds['binary_logloss'].mean(), folds['binary_logloss'].std(),
+             folds['coupon_hit'].mean(), folds['coupon_hit'].std()))
+    print('The cross-validation took %.2f minutes.' % ((time.time() - start) / 60))
+
+    return folds
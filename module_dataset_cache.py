@@ -0,0 +1,107 @@
+"""
+The purpose of this module is to:
+* cache the binned LightGBM datasets of a train-test split as LightGBM binary files
+* share them between the splitter (module_train_test_splitting) and the trainer (module_lightgbm.train_lightgbm)
+
+Constructing a lgbm.Dataset from raw arrays bins every feature again. The binary files are keyed by the feature schema, the split weeks,
+the binning parameters and the version of the engineered data, so repeated trials and retrains on the same split skip the construction.
+
+Prerequisite:
+* A feature-engineered train and test set (module_generate_dataset) or the 'train' and 'test' windows of module_feature_store
+
+Layout on disk:
+    <cache_dir>/<key>/train.bin, test.bin, (eval.bin), schema.json
+"""
+
+import hashlib
+import json
+import os
+import lightgbm as lgbm
+
+import module_train_test_splitting
+from module_train_test_splitting import train_test_splitting
+from module_profiling import stage
+
+#parameters that determine the binning of the datasets; feature_pre_filter is switched off so that the trainer may still vary min_data_in_leaf
+DATASET_PARAMS = {
+    'max_bin': 255,
+    'min_data_in_bin': 3,
+    'bin_construct_sample_cnt': 200000,
+    'data_random_seed': 1,
+    'feature_pre_filter': False,
+    'verbose': -1,
+}
+
+#datasets that are already constructed in this process: key -> dict name -> lgbm.Dataset
+_datasets = {}
+
+
+def split_key(path, train_start, train_end, test_start, test_end, eval_set = False, feature_store = False, params = None):
+
+    """
+    input:
+        see load_datasets
+    output:
+        key: hex digest identifying the split (module_train_test_splitting.split_key) and the binning parameters
+    """
+
+    definition = {
+        'split': module_train_test_splitting.split_key(path, train_start, train_end, test_start, test_end, eval_set, feature_store),
+        'params': dict(DATASET_PARAMS, **(params or {})),
+    }
+    return hashlib.sha1(json.dumps(definition, sort_keys = True).encode()).hexdigest()[:16]
+
+
+@stage()
+def load_datasets(path, train_start, train_end, test_start, test_end, eval_set = False, feature_store = False, params = None, cache_dir = None):
+
+    """
+    input:
+        path, train_start, train_end, test_start, test_end, eval_set, feature_store: see module_train_test_splitting.train_test_splitting
+        params: default = None, binning parameters that overwrite DATASET_PARAMS
+        cache_dir: default = None (path/lgbm_cache), directory of the binary files
+    output:
+        datasets: dict 'train', 'test' (and 'eval') -> lgbm.Dataset; the validation sets reference the bins of the training set
+    """
+
+    params = dict(DATASET_PARAMS, **(params or {}))
+    key = split_key(path, train_start, train_end, test_start, test_end, eval_set, feature_store, params)
+    if key in _datasets:
+        return _datasets[key]
+
+    directory = os.path.join(cache_dir or os.path.join(path, 'lgbm_cache'), key)
+    names = ['train', 'test'] + (['eval'] if eval_set else [])
+
+    if all(os.path.exists(os.path.join(directory, name + '.bin')) for name in names):
+        print('Loading the binary datasets from ' + directory)
+        train = lgbm.Dataset(os.path.join(directory, 'train.bin'), params = params).construct()
+        datasets = {'train': train}
+        for name in names[1:]:
+            datasets[name] = lgbm.Dataset(os.path.join(directory, name + '.bin'), reference = train, params = params).construct()
+
+    else:
+        print('Constructing the binary datasets in ' + directory)
+        split = train_test_splitting(path, train_start, train_end, test_start, test_end, eval_set = eval_set, feature_store = feature_store, return_schema = True)
+        if eval_set:
+            X_train, X_test, X_eval, y_train, y_eval, y_test, feature_names, categorical_features = split
+            arrays = {'train': (X_train, y_train), 'test': (X_test, y_test), 'eval': (X_eval, y_eval)}
+        else:
+            X_train, X_test, y_train, y_test, feature_names, categorical_features = split
+            arrays = {'train': (X_train, y_train), 'test': (X_test, y_test)}
+        del split
+
+        os.makedirs(directory, exist_ok = True)
+        X, y = arrays.pop('train')
+        train = lgbm.Dataset(X, label = y, feature_name = feature_names, categorical_feature = categorical_features, params = params).construct()
+        train.save_binary(os.path.join(directory, 'train.bin'))
+        datasets = {'train': train}
+        for name, (X, y) in arrays.items():
+            datasets[name] = lgbm.Dataset(X, label = y, reference = train, feature_name = feature_names, categorical_feature = categorical_features,
+                                          params = params).construct()
+            datasets[name].save_binary(os.path.join(directory, name + '.bin'))
+        with open(os.path.join(directory, 'schema.json'), 'w') as file:
+            json.dump({'feature_names': feature_names, 'categorical_features': categorical_features, 'params': params,
+                       'split': [train_start, train_end, test_start, test_end]}, file, indent = 2)
+
+    _datasets[key] = datasets
+    return datasets
@@ -0,0 +1,189 @@
+"""
+The purpose of this module is to:
+* evaluate any coupon assignment in the coupon_index schema (shopper, week, coupon, product, discount) against the purchases of historical weeks
+* compare many policies over many weeks in one vectorized pass (evaluate_policies) and replay policies that are recomputed per week (replay_policies)
+
+Metrics per policy and week:
+    coupons: number of assigned coupons; shoppers: number of shoppers with a coupon
+    hits: coupons whose product the shopper bought in that week; hit_rate = hits / coupons
+    redeemed_revenue: sum of the regular price x (1 - discount) of the hits (revenue if the coupons had been redeemed)
+    discount_cost: sum of the regular price x discount of the hits
+    offer_overlap: share of the coupons that were actually offered in that week (coupons.parquet) that are among the assigned coupons
+                   (the coupon classification accuracy of the notebook)
+The regular price of a product is its max. price in the baskets (as max_price of the feature engineering).
+All joins are lookups of int64 keys (week, shopper, product) in sorted arrays instead of pandas merges.
+
+Prerequisite:
+* baskets.parquet and coupons.parquet
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from module_profiling import stage
+
+METRICS = ['shoppers', 'coupons', 'hits', 'hit_rate', 'redeemed_revenue', 'discount_cost', 'offer_overlap']
+
+
+def _sorted_unique(keys):
+    """
+    returns the sorted distinct keys
+    """
+    keys = np.sort(keys)
+    return keys[np.r_[True, keys[1:] != keys[:-1]]] if len(keys) else keys
+
+
+def _lookup(sorted_keys, keys):
+    """
+    returns the positions of keys in sorted_keys and a mask whether the key was found
+    """
+    if len(sorted_keys) == 0:
+        return np.zeros(len(keys), dtype = np.int64), np.zeros(len(keys), dtype = bool)
+    position = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return position, sorted_keys[position] == keys
+
+
+class PurchaseHistory:
+
+    """
+    sorted key arrays of the purchases and offered coupons of historical weeks
+    """
+
+    def __init__(self, path_datasets, weeks = None, no_shoppers = 2000):
+
+        """
+        input:
+            path_datasets: path to baskets.parquet and coupons.parquet
+            weeks: default = None (all weeks), weeks whose purchases are kept; the regular prices always use all weeks
+            no_shoppers: default = 2000, only the shoppers 0..no_shoppers-1 are used; None = all shoppers
+        """
+
+        filters = [('shopper', '<', no_shoppers)] if no_shoppers is not None else None
+        baskets = pd.read_parquet(path_datasets + '/baskets.parquet', columns = ['week', 'shopper', 'product', 'price'], filters = filters)
+        coupons = pd.read_parquet(path_datasets + '/coupons.parquet', columns = ['week', 'shopper', 'product', 'discount'], filters = filters)
+        coupons = coupons[coupons['discount'] > 0]
+
+        self.no_products = int(max(baskets['product'].max(), coupons['product'].max())) + 1
+        self.no_shoppers = int(max(baskets['shopper'].max(), coupons['shopper'].max())) + 1
+        self.regular_price = np.zeros(self.no_products)
+        np.maximum.at(self.regular_price, baskets['product'].values, baskets['price'].values.astype(np.float64))
+
+        if weeks is not None:
+            baskets = baskets[baskets['week'].isin(weeks)]
+            coupons = coupons[coupons['week'].isin(weeks)]
+        self.weeks = np.unique(baskets['week'].values) if weeks is None else np.asarray(sorted(weeks))
+        #a product bought twice in the same week is one hit
+        self.purchases = _sorted_unique(self.key(baskets['week'].values, baskets['shopper'].values, baskets['product'].values))
+        self.offered = _sorted_unique(self.key(coupons['week'].values, coupons['shopper'].values, coupons['product'].values))
+        self.offered_week = self.offered // (self.no_shoppers * self.no_products)
+
+    def key(self, week, shopper, product):
+        """
+        returns the int64 key of week x shopper x product; pairs outside of the history get keys that are never found
+        """
+        week, shopper, product = [np.asarray(values).astype(np.int64) for values in [week, shopper, product]]
+        valid = (shopper >= 0) & (shopper < self.no_shoppers) & (product >= 0) & (product < self.no_products)
+        return np.where(valid, (week * self.no_shoppers + shopper) * self.no_products + product, -1)
+
+
+@stage()
+def evaluate_policies(history, policies, weeks = None):
+
+    """
+    input:
+        history: PurchaseHistory
+        policies: dict policy name -> coupons DataFrame in the coupon_index schema (the rows of a week are the coupons of that week); coupons
+                  of shoppers or products the history does not hold count as coupons without hits
+        weeks: default = None (weeks of the history), weeks that are evaluated
+    output:
+        DataFrame with policy, week and METRICS, one row per policy and week
+    """
+
+    weeks = history.weeks if weeks is None else np.asarray(sorted(weeks))
+    names = list(policies)
+    #all coupons of all policies in one set of arrays; group = policy x week
+    week_index = np.full(int(max(weeks.max(), history.weeks.max())) + 1, -1)
+    week_index[weeks] = np.arange(len(weeks))
+    group, key, shopper, discount = [], [], [], []
+    for idx, name in enumerate(names):
+        coupons = policies[name]
+        week = coupons['week'].values.astype(np.int64)
+        in_weeks = (week >= 0) & (week < len(week_index))
+        in_weeks[in_weeks] = week_index[week[in_weeks]] >= 0
+        coupons = coupons[in_weeks]
+        group.append(idx * len(weeks) + week_index[coupons['week'].values.astype(np.int64)])
+        key.append(history.key(coupons['week'].values, coupons['shopper'].values, coupons['product'].values))
+        shopper.append(coupons['shopper'].values.astype(np.int64))
+        discount.append(coupons['discount'].values.astype(np.float64))
+    group, key, shopper, discount = [np.concatenate(values) if values else np.zeros(0, dtype = np.int64) for values in [group, key, shopper, discount]]
+    no_groups = len(names) * len(weeks)
+
+    _, hit = _lookup(history.purchases, key)
+    product = np.where(key >= 0, key % history.no_products, 0)
+    price = history.regular_price[product]
+
+    coupons = np.bincount(group, minlength = no_groups)
+    hits = np.bincount(group, weights = hit, minlength = no_groups)
+    redeemed_revenue = np.bincount(group, weights = hit * price * (1 - discount / 100), minlength = no_groups)
+    discount_cost = np.bincount(group, weights = hit * price * discount / 100, minlength = no_groups)
+    #distinct coupons per policy and week: an offered coupon that a policy assigns twice is matched once; coupons outside of the history
+    #(key -1, e.g. shoppers the history does not hold) are never offered, they only count as coupons and shoppers
+    no_keys = (int(max(weeks.max(), history.weeks.max())) + 1) * history.no_shoppers * history.no_products + 1
+    known = key >= 0
+    distinct = _sorted_unique(group[known] * no_keys + key[known] + 1)
+    _, offered = _lookup(history.offered, distinct % no_keys - 1)
+    matched = np.bincount(distinct // no_keys, weights = offered, minlength = no_groups)
+    offered_week = history.offered_week[np.isin(history.offered_week, weeks)]
+    no_offered = np.bincount(np.searchsorted(weeks, offered_week), minlength = len(weeks))
+    #shoppers with at least one coupon per policy and week; the shopper ids of the policies may exceed the ones of the history
+    no_shopper_keys = int(max(history.no_shoppers, shopper.max() + 1 if len(shopper) else 0))
+    shoppers = np.bincount(_sorted_unique(group * no_shopper_keys + shopper) // no_shopper_keys, minlength = no_groups)
+
+    results = pd.DataFrame({
+        'policy': np.repeat(names, len(weeks)),
+        'week': np.tile(weeks, len(names)),
+        'shoppers': shoppers.astype(np.int64),
+        'coupons': coupons,
+        'hits': hits.astype(np.int64),
+        'hit_rate': hits / np.maximum(coupons, 1),
+        'redeemed_revenue': redeemed_revenue,
+        'discount_cost': discount_cost,
+        'offer_overlap': matched / np.maximum(np.tile(no_offered, len(names)), 1)})
+    return results
+
+
+def summarize(results):
+    """
+    returns the metrics of evaluate_policies summed (counts, revenue, cost) and averaged (rates) over the weeks per policy
+    """
+    summary = results.groupby('policy', sort = False).agg(weeks = ('week', 'count'), shoppers = ('shoppers', 'sum'), coupons = ('coupons', 'sum'),
+                                                          hits = ('hits', 'sum'), redeemed_revenue = ('redeemed_revenue', 'sum'),
+                                                          discount_cost = ('discount_cost', 'sum'), offer_overlap = ('offer_overlap', 'mean'))
+    summary.insert(4, 'hit_rate', summary['hits'] / summary['coupons'].clip(lower = 1))
+    return summary.reset_index()
+
+
+@stage()
+def replay_policies(history, policies, weeks, n_jobs = 4):
+
+    """
+    input:
+        history: PurchaseHistory
+        policies: dict policy name -> function(week) that returns the coupons of that week in the coupon_index schema, using only the
+                  data before the week (e.g. lambda week: fast_heuristic_model(path, week = week, max_week = week - 1))
+        weeks: weeks the policies are replayed for
+        n_jobs: default = 4, number of threads the coupons of the policies and weeks are computed on
+    output:
+        results: output of evaluate_policies for the replayed coupons
+    """
+
+    start = time.time()
+    tasks = [(name, week) for name in policies for week in weeks]
+    with ThreadPoolExecutor(max(1, n_jobs)) as executor:
+        coupons = list(executor.map(lambda task: policies[task[0]](task[1]), tasks))
+    replayed = {name: pd.concat([table.assign(week = week) for (policy, week), table in zip(tasks, coupons) if policy == name], ignore_index = True)
+                for name in policies}
+    results = evaluate_policies(history, replayed, weeks)
+    print('Replayed %d policies over %d weeks in %.2f seconds' % (len(policies), len(weeks), time.time() - start))
+    return results
@@ -0,0 +1,571 @@
+"""
+The purpose of this module is to:
+* persist the engineered features per grain instead of one wide table
+* assemble training, testing and scoring sets from the stored grains at read time
+
+Every row of train_s2000_final.parquet repeats the same shopper-level values (spend_per_customer, mean_basket_size, ...) and
+product-level values (product_sells, max_price, ...). The feature store keeps every grain only once:
+    * events: week x shopper x product (price, discount, target and the row-level flags)
+    * shopper: customer dimension
+    * product: product dimension
+    * shopper_product: customer x product dimension
+    * week_shopper: week x customer dimension
+The wide frame (same 35 columns as module_generate_dataset) is assembled by vectorized index gathers on the integer keys.
+
+Prerequisite:
+* The same datasets as for module_generate_dataset:
+    * download: baskets.parquet, coupons.parquet
+    * create: df_negative_samples.parquet, product_categories.csv, avg_no_weeks_between_two_purchases.parquet, lags.parquet, purchase_temporal_distribution.parquet
+
+Layout on disk:
+    path/feature_store/<name>/manifest.json
+    path/feature_store/<name>/<grain>.parquet
+"""
+
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+from module_profiling import stage
+
+#bump whenever the feature definitions or the layout on disk change -> old stores have to be rebuilt
+FEATURE_STORE_VERSION = 2
+
+#column order of the wide train/test sets written by module_generate_dataset
+TRAIN_COLUMNS = ['week', 'shopper', 'product', 'price', 'discount', 'product_bought', 'category_label', 'avg_no_weeks_between_two_purchases',
+                 'lag_weeks_of_product_per_customer', 'purchase_temporal_distribution', 'discount_offered', 'purchase_w/o_dis', 'no_purchase_w_dis',
+                 'discount_effect', 'max_price', 'min_price', 'no_products_bought', 'spend_per_customer', 'no_unique_products', 'discount_purchase',
+                 'product_sells', 'product_dis_sells', 'product_dis_sells_share', 'no_products_bought_per_product', 'customer_prod_dis_purchases',
+                 'customer_prod_bought_dis_share', 'customer_prod_dis_offers', 'customer_prod_dis_offered_share', 'customer_product_share',
+                 'customer_mean_product_price', 'customer_discount_buy_share', 'week_basket_size', 'week_basket_value', 'mean_basket_size', 'mean_basket_value']
+
+#columns per grain; the keys of a grain are not listed
+GRAINS = {
+    'events': ['price', 'discount', 'product_bought', 'lag_weeks_of_product_per_customer', 'discount_offered', 'purchase_w/o_dis', 'no_purchase_w_dis', 'discount_effect'],
+    'shopper': ['no_products_bought', 'spend_per_customer', 'no_unique_products', 'discount_purchase', 'customer_mean_product_price',
+                'customer_discount_buy_share', 'mean_basket_size', 'mean_basket_value'],
+    'product': ['category_label', 'max_price', 'min_price', 'product_sells', 'product_dis_sells', 'product_dis_sells_share'],
+    'shopper_product': ['avg_no_weeks_between_two_purchases', 'purchase_temporal_distribution', 'no_products_bought_per_product', 'customer_prod_dis_purchases',
+                        'customer_prod_bought_dis_share', 'customer_prod_dis_offers', 'customer_prod_dis_offered_share', 'customer_product_share',
+                        'last_purchase_week'],
+    'week_shopper': ['week_basket_size', 'week_basket_value'],
+}
+GRAIN_KEYS = {
+    'events': ['week', 'shopper', 'product'],
+    'shopper': ['shopper'],
+    'product': ['product'],
+    'shopper_product': ['shopper', 'product'],
+    'week_shopper': ['week', 'shopper'],
+}
+
+#missing values of these columns mean "never bought" and are imputed with -1 (see module_generate_dataset)
+FILL_VALUES = {
+    'avg_no_weeks_between_two_purchases': -1,
+    'purchase_temporal_distribution': -1,
+    'lag_weeks_of_product_per_customer': -1,
+    'no_products_bought_per_product': -1,
+    'customer_prod_dis_purchases': -1,
+    'customer_prod_bought_dis_share': -1,
+    'customer_prod_dis_offered_share': -1,
+    'customer_product_share': -1,
+    'last_purchase_week': -1,
+}
+
+#input files a feature store is derived from; their size and modification time are recorded in the manifest
+SOURCE_FILES = ['baskets.parquet', 'coupons.parquet', 'df_negative_samples.parquet', 'product_categories.csv', 'avg_no_weeks_between_two_purchases.parquet',
+                'lags.parquet', 'purchase_temporal_distribution.parquet']
+
+#key spaces up to this size are gathered through a dense position table instead of a binary search
+_DENSE_LIMIT = 2 ** 26
+
+
+class _GrainIndex:
+    """
+    maps the one or two integer keys of a grain table to row positions
+    """
+
+    def __init__(self, first, second = None):
+        first = np.asarray(first).astype(np.int64)
+        if second is None:
+            self.base = 1
+            keys = first
+        else:
+            second = np.asarray(second).astype(np.int64)
+            self.base = int(second.max()) + 1 if len(second) else 1
+            keys = first * self.base + second
+        self.size = len(keys)
+        self.dense = None
+        self.keys = None
+        if self.size and keys.min() >= 0 and keys.max() < _DENSE_LIMIT:
+            self.dense = np.full(int(keys.max()) + 1, -1, dtype = np.int64)
+            self.dense[keys] = np.arange(self.size)
+        else:
+            order = np.argsort(keys, kind = 'stable')
+            self.keys = keys[order]
+            self.order = order
+
+    def lookup(self, first, second = None):
+        """
+        returns the row positions of the query keys and a mask whether the key was found
+        """
+        first = np.asarray(first).astype(np.int64)
+        if second is None:
+            query = first
+            valid = first >= 0
+        else:
+            second = np.asarray(second).astype(np.int64)
+            query = first * self.base + second
+            valid = (first >= 0) & (second >= 0) & (second < self.base)
+        if self.size == 0:
+            return np.zeros(len(query), dtype = np.int64), np.zeros(len(query), dtype = bool)
+        if self.dense is not None:
+            valid &= query < len(self.dense)
+            pos = self.dense[np.where(valid, query, 0)]
+            found = valid & (pos >= 0)
+            return np.where(found, pos, 0), found
+        pos = np.minimum(np.searchsorted(self.keys, query), self.size - 1)
+        found = valid & (self.keys[pos] == query)
+        return self.order[pos], found
+
+
+def source_fingerprint(path):
+    """
+    returns: dict file -> [size, modification time] of the SOURCE_FILES in path
+    """
+    fingerprint = {}
+    for filename in SOURCE_FILES:
+        stat = os.stat(os.path.join(path, filename))
+        fingerprint[filename] = [stat.st_size, int(stat.st_mtime)]
+    return fingerprint
+
+
+def shopper_shards(path, shard_size, no_shoppers = None):
+    """
+    returns the (first, last) shopper ids of the shards of shard_size ids each up to the largest shopper of baskets.parquet and
+    coupons.parquet (from the row group statistics) or no_shoppers - 1
+    """
+    import pyarrow.parquet as pq
+    last = -1
+    for filename in ['baskets.parquet', 'coupons.parquet']:
+        metadata = pq.ParquetFile(os.path.join(path, filename)).metadata
+        idx = metadata.schema.names.index('shopper')
+        statistics = [metadata.row_group(group).column(idx).statistics for group in range(metadata.num_row_groups)]
+        if all(statistic is not None and statistic.has_min_max for statistic in statistics):
+            last = max([last] + [int(statistic.max) for statistic in statistics])
+        else:
+            last = max(last, int(pd.read_parquet(os.path.join(path, filename), columns = ['shopper'])['shopper'].max()))
+    if no_shoppers is not None:
+        last = min(last, no_shoppers - 1)
+    return [(first, min(first + shard_size, last + 1) - 1) for first in range(0, last + 1, shard_size)]
+
+
+@stage()
+def load_merged_data(path, no_shoppers = 2000, shoppers = None):
+
+    """
+    input:
+        path: path where the raw and the created data sets are stored (see Prerequisite)
+        no_shoppers: default = 2000, only shoppers with an id below this value are kept; None = all shoppers
+        shoppers: default = None (all shoppers), (first, last) shopper ids: only the rows of these shoppers are read from all data sets
+    output:
+        data: merged week x shopper x product frame after 'Feature Engineering Part I' of module_generate_dataset
+        inputs: dict with the shopper x product/product level inputs (avg_no_weeks_between_two_purchases, purchase_temporal_distribution,
+                categories, min_price)
+    """
+
+    'Load Data Sets'
+    filters = [('shopper', '>=', shoppers[0]), ('shopper', '<=', shoppers[1])] if shoppers is not None else None
+    basket_df = pd.read_parquet(path + '/baskets.parquet', filters = filters)
+    coupon_df = pd.read_parquet(path + '/coupons.parquet', filters = filters)
+    negative_sample_df = pd.read_parquet(path + '/df_negative_samples.parquet', filters = filters)
+    categories = pd.read_csv(path + '/product_categories.csv', sep = ',')
+    avg_no_weeks_between_two_purchases = pd.read_parquet(path + '/avg_no_weeks_between_two_purchases.parquet', filters = filters)
+    lags = pd.read_parquet(path + '/lags.parquet', columns = ['shopper', 'product', 'week', 'lag_weeks_of_product_per_customer'], filters = filters)
+    lags = lags[lags['week'] <= 89]
+    purchase_temporal_distribution = pd.read_parquet(path + '/purchase_temporal_distribution.parquet', filters = filters)
+
+    if no_shoppers is not None:
+        basket_df = basket_df[(basket_df['shopper'] < no_shoppers)]
+        coupon_df = coupon_df[(coupon_df['shopper'] < no_shoppers)]
+
+    'Merge Data Sets'
+    data = pd.merge(basket_df, coupon_df, on=['week', 'shopper', 'product'], how='outer')
+    data = pd.merge(data, negative_sample_df, on=['week', 'shopper', 'product'], how='outer')
+    data = pd.merge(data, lags, on=['shopper', 'product', 'week'], how='left')
+
+    'Feature Engineering Part I'
+    data['lag_weeks_of_product_per_customer'] = data['lag_weeks_of_product_per_customer'].replace(np.nan, -1)
+    data['discount'] = data['discount'].replace(np.nan, 0)
+    data['price'] = data['price'].replace(np.nan, 0)
+    data['discount_offered'] = np.where(data['discount'] != 0, 1, 0).astype(np.int8)
+    data['product_bought'] = np.where(data['price'] != 0, 1, 0).astype(np.int8)
+    data['purchase_w/o_dis'] = np.where(((data['product_bought'] == 1) & (data['discount_offered'] == 0)), 1, 0).astype(np.int8)
+    data['no_purchase_w_dis'] = np.where(((data['product_bought'] == 0) & (data['discount_offered'] == 1)), 1, 0).astype(np.int8)
+    data['discount_effect'] = np.where(((data.discount_offered == 1) & (data.product_bought == 1)), 1, 0).astype(np.int8)
+
+    #minimal price of the bought products over all weeks (as in module_generate_dataset)
+    min_price = basket_df.groupby('product')['price'].agg(min).rename('min_price')
+
+    inputs = {
+        'avg_no_weeks_between_two_purchases': avg_no_weeks_between_two_purchases,
+        'purchase_temporal_distribution': purchase_temporal_distribution,
+        'categories': categories,
+        'min_price': min_price,
+    }
+
+    return data, inputs
+
+
+class FeatureStore:
+    """
+    This class builds, persists and reads the grain tables of one feature window (e.g. 'train', 'test', 'week90')
+    """
+
+    def __init__(self, path, name):
+        self.path = path
+        self.directory = os.path.join(path, 'feature_store', name)
+        self.name = name
+        self.manifest = None
+        self.tables = {}
+        self._indexes = {}
+
+    def build(self, data, inputs, start, end):
+        """
+        computes the grain tables of the weeks start..end (inclusive) from the output of load_merged_data
+        """
+        window = data[(data['week'] >= start) & (data['week'] <= end)]
+        bought = window[window['product_bought'] == 1]
+
+        #WEEK X CUSTOMER DIMENSION
+        week_shopper = bought.groupby(['week', 'shopper']).agg(week_basket_size = ('product', 'count'), week_basket_value = ('price', 'sum'))
+
+        #CUSTOMER DIMENSION
+        shopper = bought.groupby('shopper').agg(no_products_bought = ('product', 'count'), spend_per_customer = ('price', 'sum'),
+                                                no_unique_products = ('product', 'nunique'), discount_purchase = ('discount_offered', 'sum'))
+        shopper['customer_mean_product_price'] = shopper['spend_per_customer'] / shopper['no_products_bought']
+        shopper['customer_discount_buy_share'] = shopper['discount_purchase'] / shopper['no_products_bought']
+        #the mean over the bought rows weights every week by its basket size, exactly as the merge in module_generate_dataset
+        tmp = bought[['week', 'shopper']].join(week_shopper, on = ['week', 'shopper'])
+        shopper = shopper.join(tmp.groupby('shopper').agg(mean_basket_size = ('week_basket_size', 'mean'), mean_basket_value = ('week_basket_value', 'mean')))
+
+        #PRODUCT DIMENSION
+        product = window.groupby('product').agg(max_price = ('price', 'max'))
+        product = product.join(inputs['categories'].set_index('product')['category_label'])
+        product = product.join(inputs['min_price'])
+        product = product.join(bought.groupby('product').agg(product_sells = ('price', 'count'), product_dis_sells = ('discount_offered', 'sum')))
+        product['product_dis_sells_share'] = product['product_dis_sells'] / product['product_sells']
+
+        #CUSTOMER X PRODUCT DIMENSION
+        shopper_product = window.groupby(['shopper', 'product']).agg(customer_prod_dis_offers = ('discount_offered', 'count'))
+        shopper_product = shopper_product.join(bought.groupby(['shopper', 'product']).agg(no_products_bought_per_product = ('price', 'count'),
+                                                                                            customer_prod_dis_purchases = ('discount_effect', 'sum'),
+                                                                                            customer_prod_bought_dis_share = ('discount_effect', 'mean')))
+        tmp = window[window['discount_offered'] == 1].groupby(['shopper', 'product'])['product_bought'].agg('mean').rename('customer_prod_dis_offered_share')
+        shopper_product = shopper_product.join(tmp)
+        shopper_product = shopper_product.join(inputs['avg_no_weeks_between_two_purchases'].set_index(['shopper', 'product']))
+        shopper_product = shopper_product.join(inputs['purchase_temporal_distribution'].set_index(['shopper', 'product']))
+        shopper_product['customer_product_share'] = (shopper_product['no_products_bought_per_product']
+                                                     / shopper['no_products_bought'].reindex(shopper_product.index.get_level_values('shopper')).values)
+        #last_purchase_week: needed for the lag of a later target week (see module_week90_generate_dataset.build_scoring_set)
+        shopper_product = shopper_product.join(bought.groupby(['shopper', 'product'])['week'].agg('max').rename('last_purchase_week'))
+
+        #EVENTS: impute the prices of not bought products with the max price minus the offered discount
+        events = window[GRAIN_KEYS['events'] + GRAINS['events']].copy()
+        max_price = product['max_price'].reindex(events['product']).values
+        events['price'] = np.where(events['price'] == 0, max_price * (1 - events['discount'] / 100), events['price'])
+        #shoppers without a purchase in a week are not part of the data sets (see module_generate_dataset)
+        _, found = _GrainIndex(week_shopper.index.get_level_values('week'), week_shopper.index.get_level_values('shopper')).lookup(events['week'].values,
+                                                                                                                                 events['shopper'].values)
+        events = events[found]
+
+        tables = {'events': events, 'shopper': shopper, 'product': product, 'shopper_product': shopper_product, 'week_shopper': week_shopper}
+        for grain, table in tables.items():
+            table = table.reset_index()
+            for column in FILL_VALUES:
+                if column in table.columns:
+                    table[column] = table[column].replace(np.nan, FILL_VALUES[column])
+            table = table.sort_values(by = GRAIN_KEYS[grain]).reset_index(drop = True)
+            tables[grain] = table[GRAIN_KEYS[grain] + GRAINS[grain]]
+
+        'Unit Test Block'
+        assert tables['events'].isna().sum().sum() == 0
+        assert tables['events']['product_bought'].nunique() == 2
+        assert not tables['shopper_product'].duplicated(['shopper', 'product']).any()
+
+        self.tables = tables
+        self._indexes = {}
+        self.manifest = {
+            'version': FEATURE_STORE_VERSION,
+            'name': self.name,
+            'start': int(start),
+            'end': int(end),
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'sources': source_fingerprint(self.path),
+            'rows': {grain: int(len(table)) for grain, table in tables.items()},
+        }
+        return self
+
+    def save(self):
+        """
+        writes every grain to its own parquet file plus a manifest with version, window and row counts
+        """
+        os.makedirs(self.directory, exist_ok = True)
+        for grain, table in self.tables.items():
+            table.to_parquet(os.path.join(self.directory, grain + '.parquet'), index = False)
+        return self.write_manifest()
+
+    def build_in_shards(self, shards, start, end, no_shoppers = 2000, lag_max_week = None):
+        """
+        builds and saves the shopper, product and shopper_product tables of the weeks start..end without holding the data of all shoppers:
+        shards: list of (first, last) shopper ids; every shard is read (load_merged_data with shoppers), aggregated and appended to the
+        shopper grains on disk, the product aggregates are accumulated with bincounts over the shards (min_price: bought rows up to end);
+        lag_max_week: default = None (the files of the data path), the temporal distribution and the average time between purchases are
+        computed from the lags of the weeks before it (module_lags); the product table stays loaded, the shopper grains are read per shard (shard)
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        import module_lags
+
+        os.makedirs(self.directory, exist_ok = True)
+        writers, rows, categories = {}, {'shopper': 0, 'shopper_product': 0}, None
+        #product accumulators, grown to the largest product id
+        accumulators = {'seen': np.zeros(0, dtype = bool), 'max_price': np.zeros(0), 'min_price': np.zeros(0), 'sells': np.zeros(0), 'dis_sells': np.zeros(0)}
+        try:
+            for first, last in shards:
+                data, inputs = load_merged_data(self.path, no_shoppers, shoppers = (first, last))
+                categories = inputs['categories']
+                data = data[data['week'] <= end]
+                if len(data) == 0:
+                    continue
+                if lag_max_week is not None:
+                    lags = pd.read_parquet(self.path + '/lags.parquet', columns = ['shopper', 'product', 'week', 'product_bought', 'lag_weeks_of_product_per_customer'],
+                                           filters = [('shopper', '>=', first), ('shopper', '<=', last)])
+                    lag_calculator = module_lags.LagCalculator(lags)
+                    inputs['purchase_temporal_distribution'] = lag_calculator.calculate_purchase_temporal_distribution(lags, max_week = lag_max_week)
+                    inputs['avg_no_weeks_between_two_purchases'] = lag_calculator.calculate_avg_no_weeks_between_two_purchases(lags, max_week = lag_max_week)
+                bought = data[data['product_bought'] == 1]
+                window = data[data['week'] >= start]
+                window_bought = window[window['product_bought'] == 1]
+
+                size = int(max(data['product'].max() if len(data) else -1, len(accumulators['seen']) - 1)) + 1
+                for name, values in accumulators.items():
+                    fill = {'min_price': np.inf, 'max_price': -np.inf}.get(name, 0)
+                    accumulators[name] = np.concatenate([values, np.full(size - len(values), fill, dtype = values.dtype)])
+                product = window['product'].values.astype(np.int64)
+                accumulators['seen'][product] = True
+                np.maximum.at(accumulators['max_price'], product, window['price'].values)
+                np.minimum.at(accumulators['min_price'], bought['product'].values.astype(np.int64), bought['price'].values)
+                accumulators['sells'] += np.bincount(window_bought['product'].values.astype(np.int64), minlength = size)
+                accumulators['dis_sells'] += np.bincount(window_bought['product'].values.astype(np.int64), weights = window_bought['discount_offered'].values,
+                                                         minlength = size)
+
+                #the shopper grains only depend on the rows of the shopper; the product grain of the shard is replaced below
+                shard = FeatureStore(self.path, self.name).build(data, inputs, start, end)
+                for grain in rows:
+                    rows[grain] += len(shard.tables[grain])
+                    if len(shard.tables[grain]):
+                        table = pa.Table.from_pandas(shard.tables[grain], preserve_index = False)
+                        if grain not in writers:
+                            writers[grain] = pq.ParquetWriter(os.path.join(self.directory, grain + '.parquet.tmp'), table.schema)
+                        writers[grain].write_table(table)
+                del data, inputs, bought, window, window_bought, shard
+        finally:
+            for writer in writers.values():
+                writer.close()
+        for grain in rows:
+            if grain not in writers:
+                pd.DataFrame(columns = GRAIN_KEYS[grain] + GRAINS[grain]).to_parquet(os.path.join(self.directory, grain + '.parquet.tmp'), index = False)
+            os.replace(os.path.join(self.directory, grain + '.parquet.tmp'), os.path.join(self.directory, grain + '.parquet'))
+
+        #PRODUCT DIMENSION (see build): products of the window, sells only of the bought products
+        products = np.flatnonzero(accumulators['seen'])
+        sells = accumulators['sells'][products]
+        product = pd.DataFrame({'product': products, 'max_price': accumulators['max_price'][products]}).set_index('product')
+        product = product.join(categories.set_index('product')['category_label'])
+        min_price = accumulators['min_price'][products]
+        product['min_price'] = np.where(np.isinf(min_price), np.nan, min_price)
+        product['product_sells'] = np.where(sells > 0, sells, np.nan)
+        product['product_dis_sells'] = np.where(sells > 0, accumulators['dis_sells'][products], np.nan)
+        product['product_dis_sells_share'] = product['product_dis_sells'] / product['product_sells']
+        self.tables = {'product': product.reset_index()[GRAIN_KEYS['product'] + GRAINS['product']]}
+        self.tables['product'].to_parquet(os.path.join(self.directory, 'product.parquet'), index = False)
+        self._indexes = {}
+        self.manifest = {
+            'version': FEATURE_STORE_VERSION,
+            'name': self.name,
+            'start': int(start),
+            'end': int(end),
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'sources': source_fingerprint(self.path),
+            'rows': dict(rows, product = int(len(self.tables['product']))),
+            'shards': len(shards),
+        }
+        self.write_manifest()
+        return self
+
+    def write_manifest(self):
+        """
+        writes the manifest (e.g. after further entries were added to it)
+        """
+        with open(os.path.join(self.directory, 'manifest.json'), 'w') as file:
+            json.dump(self.manifest, file, indent = 2)
+        return self
+
+    def load(self, grains = None, shoppers = None):
+        """
+        reads the manifest and the requested grains (default: all) from disk; shoppers: default = None (all shoppers), (first, last) shopper
+        ids whose rows are read from the grains with a shopper key
+        """
+        with open(os.path.join(self.directory, 'manifest.json')) as file:
+            self.manifest = json.load(file)
+        if self.manifest['version'] != FEATURE_STORE_VERSION:
+            raise ValueError('Feature store %s has version %s, expected %s. Please rebuild it with build_feature_store.'
+                             % (self.directory, self.manifest['version'], FEATURE_STORE_VERSION))
+        for grain in (grains or GRAINS):
+            filters = None
+            if shoppers is not None and 'shopper' in GRAIN_KEYS[grain]:
+                filters = [('shopper', '>=', shoppers[0]), ('shopper', '<=', shoppers[1])]
+            self.tables[grain] = pd.read_parquet(os.path.join(self.directory, grain + '.parquet'), filters = filters)
+        self._indexes = {}
+        return self
+
+    def shard(self, first, last):
+        """
+        returns a FeatureStore with the shopper and shopper_product rows of the shoppers first..last and the product table of this store
+        """
+        store = FeatureStore(self.path, self.name).load(grains = ['shopper', 'shopper_product'], shoppers = (first, last))
+        if 'product' not in self.tables:
+            self.load(grains = ['product'])
+        store.tables['product'] = self.tables['product']
+        return store
+
+    def _index(self, grain):
+        if grain not in self._indexes:
+            table = self.tables[grain]
+            self._indexes[grain] = _GrainIndex(*[table[key].values for key in GRAIN_KEYS[grain]])
+        return self._indexes[grain]
+
+    def gather(self, week, shopper, product, columns, out = None):
+        """
+        input:
+            week, shopper, product: np.ndarrays of equal length with the keys of the requested rows
+            columns: names of the grain columns (except events) that should be gathered
+            out: default = None, dict column -> preallocated np.ndarray (e.g. a row of a feature matrix) the values are written into
+        output:
+            dict column -> np.ndarray aligned with the keys; missing keys are imputed with FILL_VALUES or NaN
+        """
+        queries = {
+            'shopper': (shopper,),
+            'product': (product,),
+            'shopper_product': (shopper, product),
+            'week_shopper': (week, shopper),
+        }
+        out = out or {}
+        output = {}
+        positions = {}
+        for column in columns:
+            grain = next(grain for grain in queries if column in GRAINS[grain])
+            if grain not in self.tables:
+                self.load(grains = [grain])
+            if grain not in positions:
+                positions[grain] = self._index(grain).lookup(*queries[grain])
+            pos, found = positions[grain]
+            values = self.tables[grain][column].values
+            complete = found.all()
+            target = out.get(column)
+            if target is None:
+                target = np.empty(len(pos), dtype = values.dtype if complete else np.float64)
+            if len(values):
+                #the grain tables are small, so casting them before the take is cheap and the take writes straight into the target
+                np.take(values.astype(target.dtype, copy = False), pos, out = target, mode = 'clip')
+            if not complete:
+                target[~found] = FILL_VALUES.get(column, np.nan)
+            output[column] = target
+        return output
+
+    def assemble(self, columns = None):
+        """
+        input:
+            columns: default = None (all 35 columns of module_generate_dataset), subset of TRAIN_COLUMNS to assemble
+        output:
+            wide week x shopper x product frame sorted by week, shopper and product
+        """
+        columns = list(columns or TRAIN_COLUMNS)
+        if 'events' not in self.tables:
+            self.load(grains = ['events'])
+        events = self.tables['events']
+        keys = [column for column in columns if column in GRAIN_KEYS['events']]
+        features = [column for column in columns if column not in keys]
+        #all features are written into one float64 block; building the frame from many single columns would copy them again on consolidation
+        block = np.empty((len(features), len(events)), dtype = np.float64)
+        out = {}
+        for row, column in enumerate(features):
+            if column in events.columns:
+                block[row] = events[column].values
+            else:
+                out[column] = block[row]
+        self.gather(events['week'].values, events['shopper'].values, events['product'].values, list(out), out = out)
+        output = pd.concat([events[keys].reset_index(drop = True), pd.DataFrame(block.T, columns = features, copy = False)], axis = 1, copy = False)
+        if list(output.columns) != columns:
+            output = output[columns]
+        return output
+
+
+    def matrix(self, columns, start = None, end = None, dtype = np.float32):
+        """
+        input:
+            columns: subset of TRAIN_COLUMNS (numerical), e.g. module_train_test_splitting.FEATURE_COLUMNS
+            start: default = None, first week of the rows (inclusive)
+            end: default = None, last week of the rows (inclusive)
+            dtype: default = np.float32
+        output:
+            C-contiguous np.ndarray rows x columns; every column is gathered straight into the matrix
+        """
+        if 'events' not in self.tables:
+            self.load(grains = ['events'])
+        events = self.tables['events']
+        week = events['week'].values
+        mask = np.ones(len(events), dtype = bool)
+        if start is not None:
+            mask &= week >= start
+        if end is not None:
+            mask &= week <= end
+        keys = {key: events[key].values[mask] for key in GRAIN_KEYS['events']}
+        matrix = np.empty((int(mask.sum()), len(columns)), dtype = dtype)
+        out = {}
+        for idx, column in enumerate(columns):
+            if column in events.columns:
+                matrix[:, idx] = events[column].values[mask]
+            else:
+                out[column] = matrix[:, idx]
+        self.gather(keys['week'], keys['shopper'], keys['product'], list(out), out = out)
+        return matrix
+
+
+@stage()
+def build_feature_store(path, windows = None, no_shoppers = 2000):
+
+    """
+    input:
+        path: path where the data sets are stored -> the grain tables are saved to path/feature_store/<name>
+        windows: default = None, dict name -> (first week, last week); by default the windows of the final notebook:
+                 train (0, 88), test (1, 89) and week90 (0, 89) whose aggregates are reused by module_week90_generate_dataset
+        no_shoppers: default = 2000, only shoppers with an id below this value are kept
+    output:
+        stores: dict name -> FeatureStore
+    """
+
+    windows = windows or {'train': (0, 88), 'test': (1, 89), 'week90': (0, 89)}
+
+    start = time.time()
+    data, inputs = load_merged_data(path, no_shoppers)
+
+    stores = {}
+    for name, (first_week, last_week) in windows.items():
+        stores[name] = FeatureStore(path, name).build(data, inputs, first_week, last_week).save()
+        print('Feature store %s (weeks %d-%d) saved: %s' % (name, first_week, last_week, stores[name].manifest['rows']))
+
+    print('\nThe computation took %.2f minutes.' % ((time.time() - start) / 60))
+
+    return stores
@@ -38,7 +38,9 @@ Prerequisite:
 
 import pandas as pd
 import numpy as np
+from module_profiling import stage
 
+@stage()
 def generate_dataset(path, train_start, train_end, test_start, test_end):
     
     """
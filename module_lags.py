@@ -8,6 +8,7 @@ The purpose of this module is to:
 
 import numpy as np
 import pandas as pd
+from module_profiling import stage
 
 class LagCalculator:
     """
@@ -16,11 +17,13 @@ class LagCalculator:
     def __init__(self, input_dataframe):
         self.tmp_df_for_lags = input_dataframe
 
+    @stage(rows_in=lambda self: len(self.tmp_df_for_lags))
     def calculate_lags(self):
         """
         returns: lags between two purchases (= number of weeks since last purchase)
         """
         self.tmp_df_for_lags["lag_weeks_of_product_per_customer"] = -1
+        lag_column = self.tmp_df_for_lags.columns.get_loc("lag_weeks_of_product_per_customer")
 
         current_product = -1
         current_shopper = -1
@@ -53,26 +56,27 @@ class LagCalculator:
                     continue
             if row["product_bought"] == 1:
                 if has_been_bought_already:
-                    self.tmp_df_for_lags["lag_weeks_of_product_per_customer"].iloc[
-                        row_idx
-                    ] = (row["week"] - last_purchase_week)
+                    self.tmp_df_for_lags.iloc[row_idx, lag_column] = (
+                        row["week"] - last_purchase_week
+                    )
                     last_purchase_week = row["week"]
                 else:
                     has_been_bought_already = True
                     last_purchase_week = row["week"]
             else:
                 if has_been_bought_already:
-                    self.tmp_df_for_lags["lag_weeks_of_product_per_customer"].iloc[
-                        row_idx
-                    ] = (row["week"] - last_purchase_week)
+                    self.tmp_df_for_lags.iloc[row_idx, lag_column] = (
+                        row["week"] - last_purchase_week
+                    )
         return self.tmp_df_for_lags
 
-    def calculate_purchase_temporal_distribution(self, lags):
+    @stage()
+    def calculate_purchase_temporal_distribution(self, lags, max_week=89):
         """
-        returns: temporal distribution of purchases
+        returns: temporal distribution of purchases before max_week
         """
         self.purchase_temporal_distribution = (
-            lags[(lags["week"] < 89) & (lags["product_bought"] == 1)][
+            lags[(lags["week"] < max_week) & (lags["product_bought"] == 1)][
                 ["shopper", "product", "week"]
             ]
             .groupby(by=["shopper", "product"])
@@ -88,12 +92,13 @@ class LagCalculator:
         )
         return self.purchase_temporal_distribution
 
-    def calculate_avg_no_weeks_between_two_purchases(self, lags):
+    @stage()
+    def calculate_avg_no_weeks_between_two_purchases(self, lags, max_week=89):
         """
-        returns: average number of weeks between two purchases
+        returns: average number of weeks between two purchases before max_week
         """
         self.avg_no_weeks_between_two_purchases = (
-            lags[(lags["week"] < 89) & (lags["product_bought"] == 1)][
+            lags[(lags["week"] < max_week) & (lags["product_bought"] == 1)][
                 ["shopper", "product", "lag_weeks_of_product_per_customer"]
             ]
             .groupby(by=["shopper", "product"])
@@ -1,12 +1,19 @@
 """
 The purpose of this module is to:
     * generate and evaluate predictions for each shopper to buy a certain product in week89 with a lightGBM
+    * train the same model on prepared lgbm.Datasets (train_lightgbm), e.g. from the binary cache of module_dataset_cache
+    * run headless (no plots, no prints) and write a JSON run record with the evaluation curves, timing and memory of the training
 
 Prerequisite: 
     * A least a X_train, X_test, y_train, y_test as np.arrays have to be generated, e.g. via module_train_test_splitting
+    * or: lgbm.Datasets, e.g. via module_dataset_cache.load_datasets
 """
 
 #load libraries
+import datetime
+import inspect
+import json
+import os
 import time
 import lightgbm as lgbm
 import matplotlib.pyplot as plt
@@ -16,8 +23,10 @@ import pickle
 from sklearn.metrics import confusion_matrix
 from sklearn.metrics import roc_auc_score
 from sklearn.metrics import log_loss
+from module_profiling import _memory_mb, _reset_peak_rss, stage
 
-def predict_lightgbm(X_train, X_test, y_train, y_test, X_eval = None, y_eval = None, eval_set = False, output_probabilities = True, n_estimators = 300, early_stopping_rounds = 50, num_leaves = 1000, reg_alpha = 0, reg_lambda = 0.5, subsample = 0.5, learning_rate = 0.01, verbose = 200):
+@stage()
+def predict_lightgbm(X_train, X_test, y_train, y_test, X_eval = None, y_eval = None, eval_set = False, output_probabilities = True, n_estimators = 300, early_stopping_rounds = 50, num_leaves = 1000, reg_alpha = 0, reg_lambda = 0.5, subsample = 0.5, learning_rate = 0.01, verbose = 200, feature_names = None, categorical_features = None, headless = False, run_record = None, model_file = 'lightgbm_model_final.pkl'):
     
     """
     input: 
@@ -36,67 +45,81 @@ def predict_lightgbm(X_train, X_test, y_train, y_test, X_eval = None, y_eval = N
         reg_lambda: default = 0.5, L2 regularisation, L2 >= 0, reduces overfitting
         subsample: default = 0.5, randomly selects part of the data without resampling, 0 < subsample <= 1, reduces overfitting and speeds up training
         learning_rate: default = 0.01, shrinkage rate, learning_rate > 0
+        feature_names: default = None, list of feature names of the columns (e.g. from module_train_test_splitting with return_schema = True)
+        categorical_features: default = None, indices of the categorical columns (e.g. from module_train_test_splitting with return_schema = True)
+        headless: default = False, whether to skip the plots and the printed results (e.g. for batch jobs); the results go to the run record
+        run_record: default = None ('lightgbm_run_record.json' in headless mode, otherwise no record), path of the JSON run record (see write_run_record)
+        model_file: default = 'lightgbm_model_final.pkl', path the model is pickled to (None = not saved)
         -> lightgbm parameters (source: https://lightgbm.readthedocs.io/en/latest/Parameters.html):
     
     output: 
         model
-        plot that shows evaluation results over time (metrics: auc, logloss)
+        plot that shows evaluation results over time (metrics: auc, logloss), unless headless
         for binary results: confusion matrix
         for probabilities results: confusion matrix, auc, binary logloss
     
-    save: lightGBM model, outputted predictions (either in binary format or in form of probabilities dependung on set parameters)
+    save: lightGBM model (model_file), run record (run_record)
     
     """
-    assert type(X_train) == np.ndarray
-    assert type(X_test) == np.ndarray
-    assert type(y_train) == np.ndarray
-    assert type(y_test) == np.ndarray
+    #np.memmap (train_test_splitting with mmap = True) is a subclass of np.ndarray
+    assert isinstance(X_train, np.ndarray)
+    assert isinstance(X_test, np.ndarray)
+    assert isinstance(y_train, np.ndarray)
+    assert isinstance(y_test, np.ndarray)
+    
+    #'auto' keeps the LightGBM defaults (generic column names, no categorical features for np.ndarrays)
+    feature_name = feature_names if feature_names is not None else 'auto'
+    categorical_feature = categorical_features if categorical_features is not None else 'auto'
+    if headless:
+        verbose = False
+        run_record = run_record or 'lightgbm_run_record.json'
     
     if eval_set:
         
+        peak_reset = _reset_peak_rss()
         start = time.time()
     
         model = lgbm.LGBMClassifier(objective = 'binary', num_leaves = num_leaves, reg_alpha = reg_alpha, reg_lambda = reg_lambda, subsample = subsample, learning_rate = learning_rate, n_estimators = n_estimators, metric = ['auc', 'logloss'], random_state = 42) 
-        model.fit(X_train, y_train, verbose = verbose, eval_set = [(X_train, y_train), (X_eval, y_eval), (X_test, y_test)], early_stopping_rounds = early_stopping_rounds, eval_metric = ['auc', 'logloss'])
+        model.fit(X_train, y_train, verbose = verbose, eval_set = [(X_train, y_train), (X_eval, y_eval), (X_test, y_test)], early_stopping_rounds = early_stopping_rounds, eval_metric = ['auc', 'logloss'], feature_name = feature_name, categorical_feature = categorical_feature)
 
-        print(model.best_score_)
-    
         end = time.time()
-        print('\nThe computation took %.2f minutes.'%((end - start)/60))
+        peak_rss_mb = _memory_mb('VmHWM') if peak_reset else None
+        if not headless:
+            print(model.best_score_)
+            print('\nThe computation took %.2f minutes.'%((end - start)/60))
     
         #show train, eval and test set over time
         model.evals_result_['evaluation'] = model.evals_result_.pop('valid_1')
         model.evals_result_['testing'] = model.evals_result_.pop('valid_2')
-        lgbm.plot_metric(model.evals_result_, metric = 'auc')
-        lgbm.plot_metric(model.evals_result_, metric = 'binary_logloss')
-        plt.show()
-    
-        #save the model
-        filename = 'lightgbm_model_final.pkl'
-        with open(filename, 'wb') as file:
-            pickle.dump(model, file)
+        if not headless:
+            lgbm.plot_metric(model.evals_result_, metric = 'auc')
+            lgbm.plot_metric(model.evals_result_, metric = 'binary_logloss')
+            plt.show()
     
     else:
         
+        peak_reset = _reset_peak_rss()
         start = time.time()
     
         model = lgbm.LGBMClassifier(objective = 'binary', num_leaves = num_leaves, reg_alpha = reg_alpha, reg_lambda = reg_lambda, subsample = subsample, learning_rate = learning_rate, n_estimators = n_estimators, metric = ['auc', 'logloss'], random_state = 42) 
-        model.fit(X_train, y_train, verbose = verbose, eval_set = [(X_train, y_train), (X_test, y_test)], early_stopping_rounds = early_stopping_rounds, eval_metric = ['auc', 'logloss'])
+        model.fit(X_train, y_train, verbose = verbose, eval_set = [(X_train, y_train), (X_test, y_test)], early_stopping_rounds = early_stopping_rounds, eval_metric = ['auc', 'logloss'], feature_name = feature_name, categorical_feature = categorical_feature)
 
-        print(model.best_score_)
-    
         end = time.time()
-        print('\nThe computation took %.2f minutes.'%((end - start)/60))
+        peak_rss_mb = _memory_mb('VmHWM') if peak_reset else None
+        if not headless:
+            print(model.best_score_)
+            print('\nThe computation took %.2f minutes.'%((end - start)/60))
     
         #show train and test set over time
         model.evals_result_['testing'] = model.evals_result_.pop('valid_1')
-        lgbm.plot_metric(model.evals_result_, metric = 'auc')
-        lgbm.plot_metric(model.evals_result_, metric = 'binary_logloss')
-        plt.show()
-        
-        #save the model
-        filename = 'lightgbm_model_final.pkl'
-        with open(filename, 'wb') as file:
+        if not headless:
+            lgbm.plot_metric(model.evals_result_, metric = 'auc')
+            lgbm.plot_metric(model.evals_result_, metric = 'binary_logloss')
+            plt.show()
+    
+    #save the model
+    if model_file:
+        with open(model_file, 'wb') as file:
             pickle.dump(model, file)
         
     if output_probabilities:
@@ -114,9 +137,12 @@ def predict_lightgbm(X_train, X_test, y_train, y_test, X_eval = None, y_eval = N
         #binary logloss
         binary_log_loss = log_loss(y_test, y_pred)
         
-        print('Confusion Matrix: \n', confusion_mat)
-        print('The AUC score is: ', auc)
-        print('The Binary_Log_Loss is: ', binary_log_loss)
+        metrics = {'auc': auc, 'binary_logloss': binary_log_loss, 'confusion_matrix': confusion_mat.tolist()}
+        
+        if not headless:
+            print('Confusion Matrix: \n', confusion_mat)
+            print('The AUC score is: ', auc)
+            print('The Binary_Log_Loss is: ', binary_log_loss)
         
     else:
         
@@ -124,8 +150,117 @@ def predict_lightgbm(X_train, X_test, y_train, y_test, X_eval = None, y_eval = N
         
         #confusion matrix
         confusion_mat = confusion_matrix(y_test, y_pred)
+        metrics = {'confusion_matrix': confusion_mat.tolist()}
         
-        print('Confusion Matrix: ', confusion_mat)
+        if not headless:
+            print('Confusion Matrix: ', confusion_mat)
+    
+    if run_record:
+        write_run_record(run_record, model.evals_result_, model.best_iteration_ or n_estimators, end - start, len(X_train),
+                         lightgbm_params(num_leaves, reg_alpha, reg_lambda, subsample, learning_rate, n_estimators = n_estimators), metrics, peak_rss_mb)
      
     
-    return model
\ No newline at end of file
+    return model
+
+
+def write_run_record(filename, evals_result, best_iteration, seconds, training_rows, params, metrics = None, peak_rss_mb = None):
+    
+    """
+    input: 
+        filename: path of the JSON run record
+        evals_result: dict set name -> metric -> list of values per iteration (e.g. LGBMClassifier.evals_result_ or output of train_lightgbm)
+        best_iteration: best boosting iteration
+        seconds: wall time of the training
+        training_rows: number of training observations
+        params: lightgbm parameters of the training
+        metrics: default = None, further results (e.g. auc, binary_logloss and confusion matrix on the testing set)
+        peak_rss_mb: default = None, peak resident set size of the process during the training in MB (VmHWM after module_profiling._reset_peak_rss
+                     before the training, None where the peak cannot be reset)
+    output: 
+        record: dict that is written to filename (created, lightgbm_version, params, best_iteration, best_score, wall_time_seconds,
+                training_rows, rows_per_second, peak_rss_mb, metrics, evals_result)
+    """
+    
+    curves = {name: {metric: [float(value) for value in values] for metric, values in results.items()} for name, results in evals_result.items()}
+    record = {
+        'created': datetime.datetime.now().isoformat(timespec = 'seconds'),
+        'lightgbm_version': lgbm.__version__,
+        'params': params,
+        'best_iteration': int(best_iteration),
+        'best_score': {name: {metric: values[int(best_iteration) - 1] for metric, values in results.items()} for name, results in curves.items()},
+        'wall_time_seconds': seconds,
+        'training_rows': int(training_rows),
+        'rows_per_second': training_rows / seconds if seconds > 0 else None,
+        'peak_rss_mb': peak_rss_mb,
+        'metrics': metrics or {},
+        'evals_result': curves,
+    }
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok = True)
+    with open(filename, 'w') as file:
+        json.dump(record, file, indent = 2, default = float)
+    
+    return record
+
+
+def lightgbm_params(num_leaves = 1000, reg_alpha = 0, reg_lambda = 0.5, subsample = 0.5, learning_rate = 0.01, **params):
+    
+    """
+    returns the booster parameters of the LGBMClassifier in predict_lightgbm (further lightgbm parameters can be passed as keywords)
+    """
+    
+    booster_params = {'objective': 'binary', 'num_leaves': num_leaves, 'reg_alpha': reg_alpha, 'reg_lambda': reg_lambda, 'subsample': subsample,
+                      'learning_rate': learning_rate, 'metric': ['auc', 'binary_logloss'], 'random_state': 42, 'verbose': -1}
+    booster_params.update(params)
+    return booster_params
+
+
+@stage()
+def train_lightgbm(datasets, n_estimators = 300, early_stopping_rounds = 50, callbacks = None, run_record = None, **params):
+    
+    """
+    input: 
+        datasets: dict 'train', 'test' (and optional 'eval') -> lgbm.Dataset, e.g. from module_dataset_cache.load_datasets; a constructed
+                  dataset is reused as is, so repeated trials on the same split skip the binning
+        n_estimators: default = 300, number of boosting iterations
+        early_stopping_rounds: default = 50, stops training if one metric does not improve for the given early_stopping_rounds (None = off)
+        callbacks: default = None, further lightgbm callbacks
+        run_record: default = None, path of a JSON run record (see write_run_record)
+        params: num_leaves, reg_alpha, reg_lambda, subsample, learning_rate (same defaults as predict_lightgbm) or further lightgbm parameters
+    
+    output: 
+        booster: trained lgbm.Booster
+        evals_result: dict set name ('training', 'evaluation', 'testing') -> metric -> list of values per iteration
+    
+    """
+    
+    valid_names = ['training'] + (['evaluation'] if 'eval' in datasets else []) + ['testing']
+    valid_sets = [datasets['train']] + ([datasets['eval']] if 'eval' in datasets else []) + [datasets['test']]
+    
+    evals_result = {}
+    callbacks = list(callbacks or []) + [lgbm.record_evaluation(evals_result)]
+    if early_stopping_rounds:
+        callbacks.append(lgbm.early_stopping(early_stopping_rounds, verbose = False))
+    
+    kwargs = {}
+    signature = inspect.signature(lgbm.train).parameters
+    #lightgbm < 4 prints every iteration unless verbose_eval is switched off and would try to reset the schema of the constructed dataset
+    if 'verbose_eval' in signature:
+        kwargs['verbose_eval'] = False
+    if 'categorical_feature' in signature:
+        kwargs['feature_name'] = datasets['train'].feature_name
+        kwargs['categorical_feature'] = datasets['train'].categorical_feature
+    
+    peak_reset = _reset_peak_rss()
+    start = time.time()
+    booster = lgbm.train(lightgbm_params(**params), datasets['train'], num_boost_round = n_estimators, valid_sets = valid_sets,
+                         valid_names = valid_names, callbacks = callbacks, **kwargs)
+    seconds = time.time() - start
+    peak_rss_mb = _memory_mb('VmHWM') if peak_reset else None
+    
+    if run_record:
+        write_run_record(run_record, evals_result, booster.best_iteration or booster.current_iteration(), seconds,
+                         datasets['train'].num_data(), dict(lightgbm_params(**params), n_estimators = n_estimators), peak_rss_mb = peak_rss_mb)
+    
+    return booster, evals_result
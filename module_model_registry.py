@@ -0,0 +1,160 @@
+"""
+The purpose of this module is to:
+* store trained lightGBM models without pickle: the native LightGBM model text together with the feature schema, training metadata and a content hash
+* load a stored model straight into a lgbm.Booster (no sklearn wrapper) and keep it in an in-process cache for repeated scoring
+
+A pickled LGBMClassifier (module_coupon_assignment.load_model) needs the sklearn wrapper of the same library versions; the native text
+format is read by every LightGBM version. The version of a model is the hash of its model text, so registering the same model twice is a no-op.
+
+Prerequisite:
+* A trained model, e.g. from module_lightgbm.predict_lightgbm (LGBMClassifier) or module_lightgbm.train_lightgbm (lgbm.Booster)
+
+Layout on disk:
+    <registry>/<name>/<version>/model.txt, meta.json
+    <registry>/<name>/latest (version of the last registered model)
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import time
+import lightgbm as lgbm
+import numpy as np
+import pandas as pd
+
+#models that are already loaded in this process: (directory, name, version) -> (booster, meta)
+_models = {}
+
+
+def _registry(path, registry):
+    return registry or os.path.join(path, 'model_registry')
+
+
+def register_model(path, model, name = 'lightgbm', feature_names = None, categorical_features = None, metadata = None, registry = None):
+
+    """
+    input:
+        path: path to the data sets; the registry is stored in path/model_registry
+        model: trained LGBMClassifier or lgbm.Booster
+        name: default = 'lightgbm', name of the model in the registry
+        feature_names: default = None (feature names of the booster), feature names of the columns (e.g. module_train_test_splitting.FEATURE_COLUMNS)
+        categorical_features: default = None (none), indices of the categorical columns
+        metadata: default = None, further training metadata (e.g. parameters, metrics or the run record of module_lightgbm)
+        registry: default = None (path/model_registry), directory of the registry
+    output:
+        version: content hash of the model text; the model is marked as the latest version of name
+    """
+
+    booster = model.booster_ if hasattr(model, 'booster_') else model
+    model_text = booster.model_to_string()
+    sha256 = hashlib.sha256(model_text.encode()).hexdigest()
+    version = sha256[:16]
+    feature_names = list(feature_names) if feature_names is not None else booster.feature_name()
+    assert len(feature_names) == booster.num_feature()
+
+    directory = os.path.join(_registry(path, registry), name)
+    if not os.path.exists(os.path.join(directory, version, 'meta.json')):
+        meta = {
+            'name': name,
+            'version': version,
+            'sha256': sha256,
+            'created': datetime.datetime.now().isoformat(timespec = 'seconds'),
+            'lightgbm_version': lgbm.__version__,
+            'feature_names': feature_names,
+            'categorical_features': [int(idx) for idx in (categorical_features or [])],
+            'num_trees': booster.num_trees(),
+            'best_iteration': booster.best_iteration,
+            'metadata': metadata or {},
+        }
+        #written to a temporary directory first, so that a concurrent reader never sees a partial model
+        tmp_directory = os.path.join(directory, version + '.tmp%d' % os.getpid())
+        os.makedirs(tmp_directory, exist_ok = True)
+        with open(os.path.join(tmp_directory, 'model.txt'), 'w') as file:
+            file.write(model_text)
+        with open(os.path.join(tmp_directory, 'meta.json'), 'w') as file:
+            json.dump(meta, file, indent = 2, default = float)
+        try:
+            os.rename(tmp_directory, os.path.join(directory, version))
+        except OSError:
+            #another process registered the same model in the meantime
+            shutil.rmtree(tmp_directory)
+
+    with open(os.path.join(directory, 'latest.tmp%d' % os.getpid()), 'w') as file:
+        file.write(version)
+    os.replace(os.path.join(directory, 'latest.tmp%d' % os.getpid()), os.path.join(directory, 'latest'))
+
+    print('Registered model %s version %s in %s' % (name, version, directory))
+
+    return version
+
+
+def load_model(path, name = 'lightgbm', version = 'latest', registry = None, verify = True):
+
+    """
+    input:
+        path: path to the data sets; the registry is stored in path/model_registry
+        name: default = 'lightgbm', name of the model in the registry
+        version: default = 'latest', version (content hash) of the model
+        registry: default = None (path/model_registry), directory of the registry
+        verify: default = True, whether to check the content hash of the model text
+    output:
+        booster: lgbm.Booster (warmed up with one prediction); repeated calls return the cached booster
+        meta: dict with name, version, sha256, feature_names, categorical_features, num_trees, best_iteration and metadata
+    """
+
+    directory = os.path.join(_registry(path, registry), name)
+    if version == 'latest':
+        with open(os.path.join(directory, 'latest')) as file:
+            version = file.read().strip()
+    key = (os.path.abspath(directory), name, version)
+    if key in _models:
+        return _models[key]
+
+    start = time.time()
+    with open(os.path.join(directory, version, 'meta.json')) as file:
+        meta = json.load(file)
+    with open(os.path.join(directory, version, 'model.txt')) as file:
+        model_text = file.read()
+    if verify and hashlib.sha256(model_text.encode()).hexdigest() != meta['sha256']:
+        raise ValueError('The model text of %s version %s does not match its content hash' % (name, version))
+
+    booster = lgbm.Booster(model_str = model_text)
+    assert booster.num_feature() == len(meta['feature_names'])
+    #the first prediction allocates the prediction buffers of the booster
+    booster.predict(np.zeros((1, booster.num_feature())))
+
+    print('Loaded model %s version %s in %.1f ms' % (name, version, 1000 * (time.time() - start)))
+
+    _models[key] = (booster, meta)
+    return booster, meta
+
+
+def list_models(path, name = 'lightgbm', registry = None):
+
+    """
+    input:
+        path: path to the data sets; the registry is stored in path/model_registry
+        name: default = 'lightgbm', name of the model in the registry
+        registry: default = None (path/model_registry), directory of the registry
+    output:
+        DataFrame with version, created, lightgbm_version, num_trees, best_iteration and latest per registered model, sorted by creation
+    """
+
+    directory = os.path.join(_registry(path, registry), name)
+    latest = None
+    if os.path.exists(os.path.join(directory, 'latest')):
+        with open(os.path.join(directory, 'latest')) as file:
+            latest = file.read().strip()
+
+    models = []
+    for version in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+        if os.path.exists(os.path.join(directory, version, 'meta.json')):
+            with open(os.path.join(directory, version, 'meta.json')) as file:
+                meta = json.load(file)
+            models.append({column: meta[column] for column in ['version', 'created', 'lightgbm_version', 'num_trees', 'best_iteration']})
+            models[-1]['latest'] = version == latest
+
+    columns = ['version', 'created', 'lightgbm_version', 'num_trees', 'best_iteration', 'latest']
+    return pd.DataFrame(models, columns = columns).sort_values('created').reset_index(drop = True)
@@ -7,6 +7,7 @@ from scipy.sparse import csr_matrix
 import numpy as np
 import pandas as pd
 import random
+from module_profiling import stage
 
 class NegativeSampleGenerator():
     
@@ -16,6 +17,7 @@ class NegativeSampleGenerator():
         self.total_frequency = csr_matrix((self.no_customers, self.no_products), dtype=np.int8).toarray()
         self.baskets = baskets
         
+    @stage(rows_in=lambda self: len(self.baskets))
     def calculate_frequencies(self):
         """
         calculates the total frequencies of product purchases per shopper
@@ -42,6 +44,7 @@ class NegativeSampleGenerator():
     def get_total_frequency_only89(self):
         return self.total_frequency_only89
     
+    @stage(rows_in=lambda self, *args, **kwargs: self.no_customers, rows_out=len)
     def calculate_customer_preferences(self, min_frequency=3):
         """
         calculate the customer preferences bases on the total frequencies with a minimum support of min_frequency
@@ -61,6 +64,7 @@ class NegativeSampleGenerator():
         for i in range(n):
             print(f"{i}:\n{self.cons_preferences[i]}")
             
+    @stage(rows_in=lambda self: len(self.baskets))
     def generate(self):
         """
         generate neagtive samples and
@@ -69,7 +73,7 @@ class NegativeSampleGenerator():
         
         random.seed(42)
 
-        self.df_negative_samples = pd.DataFrame(columns=["week", "shopper", "product"])
+        negative_samples_rows = []
 
         for week_id in range(90):
             if round(week_id%9==0):
@@ -86,12 +90,12 @@ class NegativeSampleGenerator():
 
                 not_bought = set(self.cons_preferences[shopper_id]) - set(this_weeks_basket)
                 number_of_samples = min(len(not_bought), len(this_weeks_basket))
-                negative_samples = random.sample(not_bought, k=number_of_samples)
+                # random.sample no longer accepts sets (python >= 3.11), tuple() keeps the former sampling order
+                negative_samples = random.sample(tuple(not_bought), k=number_of_samples)
                 for neg in negative_samples:
-                    self.df_negative_samples = self.df_negative_samples.append(
-                        {"week": week_id,"shopper": shopper_id, "product": neg},
-                        ignore_index=True,
-                    )
+                    negative_samples_rows.append({"week": week_id,"shopper": shopper_id, "product": neg})
+        # DataFrame.append was removed in pandas 2.0
+        self.df_negative_samples = pd.DataFrame(negative_samples_rows, columns=["week", "shopper", "product"])
         self.df_negative_samples["product_bought"]=0
         print("100% done.")
         return self.df_negative_samples
\ No newline at end of file
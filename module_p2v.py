@@ -6,6 +6,7 @@ The purpose of this module is to:
 import gensim
 from gensim.models import Word2Vec
 from gensim.models.callbacks import CallbackAny2Vec
+from module_profiling import stage
 
 
 class p2v:
@@ -14,6 +15,7 @@ class p2v:
     def __init__(self, input_baskets):
         self.product_list = input_baskets
         
+    @stage(rows_in=lambda self: len(self.product_list))
     def create_product_list(self):
         """
         generate list of all purchased products
@@ -27,6 +29,7 @@ class p2v:
         """
         print(self.product_list[0:n])
 
+    @stage(rows_in=lambda self, *args, **kwargs: len(self.product_list))
     def train_p2v(self, vec_dim=30, epochs=100):
         """
         train gensim model
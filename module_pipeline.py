@@ -0,0 +1,494 @@
+"""
+The purpose of this module is to:
+* run the pipeline of the final notebook from the command line as a DAG of stages with explicit inputs and outputs (PIPELINE)
+* cache the outputs of every stage by the content hash of its inputs, parameters and code, so that only stale stages rerun
+* run independent stages (e.g. the negatives next to the lags and the p2v branch) at the same time in separate processes
+
+Stages (inputs -> outputs, all relative to the data path):
+    preferences:    baskets.parquet -> df_90.parquet (the preferred products of the target week, create_week_90_products of the notebook)
+    negatives:      baskets.parquet -> df_negative_samples.parquet
+    lags:           baskets.parquet, coupons.parquet, df_90.parquet -> lags.parquet
+    lag_statistics: lags.parquet -> purchase_temporal_distribution.parquet, avg_no_weeks_between_two_purchases.parquet
+    p2v:            baskets.parquet -> product_vector_model.pickle
+    clustering:     product_vector_model.pickle -> product_categories.csv
+    features:       baskets, coupons and the created data sets -> feature_store/train (train_weeks), feature_store/test (the train window
+                    shifted to end with the last test week, 1..89 in the notebook), feature_store/week90 (weeks 0..target_week-1)
+    training:       feature_store/train, feature_store/test -> lightgbm_model_final.pkl, lightgbm_run_record.json
+    assignment:     lags.parquet, feature_store/week90, lightgbm_model_final.pkl -> coupon_index.parquet
+
+The key of a stage is the sha256 of its name, the parameters it uses (PARAMS), the source of its modules and of all modules of this
+repository they import (imported_modules) and the content hashes of its inputs. A stage is fresh if its key and the hashes of its outputs are the ones of its last run. The outputs of every run are also copied
+into the artifact store under their key: a stage whose inputs and parameters go back to an earlier state is restored instead of rerun.
+A stage that reruns with identical outputs leaves the stages after it fresh. The file hashes are memoized by size and modification time.
+
+Every stage runs in a spawned worker process; its output goes to pipeline/logs/<stage>.log. Stages whose upstream failed are skipped.
+The existing outputs of reused stages (--reuse) are taken as they are, e.g. product_categories.csv of an earlier run when gensim is not
+installed.
+
+Usage:
+    python module_pipeline.py <path> [--stages assignment] [--set n_estimators=100] [--n-jobs 2] [--force lags] [--reuse p2v clustering] [--dry-run]
+
+Prerequisite:
+* baskets.parquet and coupons.parquet
+* the modules of the stages that run (gensim and yellowbrick for p2v and clustering)
+
+Layout on disk:
+    <path>/pipeline/state.json (key, output hashes and seconds of the last run per stage; memoized file hashes)
+    <path>/pipeline/artifacts/<stage>/<key>/<outputs>
+    <path>/pipeline/logs/<stage>.log (and <stage>.json, <stage>.trace.json with --profile, see module_profiling)
+"""
+
+import argparse
+import ast
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import numpy as np
+import pandas as pd
+
+#bump whenever the stage functions of this module change -> all stages rerun
+PIPELINE_VERSION = 2
+
+#parameters of the final notebook
+PARAMS = {'no_shoppers': 2000, 'no_products': 250, 'min_frequency': 3, 'target_week': 90, 'vec_dim': 30, 'epochs': 100, 'perplexity': 2,
+          'no_iterations': 5000, 'no_clusters': 25, 'train_weeks': [0, 88], 'test_weeks': [89, 89], 'n_estimators': 300, 'no_coupons': 5}
+
+_MODULE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+class Stage:
+
+    """
+    stage of the pipeline: function(path, params) reads the inputs and writes the outputs (files or directories relative to the data path)
+    """
+
+    def __init__(self, name, function, inputs, outputs, params = (), modules = ()):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = list(params)
+        #the source of these modules and of the modules of this repository they import is part of the key
+        self.modules = list(modules)
+
+
+def _product_lists(path, no_shoppers):
+    """
+    returns the product list per shopper and week (create_baskets of the final notebook)
+    """
+    baskets = pd.read_parquet(path + '/baskets.parquet', columns = ['week', 'shopper', 'product'], filters = [('shopper', '<', no_shoppers)])
+    baskets = baskets.groupby(['shopper', 'week'])['product'].agg(list).rename('products').reset_index()
+    baskets['basket_size'] = baskets['products'].apply(len)
+    return baskets
+
+
+def _negative_sampler(path, params):
+    import module_negatives
+    sampler = module_negatives.NegativeSampleGenerator(_product_lists(path, params['no_shoppers']), no_customers = params['no_shoppers'],
+                                                       no_products = params['no_products'])
+    sampler.calculate_frequencies()
+    sampler.calculate_customer_preferences(min_frequency = params['min_frequency'])
+    return sampler
+
+
+def _preferences(path, params):
+    preferences = _negative_sampler(path, params).cons_preferences
+    df_90 = pd.DataFrame([(params['target_week'], shopper, product, 0) for shopper, products in preferences.items() for product in products],
+                         columns = ['week', 'shopper', 'product', 'product_bought'])
+    df_90.to_parquet(path + '/df_90.parquet')
+
+
+def _negatives(path, params):
+    _negative_sampler(path, params).generate().to_parquet(path + '/df_negative_samples.parquet')
+
+
+def _lags(path, params):
+    import module_lags
+    filters = [('shopper', '<', params['no_shoppers'])]
+    baskets = pd.read_parquet(path + '/baskets.parquet', columns = ['week', 'shopper', 'product', 'price'], filters = filters)
+    coupons = pd.read_parquet(path + '/coupons.parquet', filters = filters)
+    data = pd.merge(baskets, coupons, on = ['week', 'shopper', 'product'], how = 'outer')
+    data['product_bought'] = np.where(data['price'].isna(), 0, 1)
+    #the target week is not observed: its rows have no target (see module_week90_generate_dataset.build_scoring_set)
+    df_90 = pd.read_parquet(path + '/df_90.parquet').assign(product_bought = np.nan)
+    data = pd.concat([data[['week', 'shopper', 'product', 'product_bought']], df_90], ignore_index = True)
+    data = data[['shopper', 'product', 'week', 'product_bought']].sort_values(by = ['shopper', 'product', 'week']).reset_index(drop = True)
+    module_lags.LagCalculator(data).calculate_lags().to_parquet(path + '/lags.parquet')
+
+
+def _lag_statistics(path, params):
+    import module_lags
+    lags = pd.read_parquet(path + '/lags.parquet')
+    lag_calculator = module_lags.LagCalculator(lags)
+    #the last observed week is left out as in the final notebook (max_week = 89)
+    max_week = params['target_week'] - 1
+    lag_calculator.calculate_purchase_temporal_distribution(lags, max_week = max_week).to_parquet(path + '/purchase_temporal_distribution.parquet')
+    lag_calculator.calculate_avg_no_weeks_between_two_purchases(lags, max_week = max_week).to_parquet(path + '/avg_no_weeks_between_two_purchases.parquet')
+
+
+def _p2v(path, params):
+    import pickle
+    import module_p2v
+    product_vector_model = module_p2v.p2v(_product_lists(path, params['no_shoppers'])['products'])
+    product_vector_model.create_product_list()
+    product_vector_model.train_p2v(vec_dim = params['vec_dim'], epochs = params['epochs'])
+    with open(path + '/product_vector_model.pickle', 'wb') as handle:
+        pickle.dump(product_vector_model, handle)
+
+
+def _clustering(path, params):
+    import pickle
+    from module_clustering import p2cluster
+    with open(path + '/product_vector_model.pickle', 'rb') as handle:
+        product_vector_model = pickle.load(handle)
+    p2cluster_model = p2cluster(product_vector_model.p2v_model)
+    p2cluster_model.tsne_train(perplexity = params['perplexity'], no_iterations = params['no_iterations'])
+    p2cluster_model.train_cluster(params['no_clusters'])
+    p2cluster_model.get_categories()[['product', 'category_label']].to_csv(path + '/product_categories.csv', index = False)
+
+
+def _features(path, params):
+    import module_feature_store
+    (train_start, train_end), test_end = params['train_weeks'], params['test_weeks'][1]
+    #the aggregates of the test set cover as many weeks as the ones of the training set and end with the last test week (1..89 for 0..88)
+    windows = {'train': (train_start, train_end), 'test': (test_end - (train_end - train_start), test_end), 'week90': (0, params['target_week'] - 1)}
+    module_feature_store.build_feature_store(path, windows, no_shoppers = params['no_shoppers'])
+
+
+def _training(path, params):
+    from module_lightgbm import predict_lightgbm
+    from module_train_test_splitting import train_test_splitting
+    (train_start, train_end), (test_start, test_end) = params['train_weeks'], params['test_weeks']
+    X_train, X_test, y_train, y_test, feature_names, categorical_features = train_test_splitting(path, train_start, train_end, test_start, test_end,
+                                                                                                 feature_store = True, return_schema = True)
+    predict_lightgbm(X_train, X_test, y_train, y_test, n_estimators = params['n_estimators'], feature_names = feature_names,
+                     categorical_features = categorical_features, headless = True, run_record = path + '/lightgbm_run_record.json',
+                     model_file = path + '/lightgbm_model_final.pkl')
+
+
+def _assignment(path, params):
+    import module_feature_store
+    import module_week90_generate_dataset
+    from module_coupon_assignment import assign_coupons, load_model, predict_discounts
+    model = load_model(path + '/lightgbm_model_final.pkl')
+    #the aggregates of the week90 store of the features stage, no as-of store is built
+    store = module_feature_store.FeatureStore(path, 'week90').load(grains = ['shopper', 'product', 'shopper_product'])
+    scoring_set = module_week90_generate_dataset.build_scoring_set(path, params['target_week'], min_frequency = params['min_frequency'],
+                                                                   no_shoppers = params['no_shoppers'], store = store)
+    proba = predict_discounts(model, scoring_set)
+    coupons = assign_coupons(scoring_set, proba, no_coupons = params['no_coupons'], week = params['target_week'])
+    coupons.to_parquet(path + '/coupon_index.parquet.tmp', index = False)
+    os.replace(path + '/coupon_index.parquet.tmp', path + '/coupon_index.parquet')
+
+
+_DATASETS = ['baskets.parquet', 'coupons.parquet', 'df_negative_samples.parquet', 'product_categories.csv', 'lags.parquet',
+             'purchase_temporal_distribution.parquet', 'avg_no_weeks_between_two_purchases.parquet']
+
+PIPELINE = [
+    Stage('preferences', _preferences, ['baskets.parquet'], ['df_90.parquet'], ['no_shoppers', 'no_products', 'min_frequency', 'target_week'],
+          ['module_negatives']),
+    Stage('negatives', _negatives, ['baskets.parquet'], ['df_negative_samples.parquet'], ['no_shoppers', 'no_products', 'min_frequency'],
+          ['module_negatives']),
+    Stage('lags', _lags, ['baskets.parquet', 'coupons.parquet', 'df_90.parquet'], ['lags.parquet'], ['no_shoppers'], ['module_lags']),
+    Stage('lag_statistics', _lag_statistics, ['lags.parquet'], ['purchase_temporal_distribution.parquet', 'avg_no_weeks_between_two_purchases.parquet'],
+          ['target_week'], ['module_lags']),
+    Stage('p2v', _p2v, ['baskets.parquet'], ['product_vector_model.pickle'], ['no_shoppers', 'vec_dim', 'epochs'], ['module_p2v']),
+    Stage('clustering', _clustering, ['product_vector_model.pickle'], ['product_categories.csv'], ['perplexity', 'no_iterations', 'no_clusters'],
+          ['module_clustering']),
+    Stage('features', _features, _DATASETS, ['feature_store/train', 'feature_store/test', 'feature_store/week90'],
+          ['no_shoppers', 'train_weeks', 'test_weeks', 'target_week'], ['module_feature_store']),
+    Stage('training', _training, ['feature_store/train', 'feature_store/test'], ['lightgbm_model_final.pkl', 'lightgbm_run_record.json'],
+          ['train_weeks', 'test_weeks', 'n_estimators'], ['module_train_test_splitting', 'module_lightgbm']),
+    Stage('assignment', _assignment, ['lags.parquet', 'feature_store/week90', 'lightgbm_model_final.pkl'], ['coupon_index.parquet'],
+          ['no_shoppers', 'target_week', 'min_frequency', 'no_coupons'], ['module_feature_store', 'module_week90_generate_dataset', 'module_coupon_assignment']),
+]
+
+
+def _hash_file(filename, memo):
+    """
+    returns the sha256 of a file; memo: dict filename -> [size, mtime_ns, hash] of earlier calls
+    """
+    status = os.stat(filename)
+    entry = memo.get(filename)
+    if entry is not None and entry[:2] == [status.st_size, status.st_mtime_ns]:
+        return entry[2]
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(2 ** 20), b''):
+            digest.update(block)
+    memo[filename] = [status.st_size, status.st_mtime_ns, digest.hexdigest()]
+    return digest.hexdigest()
+
+
+def content_hash(filename, memo = None):
+    """
+    returns the sha256 of a file or of the relative names and hashes of all files of a directory; None if it does not exist
+    """
+    memo = {} if memo is None else memo
+    if os.path.isfile(filename):
+        return _hash_file(filename, memo)
+    if not os.path.isdir(filename):
+        return None
+    digest = hashlib.sha256()
+    for directory, directories, files in sorted(os.walk(filename)):
+        directories.sort()
+        for name in sorted(files):
+            digest.update(os.path.relpath(os.path.join(directory, name), filename).encode())
+            digest.update(_hash_file(os.path.join(directory, name), memo).encode())
+    return digest.hexdigest()
+
+
+def imported_modules(modules):
+    """
+    returns the names of the modules and of all modules of this repository they import (also inside functions), recursively, sorted
+    """
+    found, pending = set(), list(modules)
+    while pending:
+        module = pending.pop()
+        filename = os.path.join(_MODULE_DIRECTORY, module + '.py')
+        if module in found or not os.path.isfile(filename):
+            continue
+        found.add(module)
+        with open(filename, 'rb') as file:
+            tree = ast.parse(file.read(), filename)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                pending += [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0:
+                pending.append(node.module)
+    return sorted(found)
+
+
+def stage_key(stage, params, input_hashes):
+    """
+    returns the key of a stage: sha256 of its name, parameters, module sources (imported_modules) and input hashes
+    """
+    code = {}
+    for module in imported_modules(stage.modules):
+        with open(os.path.join(_MODULE_DIRECTORY, module + '.py'), 'rb') as file:
+            code[module] = hashlib.sha256(file.read()).hexdigest()
+    description = {'stage': stage.name, 'version': PIPELINE_VERSION, 'params': {name: params[name] for name in stage.params}, 'code': code,
+                   'inputs': input_hashes}
+    return hashlib.sha256(json.dumps(description, sort_keys = True).encode()).hexdigest()
+
+
+def _copy(source, destination):
+    if os.path.isdir(destination):
+        shutil.rmtree(destination)
+    os.makedirs(os.path.dirname(destination) or '.', exist_ok = True)
+    if os.path.isdir(source):
+        shutil.copytree(source, destination)
+    else:
+        shutil.copy2(source, destination)
+
+
+def _run_stage(path, name, params, log_file, profile):
+    """
+    runs one stage in a worker process; returns the seconds
+    """
+    with open(log_file, 'w') as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+    sys.stdout = open(1, 'w', buffering = 1, closefd = False)
+    sys.stderr = open(2, 'w', buffering = 1, closefd = False)
+    stage = {stage.name: stage for stage in PIPELINE}[name]
+    start = time.time()
+    if profile:
+        import module_profiling
+        with module_profiling.profiling(os.path.splitext(log_file)[0]):
+            stage.function(path, params)
+    else:
+        stage.function(path, params)
+    print('Stage %s finished in %.2f seconds' % (name, time.time() - start))
+    return time.time() - start
+
+
+def _required_stages(targets, reuse):
+    """
+    returns the targets and the stages they depend on in the order of PIPELINE; the dependencies of reused stages are not required
+    """
+    producers = {output: stage.name for stage in PIPELINE for output in stage.outputs}
+    stages = {stage.name: stage for stage in PIPELINE}
+    required, pending = set(), list(targets)
+    while pending:
+        name = pending.pop()
+        if name in required:
+            continue
+        required.add(name)
+        if name not in reuse:
+            pending += [producers[filename] for filename in stages[name].inputs if filename in producers]
+    return [stage for stage in PIPELINE if stage.name in required]
+
+
+def run_pipeline(path, targets = None, params = None, n_jobs = 2, force = (), reuse = (), store = True, profile = False, dry_run = False):
+
+    """
+    input:
+        path: path to baskets.parquet and coupons.parquet; all stage outputs are written to the same path
+        targets: default = None (the last stages, i.e. all stages that are needed for coupon_index.parquet), stages to bring up to date
+                 together with the stages they depend on
+        params: default = None, dict with the parameters that differ from PARAMS
+        n_jobs: default = 2, number of stages that run at the same time
+        force: default = (), stages that run even if they are fresh
+        reuse: default = (), stages whose existing outputs are used without running them
+        store: default = True, whether to keep the outputs of every run in the artifact store
+        profile: default = False, whether to write the stage profile of module_profiling next to the log of every stage that runs
+        dry_run: default = False, only report which stages are fresh; stages after a stale stage are reported as 'pending'
+    output:
+        results: dict stage -> dict with status (fresh, restored, ran, reused, failed, skipped, stale, pending), key, seconds and error
+    """
+
+    params = dict(PARAMS, **(params or {}))
+    path = os.path.abspath(path)
+    names = [stage.name for stage in PIPELINE]
+    for name in list(targets or []) + list(force) + list(reuse):
+        if name not in names:
+            raise ValueError('unknown stage %s, the stages are %s' % (name, ', '.join(names)))
+    if not targets:
+        #the stages whose outputs no other stage reads
+        consumed = {filename for stage in PIPELINE for filename in stage.inputs}
+        targets = [stage.name for stage in PIPELINE if not set(stage.outputs) & consumed]
+    stages = _required_stages(targets, set(reuse))
+    producers = {output: stage.name for stage in stages for output in stage.outputs}
+
+    directory = os.path.join(path, 'pipeline')
+    os.makedirs(os.path.join(directory, 'logs'), exist_ok = True)
+    state_file = os.path.join(directory, 'state.json')
+    state = {'stages': {}, 'files': {}}
+    if os.path.exists(state_file):
+        with open(state_file) as file:
+            state = json.load(file)
+    memo = state['files']
+
+    def save_state():
+        with open(state_file + '.tmp', 'w') as file:
+            json.dump(state, file, indent = 2)
+        os.replace(state_file + '.tmp', state_file)
+
+    def output_hashes(stage):
+        return {output: content_hash(os.path.join(path, output), memo) for output in stage.outputs}
+
+    def finish(stage, status, key, seconds = None):
+        hashes = output_hashes(stage)
+        missing = [output for output, value in hashes.items() if value is None]
+        if missing:
+            results[stage.name] = {'status': 'failed', 'key': key, 'seconds': seconds, 'error': 'missing outputs: %s' % ', '.join(missing)}
+            return
+        if status == 'ran' and store:
+            for output in stage.outputs:
+                _copy(os.path.join(path, output), os.path.join(directory, 'artifacts', stage.name, key, output))
+        state['stages'][stage.name] = {'key': key, 'outputs': hashes, 'seconds': seconds, 'finished': time.strftime('%Y-%m-%d %H:%M:%S')}
+        results[stage.name] = {'status': status, 'key': key, 'seconds': seconds, 'error': None}
+
+    def prepare(stage):
+        """
+        returns the key of a stage whose upstream is done; stages that are fresh, reused or in the artifact store are finished right away
+        """
+        upstream = sorted({producers[filename] for filename in stage.inputs if filename in producers}, key = names.index)
+        failed = [name for name in upstream if results[name]['status'] in ['failed', 'skipped']]
+        if failed:
+            results[stage.name] = {'status': 'skipped', 'key': None, 'seconds': None, 'error': 'upstream failed: %s' % ', '.join(failed)}
+            return None
+        if stage.name in reuse:
+            finish(stage, 'reused', None)
+            return None
+        if any(results[name]['status'] in ['stale', 'pending'] for name in upstream):
+            results[stage.name] = {'status': 'pending', 'key': None, 'seconds': None, 'error': None}
+            return None
+        input_hashes = {filename: content_hash(os.path.join(path, filename), memo) for filename in stage.inputs}
+        missing = [filename for filename, value in input_hashes.items() if value is None]
+        if missing:
+            results[stage.name] = {'status': 'failed', 'key': None, 'seconds': None, 'error': 'missing inputs: %s' % ', '.join(missing)}
+            return None
+        key = stage_key(stage, params, input_hashes)
+        last = state['stages'].get(stage.name, {})
+        if stage.name not in force:
+            if last.get('key') == key and output_hashes(stage) == last.get('outputs'):
+                results[stage.name] = {'status': 'fresh', 'key': key, 'seconds': None, 'error': None}
+                return None
+            artifact = os.path.join(directory, 'artifacts', stage.name, key)
+            if os.path.isdir(artifact) and all(os.path.exists(os.path.join(artifact, output)) for output in stage.outputs):
+                if dry_run:
+                    results[stage.name] = {'status': 'stale', 'key': key, 'seconds': None, 'error': 'restorable from the artifact store'}
+                    return None
+                for output in stage.outputs:
+                    _copy(os.path.join(artifact, output), os.path.join(path, output))
+                finish(stage, 'restored', key)
+                return None
+        if dry_run:
+            results[stage.name] = {'status': 'stale', 'key': key, 'seconds': None, 'error': None}
+            return None
+        return key
+
+    start = time.time()
+    results = {}
+    waiting = list(stages)
+    running = {}
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max(1, n_jobs), mp_context = context) as executor:
+        while waiting or running:
+            for stage in list(waiting):
+                upstream = [producers[filename] for filename in stage.inputs if filename in producers]
+                if all(name in results for name in upstream):
+                    waiting.remove(stage)
+                    key = prepare(stage)
+                    if key is not None:
+                        print('Running %s' % stage.name)
+                        log_file = os.path.join(directory, 'logs', stage.name + '.log')
+                        running[executor.submit(_run_stage, path, stage.name, params, log_file, profile)] = (stage, key)
+            if not running:
+                continue
+            done, _ = wait(running, return_when = FIRST_COMPLETED)
+            for future in done:
+                stage, key = running.pop(future)
+                try:
+                    finish(stage, 'ran', key, future.result())
+                except Exception as error:
+                    results[stage.name] = {'status': 'failed', 'key': key, 'seconds': None, 'error': '%s: %s' % (type(error).__name__, error)}
+                print('%s: %s' % (stage.name, results[stage.name]['status']))
+            if not dry_run:
+                save_state()
+    if not dry_run:
+        save_state()
+
+    print('\nPipeline (%d stages) in %.2f seconds' % (len(stages), time.time() - start))
+    for stage in stages:
+        result = results[stage.name]
+        seconds = '%.2f s' % result['seconds'] if result['seconds'] is not None else ''
+        print('  %-16s %-10s %10s  %s' % (stage.name, result['status'], seconds, result['error'] or ''))
+    return results
+
+
+if __name__ == '__main__':
+
+    def parameter(text):
+        name, _, value = text.partition('=')
+        if name not in PARAMS:
+            raise argparse.ArgumentTypeError('unknown parameter %s' % name)
+        try:
+            return name, json.loads(value)
+        except ValueError:
+            return name, value
+
+    names = [stage.name for stage in PIPELINE]
+    parser = argparse.ArgumentParser(description = 'Run the stale stages of the coupon pipeline.')
+    parser.add_argument('path', help = 'path to baskets.parquet and coupons.parquet')
+    parser.add_argument('--stages', nargs = '+', choices = names, help = 'stages to bring up to date (default: assignment)')
+    parser.add_argument('--set', nargs = '+', type = parameter, default = [], metavar = 'NAME=VALUE',
+                        help = 'parameters that differ from the notebook, e.g. n_estimators=100 train_weeks=[0,80]')
+    parser.add_argument('--n-jobs', type = int, default = 2, help = 'number of stages that run at the same time')
+    parser.add_argument('--force', nargs = '+', choices = names, default = [], help = 'stages that run even if they are fresh')
+    parser.add_argument('--reuse', nargs = '+', choices = names, default = [], help = 'stages whose existing outputs are used without running them')
+    parser.add_argument('--no-store', action = 'store_true', help = 'do not keep the outputs of every run in the artifact store')
+    parser.add_argument('--profile', action = 'store_true', help = 'write the stage profile of module_profiling next to the stage logs')
+    parser.add_argument('--dry-run', action = 'store_true', help = 'only report which stages are fresh')
+    arguments = parser.parse_args()
+
+    results = run_pipeline(arguments.path, arguments.stages, dict(arguments.set), arguments.n_jobs, arguments.force, arguments.reuse,
+                           not arguments.no_store, arguments.profile, arguments.dry_run)
+    sys.exit(1 if any(result['status'] in ['failed', 'skipped'] for result in results.values()) else 0)
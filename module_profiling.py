@@ -0,0 +1,409 @@
+"""
+The purpose of this module is to:
+* record the wall time, CPU time, peak memory and rows in and out of every pipeline stage (stage decorator, profile_stage context manager)
+* optionally capture a cProfile per stage
+* export the records as JSON or as a Chrome trace (chrome://tracing, https://ui.perfetto.dev), so a full run shows where the time goes
+
+The public stage functions of the pipeline modules are decorated with @stage(). The decorator does nothing but one attribute lookup
+until the profiler is enabled:
+    with module_profiling.profiling('profile') as profiler:     #writes profile.json and profile.trace.json on exit
+        train, test = generate_dataset(path, 0, 88, 1, 89)
+    profiler.to_frame()
+or for a whole script or notebook kernel: environment variable STAGE_PROFILE=<prefix> (the files are written when the process exits).
+
+Per stage the records hold:
+    name, module, thread, depth (0 = outermost), parent (index of the enclosing stage of the same thread), start (seconds since enable)
+    wall_seconds, cpu_seconds (all threads of the process, e.g. the LightGBM threads)
+    rss_start_mb, peak_rss_mb (peak during the stage, Linux: VmHWM after a reset through /proc/self/clear_refs; elsewhere the peak of the process)
+    tracemalloc_peak_mb (if trace_memory: peak of the traced Python and NumPy allocations during the stage)
+    rows_in, rows_out: rows of the tables passed to and returned by the stage (see _rows), None if the stage has none
+    error (exception of a failed stage), profile (file of the cProfile capture)
+The memory figures are process-wide: for stages that run at the same time in several threads (e.g. the shards of module_batch_scoring)
+the peak is not reset and covers the concurrent stages as well.
+
+Prerequisite:
+* none
+"""
+
+import atexit
+import cProfile
+import datetime
+import functools
+import json
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _memory_mb(field):
+    """
+    returns a memory field of /proc/self/status (e.g. VmRSS, VmHWM) in MB, None if not available
+    """
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    """
+    resets the peak RSS (VmHWM) of the process to the current RSS; returns False where this is not supported
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _process_peak_mb():
+    """
+    returns the peak RSS of the process since its start in MB (None where the resource module is not available)
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #bytes on macOS, kilobytes on Linux
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def _table_rows(value):
+    """
+    returns the rows of a table (DataFrame, 2-d array, module_coupon_assignment.Predictions), None if value is no table
+    """
+    if getattr(value, 'ndim', None) == 2:
+        return len(value)
+    if hasattr(value, 'to_frame') and hasattr(value, 'shopper'):
+        return len(value.shopper)
+    return None
+
+
+def _rows(values):
+    """
+    returns the rows of the tables among values; if there is none, the length of the first 1-d array or Series; None if there is
+    neither (e.g. a path)
+    """
+    tables = [rows for rows in map(_table_rows, values) if rows is not None]
+    if tables:
+        return sum(tables)
+    for value in values:
+        if getattr(value, 'ndim', None) == 1:
+            return len(value)
+    return None
+
+
+class Profiler:
+
+    """
+    collects the stage records of this process
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.trace_memory = False
+        self.cprofile = False
+        self.profile_dir = None
+        self.records = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._active = 0
+        self._profiling = False
+
+
+    def enable(self, trace_memory = False, cprofile = False, profile_dir = None, reset = True):
+
+        """
+        input:
+            trace_memory: default = False, whether to trace the allocations with tracemalloc (slows down allocation-heavy stages)
+            cprofile: default = False, whether to capture a cProfile of every outermost stage (nested stages are part of it)
+            profile_dir: default = None (current directory), directory of the .prof files of the cProfile captures
+            reset: default = True, whether to drop the records of earlier runs
+        output:
+            the profiler
+        """
+
+        if reset:
+            self.records = []
+            self._origin = time.perf_counter()
+        self.trace_memory = trace_memory
+        self.cprofile = cprofile
+        self.profile_dir = profile_dir or '.'
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.enabled = True
+        return self
+
+
+    def disable(self):
+        """
+        stops recording; the records are kept
+        """
+        self.enabled = False
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        return self
+
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+
+    def _start(self, name, module, rows_in):
+        stack = self._stack()
+        with self._lock:
+            self._active += 1
+            #the peak is only reset if no stage of another thread is running; the running peak of the enclosing stages is kept
+            reset = self._active == len(stack) + 1
+        hwm = _memory_mb('VmHWM')
+        for parent in stack:
+            parent['_peak'] = max(parent['_peak'] or 0, hwm or 0)
+            if self.trace_memory and tracemalloc.is_tracing():
+                parent['_traced_peak'] = max(parent['_traced_peak'], tracemalloc.get_traced_memory()[1])
+        peak_reset = reset and _reset_peak_rss()
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+
+        record = {'name': name, 'module': module, 'thread': threading.current_thread().name, 'depth': len(stack),
+                  'parent': stack[-1]['index'] if stack else None, 'start': time.perf_counter() - self._origin, 'wall_seconds': None,
+                  'cpu_seconds': None, 'rss_start_mb': _memory_mb('VmRSS'), 'peak_rss_mb': None, 'tracemalloc_peak_mb': None,
+                  'rows_in': rows_in, 'rows_out': None, 'error': None, 'profile': None,
+                  '_peak': None, '_peak_reset': peak_reset, '_traced_peak': 0, '_wall': time.perf_counter(), '_cpu': time.process_time(), '_profiler': None}
+        with self._lock:
+            record['index'] = len(self.records)
+            self.records.append(record)
+            if self.cprofile and not self._profiling:
+                self._profiling = True
+                record['_profiler'] = cProfile.Profile()
+        stack.append(record)
+        if record['_profiler'] is not None:
+            record['_profiler'].enable()
+        return record
+
+
+    def _stop(self, record, error = None):
+        if record['_profiler'] is not None:
+            record['_profiler'].disable()
+            os.makedirs(self.profile_dir, exist_ok = True)
+            record['profile'] = os.path.join(self.profile_dir, '%04d_%s.prof' % (record['index'], re.sub(r'[^A-Za-z0-9_.]', '_', record['name'])))
+            record['_profiler'].dump_stats(record['profile'])
+            with self._lock:
+                self._profiling = False
+        record['wall_seconds'] = time.perf_counter() - record['_wall']
+        record['cpu_seconds'] = time.process_time() - record['_cpu']
+        hwm = _memory_mb('VmHWM') if record['_peak_reset'] else _process_peak_mb()
+        record['peak_rss_mb'] = max(record['_peak'] or 0, hwm or 0) or None
+        if self.trace_memory and tracemalloc.is_tracing():
+            record['tracemalloc_peak_mb'] = max(record['_traced_peak'], tracemalloc.get_traced_memory()[1]) / 2 ** 20
+        if error is not None:
+            record['error'] = '%s: %s' % (type(error).__name__, error)
+        with self._lock:
+            for key in ['_peak', '_peak_reset', '_traced_peak', '_wall', '_cpu', '_profiler']:
+                del record[key]
+
+        stack = self._stack()
+        stack.pop()
+        if stack:
+            #the enclosing stage keeps the peak of the nested stage
+            stack[-1]['_peak'] = max(stack[-1]['_peak'] or 0, record['peak_rss_mb'] or 0)
+            if record['tracemalloc_peak_mb'] is not None:
+                stack[-1]['_traced_peak'] = max(stack[-1]['_traced_peak'], record['tracemalloc_peak_mb'] * 2 ** 20)
+        with self._lock:
+            self._active -= 1
+
+
+    def stage(self, name, rows_in = None, module = None):
+
+        """
+        input:
+            name: name of the stage
+            rows_in: default = None, rows of the input of the stage
+            module: default = None, module of the stage
+        output:
+            context manager that yields the record of the stage (None if the profiler is disabled); rows_out may be set on the record
+        """
+
+        return _StageContext(self, name, rows_in, module)
+
+
+    def finished(self):
+        """
+        returns the records of the finished stages in the order the stages started
+        """
+        with self._lock:
+            return [dict(record) for record in self.records if '_wall' not in record]
+
+
+    def to_frame(self):
+        """
+        returns the finished records as a DataFrame, one row per stage
+        """
+        import pandas as pd
+        return pd.DataFrame(self.finished())
+
+
+    def summary(self):
+        """
+        returns the calls, wall and CPU time, max. peak RSS and rows per stage name, sorted by the total wall time
+        """
+        frame = self.to_frame()
+        if len(frame) == 0:
+            return frame
+        summary = frame.groupby('name').agg(calls = ('index', 'count'), wall_seconds = ('wall_seconds', 'sum'), cpu_seconds = ('cpu_seconds', 'sum'),
+                                            peak_rss_mb = ('peak_rss_mb', 'max'), rows_in = ('rows_in', 'sum'), rows_out = ('rows_out', 'sum'))
+        return summary.sort_values('wall_seconds', ascending = False).reset_index()
+
+
+    def write_json(self, filename):
+        """
+        writes the records as JSON ({'created': ..., 'pid': ..., 'records': [...]})
+        """
+        report = {'created': datetime.datetime.now().isoformat(timespec = 'seconds'), 'pid': os.getpid(), 'argv': sys.argv,
+                  'records': self.finished()}
+        with open(filename + '.tmp', 'w') as file:
+            json.dump(report, file, indent = 2, default = str)
+        os.replace(filename + '.tmp', filename)
+        return filename
+
+
+    def write_chrome_trace(self, filename):
+        """
+        writes the records in the Chrome trace event format: one complete event per stage with the measurements as arguments
+        """
+        threads = {}
+        events = []
+        for record in self.finished():
+            tid = threads.setdefault(record['thread'], len(threads) + 1)
+            events.append({'name': record['name'], 'cat': record['module'] or 'stage', 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                           'ts': record['start'] * 1e6, 'dur': record['wall_seconds'] * 1e6,
+                           'args': {key: record[key] for key in ['cpu_seconds', 'rss_start_mb', 'peak_rss_mb', 'tracemalloc_peak_mb', 'rows_in', 'rows_out',
+                                                                 'error', 'profile'] if record[key] is not None}})
+        events += [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': thread}} for thread, tid in threads.items()]
+        with open(filename + '.tmp', 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+        os.replace(filename + '.tmp', filename)
+        return filename
+
+
+class _StageContext:
+
+    def __init__(self, profiler, name, rows_in, module):
+        self.profiler, self.name, self.rows_in, self.module = profiler, name, rows_in, module
+        self.record = None
+
+    def __enter__(self):
+        if self.profiler.enabled:
+            self.record = self.profiler._start(self.name, self.module, self.rows_in)
+        return self.record
+
+    def __exit__(self, kind, error, traceback):
+        if self.record is not None:
+            self.profiler._stop(self.record, error)
+        return False
+
+
+#profiler of this process
+PROFILER = Profiler()
+
+
+def profile_stage(name, rows_in = None):
+    """
+    context manager that records a block as stage name (see Profiler.stage), e.g. with profile_stage('load baskets') as record: ...
+    """
+    return PROFILER.stage(name, rows_in)
+
+
+def stage(name = None, rows_in = None, rows_out = None):
+
+    """
+    input:
+        name: default = None (qualified name of the function), name of the stage
+        rows_in: default = None (rows of the table arguments, see _rows), function of the arguments that returns the input rows,
+                 e.g. lambda self: len(self.baskets) for a method that works on an attribute
+        rows_out: default = None (rows of the returned tables), function of the return value that returns the output rows
+    output:
+        decorator that records every call of the function as a stage of PROFILER
+    """
+
+    def decorator(function):
+        stage_name = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return function(*args, **kwargs)
+            try:
+                rows = rows_in(*args, **kwargs) if rows_in is not None else _rows(list(args) + list(kwargs.values()))
+            except Exception:
+                rows = None
+            with PROFILER.stage(stage_name, rows, function.__module__) as record:
+                output = function(*args, **kwargs)
+                if record is not None:
+                    try:
+                        record['rows_out'] = rows_out(output) if rows_out is not None else _rows(list(output) if isinstance(output, tuple) else [output])
+                    except Exception:
+                        pass
+            return output
+
+        return wrapper
+
+    return decorator
+
+
+class profiling:
+
+    """
+    context manager that enables PROFILER and writes <prefix>.json and <prefix>.trace.json on exit
+    """
+
+    def __init__(self, prefix = None, trace_memory = False, cprofile = False):
+        """
+        input:
+            prefix: default = None (nothing is written), prefix of the JSON and Chrome trace files; the cProfile captures go to <prefix>_profiles/
+            trace_memory, cprofile: see Profiler.enable
+        """
+        self.prefix = prefix
+        self.trace_memory = trace_memory
+        self.cprofile = cprofile
+
+    def __enter__(self):
+        profile_dir = self.prefix + '_profiles' if self.prefix else None
+        return PROFILER.enable(self.trace_memory, self.cprofile, profile_dir)
+
+    def __exit__(self, kind, error, traceback):
+        PROFILER.disable()
+        if self.prefix:
+            PROFILER.write_json(self.prefix + '.json')
+            PROFILER.write_chrome_trace(self.prefix + '.trace.json')
+        return False
+
+
+def _profile_from_environment():
+    """
+    enables PROFILER if the environment variable STAGE_PROFILE is set and writes the files when the process exits
+    (STAGE_PROFILE_MEMORY=1: trace_memory, STAGE_PROFILE_CPROFILE=1: cprofile)
+    """
+    prefix = os.environ.get('STAGE_PROFILE')
+    if not prefix:
+        return
+    context = profiling(prefix, os.environ.get('STAGE_PROFILE_MEMORY') == '1', os.environ.get('STAGE_PROFILE_CPROFILE') == '1')
+    context.__enter__()
+    atexit.register(context.__exit__, None, None, None)
+
+
+_profile_from_environment()
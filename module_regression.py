@@ -0,0 +1,475 @@
+"""
+The purpose of this module is to:
+* run the pipeline on a fixed synthetic data set and compare every intermediate artifact to stored golden outputs within tolerances
+* compare the wall time and the peak memory of every stage to a stored baseline and fail on regressions beyond a threshold (run_regression)
+
+A faster implementation of a module has to reproduce the golden outputs. The golden outputs and the baseline are recorded once with
+update_golden / update_baseline and committed. A change that alters a result on purpose updates the golden outputs in the same commit.
+
+Stages and their artifacts:
+    synthetic_data: baskets, coupons (module_synthetic_data.generate_synthetic_data, 50 shoppers, seed 0)
+    derived_inputs: module_synthetic_data.derive_inputs, checked against the modules of the notebook (check derive_inputs)
+    preferences, negatives: negatives (module_negatives.NegativeSampleGenerator, stages of module_pipeline)
+    lags, lag_statistics: lags, purchase_temporal_distribution, avg_no_weeks_between_two_purchases (module_lags.LagCalculator)
+    features: features_train, features_test, features_week90 (wide frames of module_feature_store.build_feature_store)
+    splitting: split_test (X_test and y_test of module_train_test_splitting.train_test_splitting)
+    training: test_predictions (module_lightgbm.predict_lightgbm with TRAINING_PARAMS)
+    scoring: scoring_set and predictions (purchase probabilities of week 90 under every discount, module_coupon_assignment.predict_discounts)
+    assignment: final_coupons (module_coupon_assignment.assign_coupons), heuristic_coupons (module_baseline_heuristic_model.fast_heuristic_model)
+The artifacts are compared after sorting by their key columns: same columns, dtypes and rows; numeric values within (rtol, atol) of
+ARTIFACTS (None = exact), the other values exactly. A stage regresses if its wall time exceeds the baseline by more than time_threshold
+(and min_seconds) or its peak RSS by more than memory_threshold (and min_mb).
+
+Checks without golden outputs:
+    derive_inputs: the lags and lag aggregates of derive_inputs equal the ones of module_lags; its negatives have the same number of samples
+                   per shopper and week as the ones of module_negatives (the samples are drawn with other random numbers)
+    mmap_split: predict_lightgbm on the memory-mapped split (train_test_splitting with mmap = True) gives the same test predictions
+    cross_validation: the last fold of module_cross_validation.fold_split equals the split of the splitting stage and the training aggregates of
+                      the fold before it end with the week before its test week
+    asof_store: the as-of aggregates of module_week90_generate_dataset.asof_feature_store, built in shards of shoppers, equal the ones of
+                FeatureStore.build on the merged data of all shoppers
+    recommendation_cache: module_recommendation_cache with the drift-tolerant hash answers a shopper without activity in the next week from
+                          the cache (stamped with the new week) and rescores a shopper whose own features changed; the exact default hash
+                          answers only a refresh of the same scoring set from the cache
+    allocation: the budget repair of module_allocation skips a coupon that overflows the budget and takes the cheaper ones after it;
+                allocate_coupons stays within a tight budget
+    evaluation: module_evaluation.evaluate_policies counts the coupons of shoppers the PurchaseHistory does not hold and of weeks after it
+                as coupons without hits of their own policy and week
+    population: module_batch_scoring.batch_score on POPULATION_SHOPPERS synthetic shoppers gives coupons to every candidate shopper
+
+Prerequisite:
+* none; the data is generated into a temporary directory
+
+Layout on disk:
+    regression/golden/<artifact>.parquet, regression/baseline.json (stage -> wall_seconds, cpu_seconds, peak_rss_mb)
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+import module_benchmark
+import module_pipeline
+import module_profiling
+import module_synthetic_data
+
+REGRESSION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'regression')
+NO_SHOPPERS = 50
+SEED = 0
+#population of the batch scoring check: more shoppers than the 2000 of the notebook, few weeks
+POPULATION_SHOPPERS, POPULATION_WEEKS = 2500, 12
+TRAINING_PARAMS = {'n_estimators': 50, 'early_stopping_rounds': 50, 'num_leaves': 31, 'learning_rate': 0.1}
+#artifacts of the modules of the notebook that are compared to the fast derivation -> file name
+_INPUT_FILES = {'lags': 'lags', 'negatives': 'df_negative_samples', 'purchase_temporal_distribution': 'purchase_temporal_distribution',
+                'avg_no_weeks_between_two_purchases': 'avg_no_weeks_between_two_purchases'}
+#artifact -> (key columns the rows are sorted by, (rtol, atol) of the numeric columns or None for exact)
+ARTIFACTS = {
+    'baskets': (['week', 'shopper', 'product'], None),
+    'coupons': (['week', 'shopper', 'product'], None),
+    'lags': (['shopper', 'product', 'week'], None),
+    'negatives': (['week', 'shopper', 'product'], None),
+    'purchase_temporal_distribution': (['shopper', 'product'], (1e-9, 1e-9)),
+    'avg_no_weeks_between_two_purchases': (['shopper', 'product'], (1e-9, 1e-9)),
+    'features_train': (['week', 'shopper', 'product'], (1e-6, 1e-6)),
+    'features_test': (['week', 'shopper', 'product'], (1e-6, 1e-6)),
+    'features_week90': (['week', 'shopper', 'product'], (1e-6, 1e-6)),
+    'split_test': (None, (1e-6, 1e-6)),
+    'test_predictions': (None, (1e-4, 1e-4)),
+    'scoring_set': (['shopper', 'product'], (1e-6, 1e-6)),
+    'predictions': (['shopper', 'product'], (1e-4, 1e-4)),
+    'final_coupons': (['shopper', 'coupon'], None),
+    'heuristic_coupons': (['shopper', 'coupon'], None),
+}
+
+
+def compare_frames(actual, golden, keys = None, tolerance = None):
+
+    """
+    input:
+        actual: DataFrame of the current run
+        golden: DataFrame of the golden output
+        keys: default = None (row order), columns both frames are sorted by before the comparison
+        tolerance: default = None (exact), (rtol, atol) of the numeric columns
+    output:
+        problems: list of the differences as text, empty if the frames match
+    """
+
+    if list(actual.columns) != list(golden.columns):
+        return ['columns %s instead of %s' % (list(actual.columns), list(golden.columns))]
+    if len(actual) != len(golden):
+        return ['%d rows instead of %d' % (len(actual), len(golden))]
+    if keys:
+        actual = actual.sort_values(keys, kind = 'stable').reset_index(drop = True)
+        golden = golden.sort_values(keys, kind = 'stable').reset_index(drop = True)
+
+    problems = []
+    for column in golden.columns:
+        values, expected = actual[column].values, golden[column].values
+        if values.dtype != expected.dtype:
+            problems.append('%s: dtype %s instead of %s' % (column, values.dtype, expected.dtype))
+            continue
+        if np.issubdtype(expected.dtype, np.number):
+            if tolerance is None:
+                equal = (values == expected) | (pd.isna(values) & pd.isna(expected))
+            else:
+                equal = np.isclose(values, expected, rtol = tolerance[0], atol = tolerance[1], equal_nan = True)
+            if not equal.all():
+                difference = np.nanmax(np.abs(values[~equal].astype(np.float64) - expected[~equal].astype(np.float64)), initial = 0)
+                problems.append('%s: %d of %d values differ (max. abs. difference %.3g)' % (column, (~equal).sum(), len(equal), difference))
+        elif not actual[column].equals(golden[column]):
+            problems.append('%s: %d of %d values differ' % (column, (actual[column] != golden[column]).sum(), len(golden)))
+    return problems
+
+
+def _frame(matrix, columns):
+    return pd.DataFrame(np.asarray(matrix), columns = columns)
+
+
+def _check_cross_validation(path, test_week, no_shoppers, split):
+    """
+    returns the problems of the fold splits of module_cross_validation: the fold of test_week has to equal the split (X_train, X_test,
+    y_train, y_test) of the weeks 0..test_week-1 / test_week, the purchases per shopper of the fold before it may only count its training weeks
+    """
+    import module_cross_validation
+    import module_feature_store
+    from module_train_test_splitting import load_split
+    problems = []
+    sets, _ = load_split(module_cross_validation.fold_split(path, test_week, no_shoppers))
+    fold = [sets['train'][0], sets['test'][0], sets['train'][1], sets['test'][1]]
+    for name, actual, expected in zip(['X_train', 'X_test', 'y_train', 'y_test'], fold, split):
+        if actual.shape != expected.shape or not np.array_equal(actual, expected, equal_nan = True):
+            problems.append('fold %d: %s differs from the split' % (test_week, name))
+    module_cross_validation.fold_split(path, test_week - 1, no_shoppers)
+    shopper = module_feature_store.FeatureStore(path, 'cv_train_%d' % (test_week - 1)).load(grains = ['shopper']).tables['shopper']
+    baskets = pd.read_parquet(path + '/baskets.parquet', columns = ['week', 'shopper'], filters = [('shopper', '<', no_shoppers)])
+    expected = baskets[baskets['week'] < test_week - 1].groupby('shopper').size()
+    if not np.array_equal(shopper['no_products_bought'].values, expected.reindex(shopper['shopper']).values):
+        problems.append('fold %d: the training aggregates count purchases of the test week or later' % (test_week - 1))
+    return problems
+
+
+def _check_asof_store(path, target_week, no_shoppers, shard_size = 16):
+    """
+    returns the problems of the as-of feature store that is built in shards: its shopper, product and shopper_product tables have to equal
+    the ones FeatureStore.build computes from the merged data of all shoppers
+    """
+    import module_feature_store
+    import module_lags
+    import module_week90_generate_dataset
+    data, inputs = module_feature_store.load_merged_data(path, no_shoppers)
+    data = data[data['week'] < target_week]
+    inputs['min_price'] = data[data['product_bought'] == 1].groupby('product')['price'].agg(min).rename('min_price')
+    lags = pd.read_parquet(path + '/lags.parquet', columns = ['shopper', 'product', 'week', 'product_bought', 'lag_weeks_of_product_per_customer'])
+    lag_calculator = module_lags.LagCalculator(lags)
+    inputs['purchase_temporal_distribution'] = lag_calculator.calculate_purchase_temporal_distribution(lags, max_week = target_week - 1)
+    inputs['avg_no_weeks_between_two_purchases'] = lag_calculator.calculate_avg_no_weeks_between_two_purchases(lags, max_week = target_week - 1)
+    expected = module_feature_store.FeatureStore(path, 'asof_reference').build(data, inputs, 0, target_week - 1)
+    store = module_week90_generate_dataset.asof_feature_store(path, target_week, no_shoppers, shard_size)
+    store = module_feature_store.FeatureStore(path, store.name).load(grains = ['shopper', 'product', 'shopper_product'])
+    problems = []
+    if store.manifest['shards'] < 2:
+        problems.append('the store was built in %d shard' % store.manifest['shards'])
+    for grain in ['shopper', 'product', 'shopper_product']:
+        #the counts of the product table become float64 in the shards
+        problems += ['%s: %s' % (grain, problem) for problem in compare_frames(store.tables[grain].astype(np.float64),
+                                                                                expected.tables[grain].astype(np.float64), None, (1e-9, 1e-9))]
+    return problems
+
+
+def _check_recommendation_cache(path, model, scoring_set):
+    """
+    refreshes a RecommendationCache with the drift-tolerant hash with the scoring set and then with the same scoring set one week later
+    without any activity (week and weeks since the last purchase + 1) and with a changed feature of one shopper; returns the problems: only
+    this shopper may miss and the coupons of the others have to equal the ones of the first week, stamped with the new week. With the
+    default (exact) hash the same scoring set has to hit and the one of the next week has to miss for every shopper
+    """
+    import module_recommendation_cache
+    columns = module_recommendation_cache.DRIFT_TOLERANT_COLUMNS
+    cache = module_recommendation_cache.RecommendationCache(path)
+    first, _ = cache.refresh(model, scoring_set, hash_columns = columns, save = False)
+    lag = scoring_set['lag_weeks_of_product_per_customer']
+    next_week = scoring_set.assign(week = scoring_set['week'] + 1, lag_weeks_of_product_per_customer = lag.where(lag < 0, lag + 1))
+    changed = first['shopper'].iloc[0]
+    next_week.loc[next_week['shopper'] == changed, 'no_products_bought'] += 1
+    second, report = cache.refresh(model, next_week, hash_columns = columns, save = False)
+    problems = []
+    if report['misses'] != 1 or report['features_changed'] != 1:
+        problems.append('%d misses (%d features changed) instead of only shopper %d' % (report['misses'], report['features_changed'], changed))
+    hits = second['shopper'] != changed
+    expected = first[first['shopper'] != changed].assign(week = first['week'] + 1).reset_index(drop = True)
+    problems += compare_frames(second[hits].reset_index(drop = True), expected, ['shopper', 'coupon'])
+    exact = module_recommendation_cache.RecommendationCache(path)
+    exact.refresh(model, scoring_set, save = False)
+    _, same = exact.refresh(model, scoring_set, save = False)
+    _, moved = exact.refresh(model, next_week, save = False)
+    if same['hits'] != same['shoppers'] or moved['features_changed'] != moved['shoppers']:
+        problems.append('exact hash: %d of %d hits for the same scoring set, %d of %d features changed in the next week'
+                        % (same['hits'], same['shoppers'], moved['features_changed'], moved['shoppers']))
+    return problems
+
+
+def _check_allocation(scoring_set, proba):
+    """
+    returns the problems of the budget repair of module_allocation: with mixed costs a coupon that overflows the budget is skipped and the
+    cheaper coupons after it are still taken, and allocate_coupons on the scoring set stays within a budget of a quarter of the cost of
+    the unconstrained top coupons
+    """
+    import module_allocation
+    no_caps = np.full(4, np.inf)
+    keep = module_allocation._repair(np.arange(4), np.zeros(4, dtype = np.int64), np.array([5.0, 4.0, 3.0, 2.0]), np.arange(4),
+                                     np.array([1.0, 10.0, 1.0, 1.0]), no_caps, no_caps[:1], 3.0)
+    problems = []
+    if keep.tolist() != [True, False, True, True]:
+        problems.append('repair keeps %s instead of [True, False, True, True]' % keep.tolist())
+    _, unconstrained = module_allocation.allocate_coupons(scoring_set, proba)
+    budget = unconstrained['cost'] / 4
+    _, report = module_allocation.allocate_coupons(scoring_set, proba, budget = budget)
+    if report['cost'] > budget * (1 + 1e-6) or report['coupons'] == 0:
+        problems.append('%d coupons cost %.2f with a budget of %.2f' % (report['coupons'], report['cost'], budget))
+    return problems
+
+
+def _check_evaluation(path, no_shoppers):
+    """
+    evaluates the offered coupons of the last two weeks against a PurchaseHistory that holds only part of the shoppers, with and without the
+    coupons of the other shoppers and of the week after the history; returns the problems: the coupons outside of the history may only add
+    to the shoppers and coupons of their own policy and week, the hits and revenues have to stay the same
+    """
+    import module_evaluation
+    history = module_evaluation.PurchaseHistory(path, no_shoppers = no_shoppers - 10)
+    last_week = int(history.weeks.max())
+    coupons = pd.read_parquet(path + '/coupons.parquet', columns = ['week', 'shopper', 'product', 'discount'], filters = [('week', '>=', last_week - 1)])
+    inside = coupons[coupons['shopper'] < history.no_shoppers]
+    outside = pd.concat([coupons, inside[inside['week'] == last_week].assign(week = last_week + 1)], ignore_index = True)
+    weeks = [last_week - 1, last_week, last_week + 1]
+    results = module_evaluation.evaluate_policies(history, {'inside': inside, 'outside': outside}, weeks)
+    expected = pd.DataFrame({'shoppers': outside.groupby('week')['shopper'].nunique(), 'coupons': outside.groupby('week').size()}).reindex(weeks)
+    problems = []
+    first, second = [results[results['policy'] == name].set_index('week') for name in ['inside', 'outside']]
+    if not np.array_equal(second[['shoppers', 'coupons']].values, expected.values):
+        problems.append('%s shoppers and %s coupons per week instead of %s and %s' % (second['shoppers'].tolist(), second['coupons'].tolist(),
+                                                                                      expected['shoppers'].tolist(), expected['coupons'].tolist()))
+    metrics = ['hits', 'redeemed_revenue', 'discount_cost']
+    if not np.allclose(first[metrics].values, second[metrics].values) or first.loc[last_week - 1, 'hits'] == 0:
+        problems.append('the coupons outside of the history change the hits and revenues: %s' % second[metrics].values.tolist())
+    return problems
+
+
+def _check_population(path, model, no_shoppers = POPULATION_SHOPPERS, no_weeks = POPULATION_WEEKS, seed = SEED):
+    """
+    scores a synthetic population of more than 2000 shoppers with module_batch_scoring.batch_score; returns the problems: every shopper with
+    candidates in the target week has to get coupons and the summary has to count them
+    """
+    import module_batch_scoring
+    module_synthetic_data.generate_synthetic_data(path, no_shoppers = no_shoppers, no_weeks = no_weeks, seed = seed)
+    summary = module_batch_scoring.batch_score(path, model, target_week = no_weeks, shard_size = 500, n_jobs = 1)
+    coupons = module_batch_scoring.load_coupon_index(path, target_week = no_weeks)
+    candidates = pd.read_parquet(path + '/lags.parquet', columns = ['shopper'], filters = [('week', '==', no_weeks)])['shopper'].unique()
+    problems = []
+    if set(coupons['shopper']) != set(candidates):
+        problems.append('coupons for %d of %d candidate shoppers (max. shopper %s)' % (coupons['shopper'].nunique(), len(candidates), coupons['shopper'].max()))
+    if summary['shoppers'].sum() != coupons['shopper'].nunique() or summary['coupons'].sum() != len(coupons):
+        problems.append('summary reports %d shoppers and %d coupons, the index holds %d and %d'
+                        % (summary['shoppers'].sum(), summary['coupons'].sum(), coupons['shopper'].nunique(), len(coupons)))
+    return problems
+
+
+def run_pipeline(path, no_shoppers = NO_SHOPPERS, seed = SEED, training_params = TRAINING_PARAMS):
+
+    """
+    input:
+        path: empty directory the data sets are written to
+        no_shoppers, seed, training_params: see NO_SHOPPERS, SEED and TRAINING_PARAMS
+    output:
+        artifacts: dict artifact -> DataFrame (see ARTIFACTS)
+        stages: dict stage -> dict with wall_seconds, cpu_seconds and peak_rss_mb
+        checks: dict check -> list of problems of the checks that have no golden output (see CHECKS)
+    """
+
+    import module_baseline_heuristic_model
+    import module_feature_store
+    import module_week90_generate_dataset
+    from module_coupon_assignment import DISCOUNTS, assign_coupons, predict_discounts
+    from module_lightgbm import predict_lightgbm
+    from module_train_test_splitting import FEATURE_COLUMNS, train_test_splitting
+
+    artifacts, stages, checks = {}, {}, {}
+
+    def measure(stage, function):
+        peak_reset = module_profiling._reset_peak_rss()
+        start, cpu_start = time.perf_counter(), time.process_time()
+        output = function()
+        stages[stage] = {'wall_seconds': time.perf_counter() - start, 'cpu_seconds': time.process_time() - cpu_start,
+                         'peak_rss_mb': module_profiling._memory_mb('VmHWM') if peak_reset else None}
+        return output
+
+    measure('synthetic_data', lambda: module_synthetic_data.generate_synthetic_data(path, no_shoppers = no_shoppers, seed = seed, derive = False))
+    artifacts['baskets'] = pd.read_parquet(path + '/baskets.parquet')
+    artifacts['coupons'] = pd.read_parquet(path + '/coupons.parquet')
+
+    #the fast derivation of module_synthetic_data is checked against the modules of the notebook, whose outputs feed the later stages
+    measure('derived_inputs', lambda: module_synthetic_data.derive_inputs(path, no_shoppers = no_shoppers, seed = seed))
+    derived = {name: pd.read_parquet(path + '/%s.parquet' % filename) for name, filename in _INPUT_FILES.items()}
+
+    params = dict(module_pipeline.PARAMS, no_shoppers = no_shoppers)
+    measure('preferences', lambda: module_pipeline._preferences(path, params))
+    measure('negatives', lambda: module_pipeline._negatives(path, params))
+    measure('lags', lambda: module_pipeline._lags(path, params))
+    measure('lag_statistics', lambda: module_pipeline._lag_statistics(path, params))
+    for name, filename in _INPUT_FILES.items():
+        artifacts[name] = pd.read_parquet(path + '/%s.parquet' % filename)
+
+    problems = []
+    for name in ['lags', 'purchase_temporal_distribution', 'avg_no_weeks_between_two_purchases']:
+        expected = artifacts[name]
+        actual = derived[name].astype(expected.dtypes.to_dict())
+        problems += ['%s: %s' % (name, problem) for problem in compare_frames(actual, expected, *ARTIFACTS[name])]
+    #the negatives are sampled with other random numbers, only the number of samples per shopper and week has to match
+    counts = [frame.groupby(['week', 'shopper']).size().rename('samples').reset_index().astype(np.int64) for frame in [derived['negatives'], artifacts['negatives']]]
+    problems += ['negatives: %s' % problem for problem in compare_frames(counts[0], counts[1], ['week', 'shopper'])]
+    checks['derive_inputs'] = problems
+
+    stores = measure('features', lambda: module_feature_store.build_feature_store(path, no_shoppers = no_shoppers))
+    for name, store in stores.items():
+        artifacts['features_' + name] = store.assemble()
+
+    train_weeks, test_weeks = module_benchmark.TRAIN_WEEKS, module_benchmark.TEST_WEEKS
+    X_train, X_test, y_train, y_test, feature_names, categorical_features = measure('splitting', lambda: train_test_splitting(
+        path, train_weeks[0], train_weeks[1], test_weeks[0], test_weeks[1], feature_store = True, return_schema = True))
+    artifacts['split_test'] = _frame(X_test, FEATURE_COLUMNS).assign(product_bought = y_test)
+
+    model = measure('training', lambda: predict_lightgbm(X_train, X_test, y_train, y_test, feature_names = feature_names, categorical_features = categorical_features,
+                                                         headless = True, run_record = os.path.join(path, 'lightgbm_run_record.json'), model_file = None,
+                                                         **training_params))
+    artifacts['test_predictions'] = pd.DataFrame({'proba': model.predict_proba(X_test)[:, 1]})
+
+    #the memory-mapped split has to train the same model
+    mmap_split = train_test_splitting(path, train_weeks[0], train_weeks[1], test_weeks[0], test_weeks[1], feature_store = True, return_schema = True, mmap = True)
+    mmap_model = predict_lightgbm(*mmap_split[:4], feature_names = feature_names, categorical_features = categorical_features, headless = True,
+                                  run_record = os.path.join(path, 'lightgbm_run_record_mmap.json'), model_file = None, **training_params)
+    mmap_predictions = pd.DataFrame({'proba': mmap_model.predict_proba(mmap_split[1])[:, 1]})
+    checks['mmap_split'] = compare_frames(mmap_predictions, artifacts['test_predictions'], *ARTIFACTS['test_predictions'])
+
+    def score():
+        store = module_feature_store.FeatureStore(path, 'week90').load(grains = ['shopper', 'product', 'shopper_product'])
+        candidates = pd.read_parquet(path + '/lags.parquet', filters = [('week', '==', module_benchmark.TARGET_WEEK)])
+        scoring_set = module_week90_generate_dataset.gather_scoring_set(store, candidates, module_benchmark.TARGET_WEEK)
+        scoring_set = scoring_set.sort_values(['shopper', 'product']).reset_index(drop = True)
+        return scoring_set, predict_discounts(model, scoring_set)
+    scoring_set, proba = measure('scoring', score)
+    artifacts['scoring_set'] = scoring_set
+    artifacts['predictions'] = pd.concat([scoring_set[['shopper', 'product']], _frame(proba, ['proba_%d' % discount for discount in DISCOUNTS])], axis = 1)
+
+    artifacts['final_coupons'] = measure('assignment', lambda: assign_coupons(scoring_set, proba))
+    artifacts['heuristic_coupons'] = module_baseline_heuristic_model.fast_heuristic_model(path, no_shoppers = no_shoppers, week = module_benchmark.TARGET_WEEK)
+    #after the measured stages, as the fold stores raise the memory of the process
+    checks['cross_validation'] = _check_cross_validation(path, test_weeks[1], no_shoppers, mmap_split[:4])
+    checks['asof_store'] = _check_asof_store(path, module_benchmark.TARGET_WEEK, no_shoppers)
+    checks['recommendation_cache'] = _check_recommendation_cache(path, model, scoring_set)
+    checks['allocation'] = _check_allocation(scoring_set, proba)
+    checks['evaluation'] = _check_evaluation(path, no_shoppers)
+
+    #last, as its larger data sets raise the memory of the process
+    checks['population'] = _check_population(os.path.join(path, 'population'), model)
+
+    return artifacts, stages, checks
+
+
+def run_regression(directory = REGRESSION_DIR, update_golden = False, update_baseline = False, time_threshold = 0.5, memory_threshold = 0.25,
+                   min_seconds = 0.5, min_mb = 50, work_dir = None):
+
+    """
+    input:
+        directory: default = REGRESSION_DIR (regression/ next to this module), directory of the golden outputs and the baseline
+        update_golden: default = False, whether to write the artifacts of this run as the new golden outputs
+        update_baseline: default = False, whether to write the timings of this run as the new baseline
+        time_threshold: default = 0.5, allowed relative increase of the wall time of a stage
+        memory_threshold: default = 0.25, allowed relative increase of the peak RSS of a stage
+        min_seconds: default = 0.5, increases of the wall time below this are never a regression (timer noise of short stages)
+        min_mb: default = 50, increases of the peak RSS below this are never a regression
+        work_dir: default = None (temporary directory that is removed afterwards), directory of the synthetic data sets
+    output:
+        report: dict with passed, artifacts (artifact -> problems), stages (stage -> measurements, baseline and problems) and checks (check -> problems)
+    """
+
+    golden_dir = os.path.join(directory, 'golden')
+    baseline_file = os.path.join(directory, 'baseline.json')
+    path = work_dir or tempfile.mkdtemp(prefix = 'regression_')
+    try:
+        artifacts, stages, checks = run_pipeline(path)
+    finally:
+        if work_dir is None:
+            shutil.rmtree(path, ignore_errors = True)
+
+    report = {'passed': True, 'artifacts': {}, 'stages': {}, 'checks': checks}
+    if update_golden:
+        os.makedirs(golden_dir, exist_ok = True)
+    for name, (keys, tolerance) in ARTIFACTS.items():
+        filename = os.path.join(golden_dir, name + '.parquet')
+        if update_golden:
+            artifacts[name].to_parquet(filename, index = False, compression = 'zstd')
+            report['artifacts'][name] = []
+        elif not os.path.exists(filename):
+            report['artifacts'][name] = ['no golden output %s' % filename]
+        else:
+            report['artifacts'][name] = compare_frames(artifacts[name], pd.read_parquet(filename), keys, tolerance)
+
+    baseline = {}
+    if update_baseline:
+        os.makedirs(directory, exist_ok = True)
+        with open(baseline_file, 'w') as file:
+            json.dump({'environment': module_benchmark.environment(), 'stages': stages}, file, indent = 2)
+    elif os.path.exists(baseline_file):
+        with open(baseline_file) as file:
+            baseline = json.load(file)['stages']
+    for stage, measured in stages.items():
+        expected = baseline.get(stage)
+        problems = []
+        if expected is not None:
+            if measured['wall_seconds'] > expected['wall_seconds'] * (1 + time_threshold) and measured['wall_seconds'] - expected['wall_seconds'] > min_seconds:
+                problems.append('wall time %.2f s instead of %.2f s' % (measured['wall_seconds'], expected['wall_seconds']))
+            if (measured['peak_rss_mb'] is not None and expected['peak_rss_mb'] is not None and measured['peak_rss_mb'] > expected['peak_rss_mb'] * (1 + memory_threshold)
+                    and measured['peak_rss_mb'] - expected['peak_rss_mb'] > min_mb):
+                problems.append('peak RSS %.0f MB instead of %.0f MB' % (measured['peak_rss_mb'], expected['peak_rss_mb']))
+        report['stages'][stage] = dict(measured, baseline = expected, problems = problems)
+
+    report['passed'] = not any(checks.values()) and not any(report['artifacts'].values()) and not any(stage['problems'] for stage in report['stages'].values())
+
+    print('\nArtifacts:')
+    for name, problems in report['artifacts'].items():
+        print('  %-36s %s' % (name, 'updated' if update_golden else 'ok' if not problems else 'FAILED: ' + '; '.join(problems)))
+    print('Checks:')
+    for name, problems in checks.items():
+        print('  %-36s %s' % (name, 'ok' if not problems else 'FAILED: ' + '; '.join(problems)))
+    print('Stages:')
+    for stage, result in report['stages'].items():
+        expected = result['baseline']
+        print('  %-16s %8.2f s %8s MB  baseline %s  %s' % (stage, result['wall_seconds'], '%.0f' % result['peak_rss_mb'] if result['peak_rss_mb'] is not None else '-',
+              '%.2f s %s MB' % (expected['wall_seconds'], '%.0f' % expected['peak_rss_mb'] if expected['peak_rss_mb'] is not None else '-') if expected else '-',
+              'updated' if update_baseline else 'ok' if not result['problems'] else 'FAILED: ' + '; '.join(result['problems'])))
+    print('\nRegression gate %s' % ('passed' if report['passed'] else 'FAILED'))
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Compare the pipeline outputs and stage timings to the golden outputs and the baseline')
+    parser.add_argument('--directory', default = REGRESSION_DIR)
+    parser.add_argument('--update-golden', action = 'store_true')
+    parser.add_argument('--update-baseline', action = 'store_true')
+    parser.add_argument('--time-threshold', type = float, default = 0.5)
+    parser.add_argument('--memory-threshold', type = float, default = 0.25)
+    parser.add_argument('--min-seconds', type = float, default = 0.5)
+    parser.add_argument('--min-mb', type = float, default = 50)
+    parser.add_argument('--work-dir', default = None)
+    args = parser.parse_args()
+
+    report = run_regression(args.directory, args.update_golden, args.update_baseline, args.time_threshold, args.memory_threshold, args.min_seconds,
+                            args.min_mb, args.work_dir)
+    sys.exit(0 if report['passed'] else 1)
@@ -0,0 +1,380 @@
+"""
+The purpose of this module is to:
+* serve the top coupons of single shoppers online: the model, the feature rows of all candidates and the discount grid are kept in memory,
+  a request only scores the candidate rows of the requested shoppers (CouponService)
+* batch concurrent requests: one scoring thread takes all requests that are waiting and scores them in one prediction call
+* answer over HTTP on a TCP port or a Unix socket (make_server, serve) and measure the latency with a load test (load_test)
+
+Endpoints (JSON responses):
+    GET /coupons?shopper=<id>[&shopper=<id>...]  -> {"version": ..., "coupons": {"<id>": [{"coupon", "product", "discount", "probability", "expected_revenue"}, ...]}}
+    GET /health                                  -> {"status": "ok", "version": ..., "shoppers": ...}
+    GET /stats                                   -> requests, batches, mean batch size and the percentiles of the scoring latency
+
+Usage:
+    python module_serving.py serve <path> [--port 8090 | --unix-socket /tmp/coupons.sock] [--top-n 25]
+    python module_serving.py load-test [--url http://127.0.0.1:8090 | --unix-socket /tmp/coupons.sock] [--requests 5000 --concurrency 8]
+
+Prerequisite:
+* A registered model (module_model_registry.register_model) and the data sets of build_scoring_set (module_week90_generate_dataset)
+"""
+
+import argparse
+import http.client
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+
+from module_coupon_assignment import DISCOUNTS, feature_matrix, predict_discounts, top_coupons
+
+
+class CouponService:
+
+    """
+    in-memory scoring of the top coupons per shopper; requests are queued and scored in batches by one scoring thread
+    """
+
+    def __init__(self, model, scoring_set, discounts = DISCOUNTS, no_coupons = 5, version = None, max_batch = 256, max_wait = 0.0):
+
+        """
+        input:
+            model: trained model (LGBMClassifier or lgbm.Booster, e.g. from module_model_registry.load_model)
+            scoring_set: DataFrame with shopper, product, max_price and the feature columns of the candidates (e.g. build_scoring_set)
+            discounts: default = DISCOUNTS, discount levels that are scored
+            no_coupons: default = 5, coupons per shopper
+            version: default = None, model version that is reported with every response (e.g. the version of module_model_registry)
+            max_batch: default = 256, max. number of requests that are scored in one batch
+            max_wait: default = 0.0, seconds the scoring thread waits for further requests before it scores a batch; with 0 only the
+                      requests that arrived while the previous batch was scored are batched, so a single request never waits
+        """
+
+        self.discounts = list(discounts)
+        self.no_coupons = no_coupons
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.update(model, scoring_set, version)
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._latencies = []
+        self._requests = 0
+        self._batches = 0
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+
+    def update(self, model = None, scoring_set = None, version = None):
+        """
+        replaces the model and/or the scoring set; the new state is built first and swapped in one assignment, so requests that are
+        being scored keep the old state
+        """
+        state = getattr(self, '_state', None)
+        model = model if model is not None else state['model']
+        if scoring_set is None:
+            state = dict(state, model = model, version = version if version is not None else state['version'])
+        else:
+            scoring_set = scoring_set.sort_values(['shopper', 'product'], kind = 'stable')
+            shopper = scoring_set['shopper'].values
+            base = feature_matrix(scoring_set)
+            #rows of every shopper: shopper -> (first row, last row + 1)
+            shoppers, starts, counts = np.unique(shopper, return_index = True, return_counts = True)
+            max_price = scoring_set['max_price'].values.astype(np.float32)
+            state = {
+                'model': model,
+                'version': version,
+                'base': base,
+                'shopper': shopper,
+                'product': scoring_set['product'].values,
+                'price': max_price[:, None] * (1 - np.array(self.discounts, dtype = np.float32) / 100),
+                'rows': {int(key): (int(start), int(start + count)) for key, start, count in zip(shoppers, starts, counts)},
+            }
+        self._state = state
+
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    timeout = deadline - time.perf_counter()
+                    batch.append(self._queue.get(timeout = timeout) if timeout > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._score(batch)
+
+
+    def _score(self, batch):
+        start = time.perf_counter()
+        state = self._state
+        try:
+            shoppers = sorted({shopper for shoppers, _ in batch for shopper in shoppers if shopper in state['rows']})
+            coupons = {}
+            if shoppers:
+                rows = np.concatenate([np.arange(*state['rows'][shopper]) for shopper in shoppers])
+                proba = predict_discounts(state['model'], state['base'][rows], self.discounts, chunk_size = len(rows) * len(self.discounts))
+                e_revenue = proba * state['price'][rows]
+                row, level, coupon = top_coupons(state['shopper'][rows], state['product'][rows], e_revenue, self.no_coupons)
+                for idx, lvl, rank in zip(row, level, coupon):
+                    coupons.setdefault(int(state['shopper'][rows[idx]]), []).append({
+                        'coupon': int(rank),
+                        'product': int(state['product'][rows[idx]]),
+                        'discount': self.discounts[lvl],
+                        'probability': float(proba[idx, lvl]),
+                        'expected_revenue': float(e_revenue[idx, lvl])})
+            for shoppers, future in batch:
+                future.set_result({shopper: coupons.get(shopper, []) for shopper in shoppers})
+        except Exception as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+        with self._lock:
+            self._batches += 1
+            self._requests += len(batch)
+            self._latencies.append(time.perf_counter() - start)
+            del self._latencies[:-10000]
+
+
+    def recommend(self, shoppers, timeout = None):
+
+        """
+        input:
+            shoppers: shopper id or list of shopper ids
+            timeout: default = None (no timeout), seconds to wait for the result
+        output:
+            dict shopper -> list of the coupons (coupon, product, discount, probability, expected_revenue), sorted by coupon;
+            an empty list for unknown shoppers
+        """
+
+        shoppers = [int(shoppers)] if np.isscalar(shoppers) else [int(shopper) for shopper in shoppers]
+        future = Future()
+        self._queue.put((shoppers, future))
+        return future.result(timeout)
+
+
+    def stats(self):
+        """
+        returns a dict with the number of requests and batches, the mean batch size and the percentiles of the scoring time per batch (ms)
+        """
+        with self._lock:
+            latencies = 1000 * np.array(self._latencies)
+            stats = {'requests': self._requests, 'batches': self._batches, 'mean_batch_size': self._requests / max(self._batches, 1)}
+        for percentile in [50, 90, 99]:
+            stats['p%d_ms' % percentile] = float(np.percentile(latencies, percentile)) if len(latencies) else None
+        return stats
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    #the headers and the body are separate writes, without TCP_NODELAY the second one waits for the delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        service = self.server.service
+        try:
+            if url.path == '/coupons':
+                shoppers = [int(shopper) for shopper in parse_qs(url.query).get('shopper', [])]
+                if not shoppers:
+                    return self._send(400, {'error': 'missing parameter shopper'})
+                coupons = service.recommend(shoppers, timeout = 10)
+                self._send(200, {'version': service._state['version'], 'coupons': {str(key): value for key, value in coupons.items()}})
+            elif url.path == '/health':
+                self._send(200, {'status': 'ok', 'version': service._state['version'], 'shoppers': len(service._state['rows'])})
+            elif url.path == '/stats':
+                self._send(200, service.stats())
+            else:
+                self._send(404, {'error': 'unknown path %s' % url.path})
+        except ValueError as error:
+            self._send(400, {'error': str(error)})
+        except Exception as error:
+            self._send(500, {'error': repr(error)})
+
+    def _send(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        #the client address of a Unix socket is empty
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _UnixHandler(_Handler):
+    #TCP_NODELAY does not exist for Unix sockets
+    disable_nagle_algorithm = False
+
+
+class _TCPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, host = '127.0.0.1', port = 8090, unix_socket = None):
+
+    """
+    input:
+        service: CouponService
+        host: default = '127.0.0.1', host of the TCP server
+        port: default = 8090, port of the TCP server
+        unix_socket: default = None, path of a Unix socket; if given, the server listens on the socket instead of host:port
+    output:
+        server (not started yet): server.serve_forever() answers the requests, server.shutdown() stops it
+    """
+
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = _UnixServer(unix_socket, _UnixHandler)
+    else:
+        server = _TCPServer((host, port), _Handler)
+    server.service = service
+    return server
+
+
+def serve(path, host = '127.0.0.1', port = 8090, unix_socket = None, model_name = 'lightgbm', version = 'latest', scoring_set = None,
+          target_week = 90, top_n = None, **service_args):
+
+    """
+    input:
+        path: path to the data sets and the model registry (module_model_registry)
+        host, port, unix_socket: see make_server
+        model_name: default = 'lightgbm', name of the model in the registry
+        version: default = 'latest', version of the model
+        scoring_set: default = None (build_scoring_set(path, target_week, top_n = top_n)), candidates and features that are served
+        target_week: default = 90, week the coupons are served for
+        top_n: default = None (all candidates), candidates per shopper, see module_candidates.prune_candidates
+        **service_args: further arguments of CouponService (discounts, no_coupons, max_batch, max_wait)
+    output:
+        None, answers requests until it is interrupted
+    """
+
+    import module_model_registry
+    import module_week90_generate_dataset
+
+    model, meta = module_model_registry.load_model(path, model_name, version)
+    if scoring_set is None:
+        scoring_set = module_week90_generate_dataset.build_scoring_set(path, target_week, top_n = top_n)
+    service = CouponService(model, scoring_set, version = meta['version'], **service_args)
+    server = make_server(service, host, port, unix_socket)
+    #the first batch allocates the prediction buffers of the model
+    service.recommend(next(iter(service._state['rows'])))
+    print('Serving %d shoppers with model %s version %s on %s' % (len(service._state['rows']), model_name, meta['version'],
+                                                                   unix_socket or 'http://%s:%d' % (host, port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class _UnixConnection(http.client.HTTPConnection):
+
+    def __init__(self, unix_socket, timeout = 10):
+        super().__init__('localhost', timeout = timeout)
+        self.unix_socket = unix_socket
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_socket)
+
+
+def load_test(url = 'http://127.0.0.1:8090', unix_socket = None, shoppers = None, requests = 5000, concurrency = 8, shoppers_per_request = 1,
+              seed = 0):
+
+    """
+    input:
+        url: default = 'http://127.0.0.1:8090', address of a running server (see serve)
+        unix_socket: default = None, path of the Unix socket of a running server (instead of url)
+        shoppers: default = None (shoppers 0..1999), shopper ids that are requested at random
+        requests: default = 5000, total number of requests
+        concurrency: default = 8, number of clients with one persistent connection each
+        shoppers_per_request: default = 1, shoppers per request
+        seed: default = 0, seed of the random shoppers
+    output:
+        dict with requests, errors, seconds, requests_per_second and the p50, p90, p99 and max latency in ms (end to end, measured by the client)
+    """
+
+    shoppers = np.arange(2000) if shoppers is None else np.asarray(shoppers)
+    address = urlparse(url)
+    rng = np.random.default_rng(seed)
+    queries = ['/coupons?' + '&'.join('shopper=%d' % shopper for shopper in rng.choice(shoppers, shoppers_per_request)) for _ in range(requests)]
+
+    def client(worker):
+        connection = _UnixConnection(unix_socket) if unix_socket else http.client.HTTPConnection(address.hostname, address.port, timeout = 10)
+        latencies, errors = [], 0
+        for query in queries[worker::concurrency]:
+            start = time.perf_counter()
+            try:
+                connection.request('GET', query)
+                response = connection.getresponse()
+                response.read()
+                errors += response.status != 200
+            except (OSError, http.client.HTTPException):
+                errors += 1
+                connection.close()
+            latencies.append(time.perf_counter() - start)
+        connection.close()
+        return latencies, errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(client, range(concurrency)))
+    seconds = time.perf_counter() - start
+
+    latencies = 1000 * np.concatenate([latencies for latencies, _ in results])
+    report = {'requests': requests, 'errors': int(sum(errors for _, errors in results)), 'seconds': seconds, 'requests_per_second': requests / seconds}
+    for percentile in [50, 90, 99]:
+        report['p%d_ms' % percentile] = float(np.percentile(latencies, percentile))
+    report['max_ms'] = float(latencies.max())
+
+    print('%d requests (%d errors) in %.2f seconds (%.0f requests/s): p50 %.2f ms, p90 %.2f ms, p99 %.2f ms, max %.2f ms'
+          % (requests, report['errors'], seconds, report['requests_per_second'], report['p50_ms'], report['p90_ms'], report['p99_ms'], report['max_ms']))
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Online coupon recommendation service')
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    serve_parser = commands.add_parser('serve', help = 'serve the coupons of a registered model')
+    serve_parser.add_argument('path', help = 'path to the data sets and the model registry')
+    serve_parser.add_argument('--host', default = '127.0.0.1')
+    serve_parser.add_argument('--port', type = int, default = 8090)
+    serve_parser.add_argument('--unix-socket', default = None)
+    serve_parser.add_argument('--model-name', default = 'lightgbm')
+    serve_parser.add_argument('--version', default = 'latest')
+    serve_parser.add_argument('--target-week', type = int, default = 90)
+    serve_parser.add_argument('--top-n', type = int, default = None)
+    test_parser = commands.add_parser('load-test', help = 'measure the latency of a running server')
+    test_parser.add_argument('--url', default = 'http://127.0.0.1:8090')
+    test_parser.add_argument('--unix-socket', default = None)
+    test_parser.add_argument('--requests', type = int, default = 5000)
+    test_parser.add_argument('--concurrency', type = int, default = 8)
+    test_parser.add_argument('--shoppers-per-request', type = int, default = 1)
+    test_parser.add_argument('--no-shoppers', type = int, default = 2000)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.path, args.host, args.port, args.unix_socket, args.model_name, args.version, target_week = args.target_week, top_n = args.top_n)
+    else:
+        load_test(args.url, args.unix_socket, np.arange(args.no_shoppers), args.requests, args.concurrency, args.shoppers_per_request)
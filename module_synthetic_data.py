@@ -0,0 +1,270 @@
+"""
+The purpose of this module is to:
+* generate synthetic baskets.parquet and coupons.parquet with the schema of the raw data at any scale (generate_synthetic_data)
+* derive the created data sets of the final notebook from them (derive_inputs): df_negative_samples.parquet, lags.parquet,
+  purchase_temporal_distribution.parquet and avg_no_weeks_between_two_purchases.parquet
+
+The raw data is not shipped with the repository. The synthetic data follows its shape:
+    * every shopper shops in every week, the basket size is 1 + Poisson(mean_basket_size - 1) with mean 7.65 products
+      (68.8M basket rows for 100,000 shoppers x 90 weeks) and a product is at most once in a basket
+    * every shopper gets 5 coupons per week for distinct products (45M coupon rows), the discounts 10, 15, ..., 40 are equally likely
+    * a shopper buys the products of a few preferred categories most of the time; a coupon raises the purchase probability of its product
+      by the factor exp(coupon_effect x discount / 100), a redeemed coupon lowers the price of the product by the discount
+    * the products have a regular price between 400 and 800 and are grouped into no_categories latent categories
+      (product_categories.csv holds the latent category instead of the p2v clusters)
+The products of a basket are drawn without replacement proportional to the preferences by the Gumbel top-k trick, so a week of all shoppers
+is a handful of array operations. The data is written one row group per week, so the memory does not grow with the number of weeks.
+
+derive_inputs uses the definitions of module_negatives and module_lags (frequencies without the last week, preferences with at least
+min_frequency purchases, negatives sampled from the preferences that were not bought, lags as weeks since the last purchase) on blocks of
+shoppers with array operations. The negative samples are drawn from another random stream than random.sample of module_negatives.
+
+Prerequisite:
+* none (derive_inputs: baskets.parquet and coupons.parquet, e.g. from generate_synthetic_data)
+
+Layout on disk:
+    <path>/baskets.parquet (week, shopper, product, price), <path>/coupons.parquet (week, shopper, product, discount)
+    <path>/product_categories.csv (product, category_label), <path>/synthetic_data.json (parameters and summary)
+    derive_inputs: <path>/df_negative_samples.parquet, lags.parquet, purchase_temporal_distribution.parquet, avg_no_weeks_between_two_purchases.parquet
+"""
+
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import module_lags
+from module_profiling import stage
+
+#discounts of the coupons of the raw data in percent
+SYNTHETIC_DISCOUNTS = [10, 15, 20, 25, 30, 35, 40]
+
+
+def _append(writers, filename, frame):
+    """
+    appends the DataFrame as a row group to the parquet file; the file is written to filename.tmp until _close renames it
+    """
+    table = pa.Table.from_pandas(frame, preserve_index = False)
+    if filename not in writers:
+        writers[filename] = pq.ParquetWriter(filename + '.tmp', table.schema)
+    writers[filename].write_table(table)
+
+
+def _close(writers, replace = True):
+    """
+    closes the writers of _append and moves the files to their final names
+    """
+    for filename, writer in writers.items():
+        writer.close()
+        if replace:
+            os.replace(filename + '.tmp', filename)
+
+
+def _top_k(keys, size):
+    """
+    returns a boolean matrix with the size[i] largest keys of every row i
+    """
+    chosen = np.zeros(keys.shape, dtype = bool)
+    max_size = int(size.max()) if len(size) else 0
+    if max_size == 0:
+        return chosen
+    top = np.argpartition(-keys, max_size - 1, axis = 1)[:, :max_size]
+    top = np.take_along_axis(top, np.argsort(-np.take_along_axis(keys, top, axis = 1), axis = 1), axis = 1)
+    np.put_along_axis(chosen, top, np.arange(max_size) < size[:, None], axis = 1)
+    return chosen
+
+
+def _shopper_blocks(no_shoppers, block_size):
+    return [(first, min(first + block_size, no_shoppers)) for first in range(0, no_shoppers, block_size)]
+
+
+@stage()
+def generate_synthetic_data(path, no_shoppers = 2000, no_products = 250, no_weeks = 90, no_coupons = 5, mean_basket_size = 7.65,
+                            discounts = SYNTHETIC_DISCOUNTS, coupon_effect = 2.0, no_categories = 25, seed = 0, block_size = 10000, derive = True):
+
+    """
+    input:
+        path: directory the data sets are written to (created if needed)
+        no_shoppers: default = 2000, number of shoppers (ids 0..no_shoppers-1)
+        no_products: default = 250, number of products
+        no_weeks: default = 90, number of observed weeks (0..no_weeks-1); the week no_weeks is the week to predict
+        no_coupons: default = 5, coupons per shopper and week
+        mean_basket_size: default = 7.65, mean number of products per basket
+        discounts: default = SYNTHETIC_DISCOUNTS, discounts of the coupons in percent (equally likely)
+        coupon_effect: default = 2.0, log factor of the purchase probability of a product with a 100% coupon
+        no_categories: default = 25, number of latent product categories
+        seed: default = 0, seed of the random numbers; the data is the same for the same parameters
+        block_size: default = 10000, shoppers that are generated at the same time
+        derive: default = True, whether to write the created data sets with derive_inputs as well
+    output:
+        summary: dict with the parameters, rows, mean_basket_size, coupon_redemption_rate and seconds
+    """
+
+    start = time.time()
+    os.makedirs(path, exist_ok = True)
+    rng = np.random.default_rng(seed)
+    regular_price = rng.integers(400, 801, no_products)
+    category = rng.integers(0, no_categories, no_products)
+    discounts = np.asarray(discounts)
+    blocks = _shopper_blocks(no_shoppers, block_size)
+
+    #log preferences: every shopper prefers a few categories and within them a few products
+    preference = []
+    for first, last in blocks:
+        affinity = rng.gamma(0.3, 1.0, (last - first, no_categories))[:, category]
+        preference.append(np.log(affinity * rng.random((last - first, no_products)) ** 4 + 1e-12).astype(np.float32))
+
+    counts = {'baskets': 0, 'coupons': 0, 'redeemed': 0}
+    writers = {}
+    try:
+        #one row group per week; within a week the rows are sorted by shopper and product
+        for week in range(no_weeks):
+            week_rng = np.random.default_rng([seed, week])
+            baskets, coupons = [], []
+            for (first, last), log_preference in zip(blocks, preference):
+                size = last - first
+                #coupons: no_coupons distinct products per shopper
+                coupon_product = np.argpartition(week_rng.random((size, no_products), dtype = np.float32), no_coupons - 1, axis = 1)[:, :no_coupons]
+                discount = np.zeros((size, no_products), dtype = np.int64)
+                np.put_along_axis(discount, coupon_product, week_rng.choice(discounts, (size, no_coupons)), axis = 1)
+                #baskets: products drawn without replacement proportional to the preferences and the coupon effect (Gumbel top-k)
+                keys = log_preference + np.float32(coupon_effect / 100) * discount + week_rng.gumbel(size = (size, no_products)).astype(np.float32)
+                bought = _top_k(keys, np.minimum(1 + week_rng.poisson(mean_basket_size - 1, size), no_products))
+
+                shopper, product = np.nonzero(bought)
+                price = np.round(regular_price[product] * (1 - discount[shopper, product] / 100)).astype(np.int64)
+                baskets.append(pd.DataFrame({'week': week, 'shopper': shopper + first, 'product': product, 'price': price}))
+                shopper, product = np.nonzero(discount)
+                coupons.append(pd.DataFrame({'week': week, 'shopper': shopper + first, 'product': product, 'discount': discount[shopper, product]}))
+                counts['redeemed'] += int((bought & (discount > 0)).sum())
+            for name, tables in [('baskets', baskets), ('coupons', coupons)]:
+                table = pd.concat(tables, ignore_index = True)
+                table['week'] = table['week'].astype(np.int64)
+                counts[name] += len(table)
+                _append(writers, os.path.join(path, name + '.parquet'), table)
+    except BaseException:
+        _close(writers, replace = False)
+        raise
+    _close(writers)
+    pd.DataFrame({'product': np.arange(no_products), 'category_label': category}).to_csv(os.path.join(path, 'product_categories.csv'), index = False)
+
+    summary = {'no_shoppers': no_shoppers, 'no_products': no_products, 'no_weeks': no_weeks, 'no_coupons': no_coupons,
+               'discounts': [int(discount) for discount in discounts], 'coupon_effect': coupon_effect, 'no_categories': no_categories, 'seed': seed,
+               'basket_rows': counts['baskets'], 'coupon_rows': counts['coupons'],
+               'mean_basket_size': counts['baskets'] / max(no_shoppers * no_weeks, 1),
+               'coupon_redemption_rate': counts['redeemed'] / max(counts['coupons'], 1)}
+    print('Generated %d basket rows and %d coupon rows for %d shoppers in %.2f seconds (mean basket size %.2f, coupon redemption rate %.3f)'
+          % (counts['baskets'], counts['coupons'], no_shoppers, time.time() - start, summary['mean_basket_size'], summary['coupon_redemption_rate']))
+
+    if derive:
+        summary['derived'] = derive_inputs(path, no_shoppers = no_shoppers, no_products = no_products, seed = seed)
+    summary['seconds'] = time.time() - start
+    with open(os.path.join(path, 'synthetic_data.json'), 'w') as file:
+        json.dump(summary, file, indent = 2)
+    return summary
+
+
+def _max_value(filename, column):
+    """
+    returns the max. value of an integer column of a parquet file from the row group statistics
+    """
+    metadata = pq.ParquetFile(filename).metadata
+    idx = metadata.schema.names.index(column)
+    return max(metadata.row_group(group).column(idx).statistics.max for group in range(metadata.num_row_groups))
+
+
+@stage()
+def derive_inputs(path, no_shoppers = None, no_products = None, min_frequency = 3, seed = 0, block_size = 2500):
+
+    """
+    input:
+        path: path to baskets.parquet and coupons.parquet; the created data sets are written to the same path
+        no_shoppers: default = None (all shoppers), only the shoppers 0..no_shoppers-1 are used (the notebook uses 2000)
+        no_products: default = None (max. product id + 1), number of products
+        min_frequency: default = 3, min. number of purchases of a product before the last week to count as preference (module_negatives)
+        seed: default = 0, seed of the negative samples
+        block_size: default = 2500, shoppers that are processed at the same time
+    output:
+        summary: dict with the rows of the created data sets and seconds
+    """
+
+    start = time.time()
+    baskets_file, coupons_file = os.path.join(path, 'baskets.parquet'), os.path.join(path, 'coupons.parquet')
+    no_shoppers = no_shoppers or int(max(_max_value(baskets_file, 'shopper'), _max_value(coupons_file, 'shopper'))) + 1
+    no_products = no_products or int(max(_max_value(baskets_file, 'product'), _max_value(coupons_file, 'product'))) + 1
+    #the last observed week is left out of the preferences; the week after it is the week to predict (week 89 and week 90 of the notebook)
+    last_week = int(_max_value(baskets_file, 'week'))
+    target_week = last_week + 1
+    lag_calculator = module_lags.LagCalculator(None)
+
+    rows = {'df_negative_samples': 0, 'lags': 0, 'purchase_temporal_distribution': 0, 'avg_no_weeks_between_two_purchases': 0}
+    writers = {}
+    try:
+        for first, last in _shopper_blocks(no_shoppers, block_size):
+            size = last - first
+            filters = [('shopper', '>=', first), ('shopper', '<', last)]
+            baskets = pd.read_parquet(baskets_file, columns = ['week', 'shopper', 'product'], filters = filters)
+            coupons = pd.read_parquet(coupons_file, columns = ['week', 'shopper', 'product'], filters = filters)
+            week, shopper, product = [baskets[column].values.astype(np.int64) for column in ['week', 'shopper', 'product']]
+            shopper = shopper - first
+
+            #PREFERENCES: products bought at least min_frequency times before the last week
+            history = week < last_week
+            frequency = np.bincount(shopper[history] * no_products + product[history], minlength = size * no_products).reshape(size, no_products)
+            preferred = frequency >= min_frequency
+
+            #NEGATIVE SAMPLES: per basket as many preferred products as the basket has products, drawn from the preferred products not bought
+            negative_rng = np.random.default_rng([seed, first])
+            order = np.argsort(week, kind = 'stable')
+            bounds = np.searchsorted(week[order], np.arange(target_week + 1))
+            negatives = []
+            for idx in range(target_week):
+                rows_of_week = order[bounds[idx]:bounds[idx + 1]]
+                bought = np.zeros((size, no_products), dtype = bool)
+                bought[shopper[rows_of_week], product[rows_of_week]] = True
+                candidates = preferred & ~bought
+                no_samples = np.minimum(candidates.sum(axis = 1), bought.sum(axis = 1))
+                sampled = _top_k(np.where(candidates, negative_rng.random((size, no_products)), -1.0), no_samples)
+                sample_shopper, sample_product = np.nonzero(sampled)
+                negatives.append(pd.DataFrame({'week': np.full(len(sample_shopper), idx, dtype = np.int64), 'shopper': sample_shopper + first,
+                                               'product': sample_product, 'product_bought': 0}))
+            negatives = pd.concat(negatives, ignore_index = True)
+
+            #LAGS: rows of the baskets, the coupons and the preferred products in the target week, sorted by shopper, product and week
+            key = lambda shopper, product, week: (shopper * no_products + product) * (target_week + 1) + week
+            bought_keys = np.sort(key(shopper, product, week))
+            preferred_shopper, preferred_product = np.nonzero(preferred)
+            keys = np.concatenate([bought_keys, key(coupons['shopper'].values.astype(np.int64) - first, coupons['product'].values.astype(np.int64),
+                                                     coupons['week'].values.astype(np.int64)),
+                                   key(preferred_shopper, preferred_product, np.full(len(preferred_shopper), target_week, dtype = np.int64))])
+            keys = np.sort(keys)
+            keys = keys[np.r_[True, keys[1:] != keys[:-1]]]
+            is_bought = np.isin(keys, bought_keys, assume_unique = True)
+            pair, lag_week = keys // (target_week + 1), keys % (target_week + 1)
+            #last purchase week up to every row: running max within the shopper x product pair (pair offsets keep the pairs apart)
+            offset = pair * (target_week + 2)
+            last_purchase = np.maximum.accumulate(offset + np.where(is_bought, lag_week + 1, 0)) - offset - 1
+            #the lag of a row is measured to the last purchase before the row
+            previous = np.r_[-1, last_purchase[:-1]]
+            previous[np.r_[True, pair[1:] != pair[:-1]]] = -1
+            lags = pd.DataFrame({'shopper': pair // no_products + first, 'product': pair % no_products, 'week': lag_week.astype(np.int32),
+                                 'product_bought': np.where(lag_week == target_week, np.nan, is_bought.astype(np.float64)),
+                                 'lag_weeks_of_product_per_customer': np.where(previous >= 0, lag_week - previous, -1)})
+
+            tables = {'df_negative_samples': negatives, 'lags': lags,
+                      'purchase_temporal_distribution': lag_calculator.calculate_purchase_temporal_distribution(lags, max_week = last_week),
+                      'avg_no_weeks_between_two_purchases': lag_calculator.calculate_avg_no_weeks_between_two_purchases(lags, max_week = last_week)}
+            for name, table in tables.items():
+                rows[name] += len(table)
+                _append(writers, os.path.join(path, name + '.parquet'), table)
+    except BaseException:
+        _close(writers, replace = False)
+        raise
+    _close(writers)
+
+    print('Derived %d negative samples and %d lag rows for %d shoppers in %.2f seconds'
+          % (rows['df_negative_samples'], rows['lags'], no_shoppers, time.time() - start))
+    return dict(rows, seconds = time.time() - start)
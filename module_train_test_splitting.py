@@ -1,15 +1,157 @@
 """
 The purpose of this module is to:
     * split the generated train and test set into appropriate training and testing sets for tuning the model
+    * return the sets as C-contiguous float32 matrices together with the feature names and the indices of the categorical features
+    * materialize a split once as .npy files that are memory-mapped read-only, so several processes share one copy (materialize_split, load_split)
     
 Prerequisite: 
-    * A feature-engineered train and test set is needed as an input, e.g. output from module_generate data set
+    * A feature-engineered train and test set is needed as an input, e.g. output from module_generate data set or the 'train' and 'test' windows of module_feature_store
 """
 
 #load libraries
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
 import pandas as pd
 
-def train_test_splitting(path, train_start, train_end, test_start, test_end, eval_set = False):
+import module_feature_store
+from module_profiling import stage
+
+#target variable
+TARGET = 'product_bought'
+#removed from the data sets besides the target variable; among others, reasons are target leakage and non-reproducibility for week 90
+DROP_COLUMNS = ['shopper', 'product', 'purchase_w/o_dis', 'no_purchase_w_dis', 'discount_effect', 'week_basket_size', 'week_basket_value', 'discount_offered']
+#features in the column order of the engineered data sets
+FEATURE_COLUMNS = [column for column in module_feature_store.TRAIN_COLUMNS if column not in DROP_COLUMNS + [TARGET]]
+#week stays numerical: the testing and scoring weeks never occur in the training set, so as a category it could not generalize
+CATEGORICAL_FEATURES = ['category_label']
+
+
+def to_matrix(frame, columns = FEATURE_COLUMNS, mask = None, dtype = np.float32):
+    
+    """
+    input: 
+        frame: DataFrame that contains the columns
+        columns: default = FEATURE_COLUMNS, columns (in this order) of the matrix
+        mask: default = None, boolean np.ndarray selecting the rows
+        dtype: default = np.float32
+    output: 
+        C-contiguous np.ndarray rows x columns; it is filled column by column, so the frame is never converted as a whole (object-dtype copy)
+    """
+    
+    no_rows = len(frame) if mask is None else int(mask.sum())
+    matrix = np.empty((no_rows, len(columns)), dtype = dtype)
+    for idx, column in enumerate(columns):
+        values = frame[column].values
+        matrix[:, idx] = values if mask is None else values[mask]
+    return matrix
+
+
+def _data_version(path, feature_store):
+    """
+    returns the version of the engineered data a split is taken from (name, size and modification time of the files)
+    """
+    if feature_store:
+        files = [os.path.join(path, 'feature_store', name, 'manifest.json') for name in _store_names(feature_store)]
+    else:
+        files = [path + '/train_s2000_final.parquet', path + '/test_s2000_final.parquet']
+    return [[os.path.basename(os.path.dirname(file)) + '/' + os.path.basename(file), os.stat(file).st_size, int(os.stat(file).st_mtime)] for file in files]
+
+
+def _store_names(feature_store):
+    """
+    returns the names of the train and the test window of module_feature_store: 'train' and 'test' or the given pair
+    """
+    return ('train', 'test') if feature_store is True else tuple(feature_store)
+
+
+def split_key(path, train_start, train_end, test_start, test_end, eval_set = False, feature_store = False):
+    
+    """
+    input: 
+        see train_test_splitting
+    output: 
+        key: hex digest identifying the feature schema, the split weeks and the version of the engineered data
+    """
+    
+    definition = {
+        'features': FEATURE_COLUMNS,
+        'categorical': CATEGORICAL_FEATURES,
+        'split': [train_start, train_end, test_start, test_end, bool(eval_set)],
+        'data': _data_version(path, feature_store),
+    }
+    return hashlib.sha1(json.dumps(definition, sort_keys = True).encode()).hexdigest()[:16]
+
+
+@stage()
+def materialize_split(path, train_start, train_end, test_start, test_end, eval_set = False, feature_store = False, directory = None):
+    
+    """
+    input: 
+        path, train_start, train_end, test_start, test_end, eval_set, feature_store: see train_test_splitting
+        directory: default = None (path/split_cache/<split_key>), directory of the .npy files
+    output: 
+        directory with X_<set>.npy (features), y_<set>.npy (labels), week_<set>.npy (week index) per set and schema.json;
+        an existing split is not written again
+    """
+    
+    directory = directory or os.path.join(path, 'split_cache', split_key(path, train_start, train_end, test_start, test_end, eval_set, feature_store))
+    if os.path.exists(os.path.join(directory, 'schema.json')):
+        return directory
+    
+    split = train_test_splitting(path, train_start, train_end, test_start, test_end, eval_set = eval_set, feature_store = feature_store, return_schema = True)
+    if eval_set:
+        X_train, X_test, X_eval, y_train, y_eval, y_test, feature_names, categorical_features = split
+        sets = {'train': (X_train, y_train), 'eval': (X_eval, y_eval), 'test': (X_test, y_test)}
+    else:
+        X_train, X_test, y_train, y_test, feature_names, categorical_features = split
+        sets = {'train': (X_train, y_train), 'test': (X_test, y_test)}
+    del split
+    
+    #written to a temporary directory first, so that a concurrent reader never sees a partial split
+    tmp_directory = directory + '.tmp%d' % os.getpid()
+    os.makedirs(tmp_directory, exist_ok = True)
+    for name, (X, y) in sets.items():
+        np.save(os.path.join(tmp_directory, 'X_%s.npy' % name), X)
+        np.save(os.path.join(tmp_directory, 'y_%s.npy' % name), y.astype(np.float32))
+        np.save(os.path.join(tmp_directory, 'week_%s.npy' % name), X[:, FEATURE_COLUMNS.index('week')].astype(np.int16))
+    with open(os.path.join(tmp_directory, 'schema.json'), 'w') as file:
+        json.dump({'sets': list(sets), 'feature_names': feature_names, 'categorical_features': categorical_features,
+                   'split': [train_start, train_end, test_start, test_end], 'rows': {name: len(X) for name, (X, y) in sets.items()}}, file, indent = 2)
+    try:
+        os.rename(tmp_directory, directory)
+    except OSError:
+        #another process materialized the same split in the meantime
+        shutil.rmtree(tmp_directory)
+    
+    print('The split is materialized to: ' + directory)
+    
+    return directory
+
+
+def load_split(directory, mmap_mode = 'r'):
+    
+    """
+    input: 
+        directory: output of materialize_split
+        mmap_mode: default = 'r', memory-mapping mode of np.load; read-only maps share the same pages between processes (None = load into memory)
+    output: 
+        sets: dict set name ('train', 'test', optional 'eval') -> (X, y, week)
+        schema: dict with feature_names, categorical_features, split and rows
+    """
+    
+    with open(os.path.join(directory, 'schema.json')) as file:
+        schema = json.load(file)
+    sets = {}
+    for name in schema['sets']:
+        sets[name] = tuple(np.load(os.path.join(directory, '%s_%s.npy' % (array, name)), mmap_mode = mmap_mode) for array in ['X', 'y', 'week'])
+    return sets, schema
+
+
+@stage()
+def train_test_splitting(path, train_start, train_end, test_start, test_end, eval_set = False, feature_store = False, return_schema = False, mmap = False):
     
     """
     input:  
@@ -19,67 +161,71 @@ def train_test_splitting(path, train_start, train_end, test_start, test_end, eva
         test_start: lower boundary (week) of the testing set
         test_end: upper boundary (week) of the testing set
         eval_set: default = False, whether to generate also an evaluation set or not
+        feature_store: default = False, whether to assemble the train and test set from module_feature_store instead of reading the wide parquet files;
+                       True takes the windows 'train' and 'test', a pair of names other windows (e.g. the folds of module_cross_validation)
+        return_schema: default = False, whether to return also the feature names and the indices of the categorical features (e.g. for predict_lightgbm)
+        mmap: default = False, whether to return read-only memory maps of the split that is materialized once with materialize_split
     output: 
-        X_train: training set without target variable
+        X_train: training set without target variable (C-contiguous float32 matrix with the columns FEATURE_COLUMNS)
         X_test: testing set without target variable
         y_train: training set containing only target variable
         y_test: testing set containing only target variable
-        optional: X_eval, y_test
+        optional: X_eval, y_eval
+        optional: feature_names, categorical_features
     """
-        
-    #takes data sets that are created by the module 'module_generate_dataset.py'
-    train = pd.read_parquet(path + '/train_s2000_final.parquet')
-    test = pd.read_parquet(path + '/test_s2000_final.parquet')
     
     print('The following features will be removed from the data sets (besides the target variable product_bought): \nshopper, \nproduct, \npurchase_w/o_dis, \nno_purchase_w_dis, \ndiscount_offered, \ndiscount_effect, \nweek_basket_size and \nweek_basket_value. \nAmong others, reasons are target leakage and non-reproducibility for week 90.')
-
+    
+    if mmap:
+        sets, schema = load_split(materialize_split(path, train_start, train_end, test_start, test_end, eval_set, feature_store))
+        X_train, y_train, _ = sets['train']
+        X_test, y_test, _ = sets['test']
+        if eval_set:
+            X_eval, y_eval, _ = sets['eval']
+    
+    else:
+        if feature_store:
+            #takes the grain tables that are created by the module 'module_feature_store.py'; only the needed columns are gathered
+            train, test = [module_feature_store.FeatureStore(path, name) for name in _store_names(feature_store)]
+            split = lambda store, first, last: (store.matrix(FEATURE_COLUMNS, first, last), store.matrix([TARGET], first, last).reshape(-1))
+        else:
+            #takes data sets that are created by the module 'module_generate_dataset.py'; only the needed columns are read
+            train = pd.read_parquet(path + '/train_s2000_final.parquet', columns = FEATURE_COLUMNS + [TARGET])
+            test = pd.read_parquet(path + '/test_s2000_final.parquet', columns = FEATURE_COLUMNS + [TARGET])
+            def split(frame, first, last):
+                mask = ((frame['week'] >= first) & (frame['week'] <= last)).values
+                return to_matrix(frame, mask = mask), to_matrix(frame, [TARGET], mask).reshape(-1)
+    
+        X_train, y_train = split(train, train_start, train_end)
+        X_test, y_test = split(test, test_start, test_end)
+        if eval_set:
+            X_eval, y_eval = split(test, train_end + 1, test_start - 1)
+    
+    print('Training Observations: %d' % (len(X_train)))
+    if eval_set:
+        print('Evaluation Observations: %d' % (len(X_eval)))
+    print('Testing Observations: %d' % (len(X_test)))
+    print('Observations: %d' % (len(X_train) + len(X_test) + (len(X_eval) if eval_set else 0)))
+    
+    for matrix in [X_train, X_test] + ([X_eval] if eval_set else []):
+        assert matrix.dtype == np.float32 and matrix.flags['C_CONTIGUOUS']
+        assert matrix.shape[1] == len(FEATURE_COLUMNS)
+    
+    feature_names = list(FEATURE_COLUMNS)
+    categorical_features = [FEATURE_COLUMNS.index(column) for column in CATEGORICAL_FEATURES]
+    
     if eval_set:
-        train = train[(train['week'] >= train_start) & (train['week'] <= train_end)]
-        evaluation = test[(test['week'] > train_end) & (test['week'] < test_start)]
-        test = test[(test['week'] >= test_start) & (test['week'] <= test_end)]
-    
-        print('Training Observations: %d' % (len(train)))
-        print('Evaluation Observations: %d' % (len(evaluation)))
-        print('Testing Observations: %d' % (len(test)))
-        print('Observations: %d' % (len(train) + len(test) + len(evaluation)))
-        
-        train['week'] = train['week'].astype('category')
-        train['category_label'] = train['category_label'].astype('category')
-        evaluation['week'] = evaluation['week'].astype('category')
-        evaluation['category_label'] = evaluation['category_label'].astype('category')
-        test['week'] = test['week'].astype('category')
-        test['category_label'] = test['category_label'].astype('category')
-        
-        X_train = train.drop(['product_bought', 'shopper', 'product', 'purchase_w/o_dis', 'no_purchase_w_dis', 'discount_effect', 'week_basket_size', 'week_basket_value', 'discount_offered'], axis = 1).values
-        X_eval = evaluation.drop(['product_bought', 'shopper', 'product', 'purchase_w/o_dis', 'no_purchase_w_dis', 'discount_effect', 'week_basket_size', 'week_basket_value', 'discount_offered'], axis = 1).values
-        X_test = test.drop(['product_bought', 'shopper', 'product', 'purchase_w/o_dis', 'no_purchase_w_dis', 'discount_effect', 'week_basket_size', 'week_basket_value', 'discount_offered'], axis = 1).values 
-
-        y_train, y_eval, y_test = train[['product_bought']].values.reshape(-1), evaluation[['product_bought']].values.reshape(-1), test[['product_bought']].values.reshape(-1)
-        
         #should results in the number of X or y data set. Here: 3 - train, eval, test
         assert (len(X_train)/len(y_train)) + (len(X_eval)/len(y_eval)) + (len(X_test)/len(y_test)) == 3
         
+        if return_schema:
+            return X_train, X_test, X_eval, y_train, y_eval, y_test, feature_names, categorical_features
         return X_train, X_test, X_eval, y_train, y_eval, y_test
     
     else:
-        train = train[(train['week'] >= train_start) & (train['week'] <= train_end)]
-        test = test[(test['week'] >= test_start) & (test['week'] <= test_end)]
-    
-        print('Training Observations: %d' % (len(train)))
-        print('Testing Observations: %d' % (len(test)))
-        print('Observations: %d' % (len(train) + len(test)))
-        
-        train['week'] = train['week'].astype('category')
-        train['category_label'] = train['category_label'].astype('category')
-        test['week'] = test['week'].astype('category')
-        test['category_label'] = test['category_label'].astype('category')
-        
-        X_train = train.drop(['product_bought', 'shopper', 'product', 'purchase_w/o_dis', 'no_purchase_w_dis', 'discount_effect', 'week_basket_size', 'week_basket_value', 'discount_offered'], axis = 1).values
-        X_test = test.drop(['product_bought', 'shopper', 'product', 'purchase_w/o_dis', 'no_purchase_w_dis', 'discount_effect', 'week_basket_size', 'week_basket_value', 'discount_offered'], axis = 1).values 
-
-        y_train, y_test = train[['product_bought']].values.reshape(-1), test[['product_bought']].values.reshape(-1)
-        
-        #should results in the number of X or y data set. Here: 2 - train, eval, test
+        #should results in the number of X or y data set. Here: 2 - train, test
         assert (len(X_train)/len(y_train)) + (len(X_test)/len(y_test)) == 2
         
-        return X_train, X_test, y_train, y_test
\ No newline at end of file
+        if return_schema:
+            return X_train, X_test, y_train, y_test, feature_names, categorical_features
+        return X_train, X_test, y_train, y_test
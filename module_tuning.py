@@ -0,0 +1,140 @@
+"""
+The purpose of this module is to:
+* tune the lightGBM of module_lightgbm with a parallel successive halving search over the boosting rounds
+* log the parameters, metrics and timing of every trial to a results table
+
+All trials of a search share one prepared dataset (module_dataset_cache): the trials run on a thread pool and use the same constructed
+lgbm.Dataset. LightGBM releases the GIL while it trains, so the threads train in parallel, and every surviving trial continues its booster
+in the next rung instead of being retrained from scratch.
+
+Successive halving: every trial is trained for min_rounds boosting rounds, only the best 1/eta trials (by the metric on the testing set)
+are trained further for eta times as many rounds, and so on until max_rounds.
+
+Prerequisite:
+* A feature-engineered train and test set (module_generate_dataset) or the 'train' and 'test' windows of module_feature_store
+"""
+
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import lightgbm as lgbm
+import pandas as pd
+
+import module_dataset_cache
+from module_lightgbm import lightgbm_params
+from module_profiling import stage
+
+#subsample only takes effect with subsample_freq > 0 (as in LGBMClassifier), so bagging is switched on for the search
+SEARCH_PARAMS = {'subsample_freq': 1}
+
+#metrics that are better when higher
+_HIGHER_IS_BETTER = {'auc': True, 'binary_logloss': False}
+
+#constructing a booster updates the parameters of the shared datasets, so only one thread may do so at a time
+_booster_lock = threading.Lock()
+
+
+def _expand_grid(param_grid):
+    """
+    returns a list of parameter dicts from a dict name -> list of values (all combinations) or a list of parameter dicts
+    """
+    if isinstance(param_grid, dict):
+        names = list(param_grid)
+        return [dict(zip(names, values)) for values in itertools.product(*[param_grid[name] for name in names])]
+    return [dict(params) for params in param_grid]
+
+
+def _new_booster(datasets, params):
+    with _booster_lock:
+        booster = lgbm.Booster(params = params, train_set = datasets['train'])
+        booster.add_valid(datasets['test'], 'testing')
+    return booster
+
+
+def _advance(booster, rounds):
+    """
+    trains the booster for the given number of further boosting rounds and returns its metrics on the testing set
+    """
+    for _ in range(rounds):
+        #update returns True if no further split can be made
+        if booster.update():
+            break
+    return {name: value for _, name, value, _ in booster.eval_valid()}
+
+
+@stage()
+def successive_halving(path, train_start, train_end, test_start, test_end, param_grid, min_rounds = 25, max_rounds = 300, eta = 3, metric = 'auc',
+                       n_jobs = None, feature_store = False, results_file = None):
+
+    """
+    input:
+        path, train_start, train_end, test_start, test_end, feature_store: see module_train_test_splitting.train_test_splitting
+        param_grid: dict parameter -> list of values (e.g. num_leaves, learning_rate, reg_lambda, subsample) or list of parameter dicts
+        min_rounds: default = 25, boosting rounds of the first rung
+        max_rounds: default = 300, boosting rounds of the last rung
+        eta: default = 3, only the best 1/eta trials of a rung are promoted and they are trained eta times as long
+        metric: default = 'auc', metric on the testing set that ranks the trials ('auc' or 'binary_logloss')
+        n_jobs: default = None (min(number of trials, number of cores)), number of concurrent trials; the cores are split evenly between them
+        results_file: default = None (path/tuning_results.csv), csv file the results table is written to
+    output:
+        results: DataFrame with one row per trial and rung: trial, rung, rounds, parameters, auc, binary_logloss, seconds, status
+    """
+
+    trials = _expand_grid(param_grid)
+    #the datasets are prepared once for all trials
+    datasets = module_dataset_cache.load_datasets(path, train_start, train_end, test_start, test_end, feature_store = feature_store)
+
+    cores = os.cpu_count() or 1
+    n_jobs = n_jobs or min(len(trials), cores)
+    threads_per_trial = max(1, cores // n_jobs)
+    params = [lightgbm_params(**dict(SEARCH_PARAMS, num_threads = threads_per_trial, **trial)) for trial in trials]
+
+    rungs = []
+    rounds = min_rounds
+    while rounds < max_rounds:
+        rungs.append(rounds)
+        rounds *= eta
+    rungs.append(max_rounds)
+
+    print('Successive halving: %d trials, rungs %s, %d concurrent trials with %d threads each' % (len(trials), rungs, n_jobs, threads_per_trial))
+
+    start = time.time()
+    boosters = {}
+    results = []
+    alive = list(range(len(trials)))
+    with ThreadPoolExecutor(n_jobs) as executor:
+        done_rounds = 0
+        for rung, rounds in enumerate(rungs):
+            def run(trial, rounds = rounds, done_rounds = done_rounds):
+                trial_start = time.time()
+                if trial not in boosters:
+                    boosters[trial] = _new_booster(datasets, params[trial])
+                return _advance(boosters[trial], rounds - done_rounds), time.time() - trial_start
+            futures = {trial: executor.submit(run, trial) for trial in alive}
+
+            scores = {}
+            for trial, future in futures.items():
+                metrics, seconds = future.result()
+                scores[trial] = metrics[metric]
+                results.append(dict(trial = trial, rung = rung, rounds = rounds, **trials[trial], **metrics, seconds = seconds, status = 'stopped'))
+
+            ranking = sorted(alive, key = lambda trial: scores[trial], reverse = _HIGHER_IS_BETTER[metric])
+            alive = ranking[:max(1, len(ranking) // eta)] if rung < len(rungs) - 1 else ranking[:1]
+            for row in results[-len(futures):]:
+                if row['trial'] in alive:
+                    row['status'] = 'promoted' if rung < len(rungs) - 1 else 'best'
+            for trial in list(boosters):
+                if trial not in alive:
+                    del boosters[trial]
+            done_rounds = rounds
+
+            print('Rung %d (%d rounds): best %s = %.5f (trial %d)' % (rung, rounds, metric, scores[ranking[0]], ranking[0]))
+
+    results = pd.DataFrame(results)
+    results.to_csv(results_file or os.path.join(path, 'tuning_results.csv'), index = False)
+
+    print('\nThe search took %.2f minutes. Best parameters: %s' % ((time.time() - start) / 60, trials[alive[0]]))
+
+    return results
@@ -1,6 +1,7 @@
 """
 The purpose of this module is to:
 * generate a dataset that can be used for the prediction for week90
+* generate the same dataset for any target week t+1 from cached as-of aggregates (build_scoring_set)
 
 In order to achieve this, the same feature engineering is applied as for the construction of the train and test set
 
@@ -15,16 +16,33 @@ Prerequisite:
 import pandas as pd
 import numpy as np
 
-def week90_generate_dataset(path):
+import module_candidates
+import module_feature_store
+from module_profiling import stage
+
+#column order of the week 90 data set
+WEEK90_COLUMNS = ['shopper', 'product', 'week', 'product_bought', 'lag_weeks_of_product_per_customer', 'category_label', 'avg_no_weeks_between_two_purchases',
+                  'purchase_temporal_distribution', 'max_price', 'min_price', 'no_products_bought', 'spend_per_customer', 'no_unique_products',
+                  'discount_purchase', 'product_sells', 'product_dis_sells', 'product_dis_sells_share', 'no_products_bought_per_product',
+                  'customer_prod_dis_purchases', 'customer_prod_bought_dis_share', 'customer_prod_dis_offers', 'customer_prod_dis_offered_share',
+                  'customer_product_share', 'customer_mean_product_price', 'customer_discount_buy_share', 'mean_basket_size', 'mean_basket_value']
+
+@stage()
+def week90_generate_dataset(path, feature_store = False):
     
     """
     input: 
         path: path to datasets -> outputted data set is also saved as /week90_s2000_final.parquet to this path
+        feature_store: default = False, whether to gather the aggregates from the 'week90' window of module_feature_store
+                       (see build_feature_store) instead of recomputing them over all history
     output: 
         week90: dataset for week90 
     
     """
     
+    if feature_store:
+        return week90_from_feature_store(path)
+    
     print('The dataframes should be named: \nbaskets.parquet, \ncoupons.parquet, \ndf_negative_samples.parquet, \nproduct_categories.csv, \navg_no_weeks_between_two_purchases.parquet, \nlags.parquet and \npurchase_temporal_distribution.parquet')
     
     'Load Data Sets'
@@ -213,4 +231,171 @@ def week90_generate_dataset(path):
     
     week90 = week90.reset_index(drop = True)
     
-    return week90
\ No newline at end of file
+    return week90
+
+
+@stage()
+def week90_from_feature_store(path, name = 'week90'):
+    
+    """
+    input: 
+        path: path to datasets; the feature store has to be built before with module_feature_store.build_feature_store
+        name: default = 'week90', name of the feature window covering weeks 0-89
+    output: 
+        week90: dataset for week90 with the same 27 columns as week90_generate_dataset
+    
+    """
+    
+    'Load Data Sets'
+    lags = pd.read_parquet(path + '/lags.parquet')
+    week90 = lags[lags['week'] == 90].reset_index(drop = True)
+    
+    store = module_feature_store.FeatureStore(path, name).load(grains = ['shopper', 'product', 'shopper_product'])
+    assert store.manifest['end'] == 89
+    
+    'Gather Features'
+    week90 = gather_scoring_set(store, week90, 90)
+    
+    'Unit Test Block'
+    assert week90['shopper'].nunique() == 2000
+    assert len(list(week90.columns)) == 27
+    #all product_bought rows should be NaN but nothing else 
+    assert week90.isna().sum().sum() == week90.shape[0]
+    
+    'Store data'
+    week90.sort_values(by = ['week', 'shopper', 'product'], inplace = True)
+    week90.to_parquet(path + '/week90_s2000_final.parquet')
+    
+    print('\nThe data set for week 90 is generated from the feature store and saved as a parquet file to: ' + path)
+    
+    week90 = week90.reset_index(drop = True)
+    
+    return week90
+
+
+def gather_scoring_set(store, candidates, target_week):
+    
+    """
+    input: 
+        store: loaded module_feature_store.FeatureStore whose window ends with week target_week - 1
+        candidates: DataFrame with the shopper x product pairs to score (optional: lag_weeks_of_product_per_customer)
+        target_week: week the pairs are scored for
+    output: 
+        scoring set with the 27 columns of week90_generate_dataset
+    
+    """
+    
+    scoring = pd.DataFrame({'shopper': candidates['shopper'].values, 'product': candidates['product'].values})
+    scoring['week'] = target_week
+    scoring['product_bought'] = np.nan
+    
+    features = [column for column in WEEK90_COLUMNS if column not in scoring.columns and column != 'lag_weeks_of_product_per_customer']
+    gathered = store.gather(scoring['week'].values, scoring['shopper'].values, scoring['product'].values, features + ['last_purchase_week'])
+    
+    #number of weeks since the last purchase before the target week; -1 if the product was never bought (see module_lags)
+    if 'lag_weeks_of_product_per_customer' in candidates.columns:
+        scoring['lag_weeks_of_product_per_customer'] = candidates['lag_weeks_of_product_per_customer'].values
+    else:
+        last_purchase_week = gathered['last_purchase_week']
+        scoring['lag_weeks_of_product_per_customer'] = np.where(last_purchase_week >= 0, target_week - last_purchase_week, -1)
+    for column in features:
+        scoring[column] = gathered[column]
+    
+    return scoring[WEEK90_COLUMNS]
+
+
+#as-of feature stores that are already loaded in this process: (path, name) -> FeatureStore
+_asof_stores = {}
+
+def asof_feature_store(path, target_week, no_shoppers = 2000, shard_size = 2500):
+    
+    """
+    input: 
+        path: path to datasets
+        target_week: week t+1; the aggregates use the weeks 0..t
+        no_shoppers: default = 2000, only the shoppers with an id below this value are kept; None = all shoppers
+        shard_size: default = 2500, shoppers whose data is read and aggregated at the same time (module_feature_store.FeatureStore.build_in_shards)
+    output: 
+        store: FeatureStore path/feature_store/asof_<target_week>_s<no_shoppers> (_all for all shoppers) with the product table loaded; the
+               shopper grains are read per shard (store.shard) or with store.load; it is built if it does not exist yet, if one of the source
+               files changed since it was built or if it was built for another population
+    """
+    
+    name = 'asof_%d_s%s' % (target_week, 'all' if no_shoppers is None else no_shoppers)
+    store = _asof_stores.get((path, name))
+    if store is None:
+        store = module_feature_store.FeatureStore(path, name)
+        try:
+            store.load(grains = ['product'])
+        except (OSError, ValueError):
+            store.manifest = None
+    if (store.manifest is not None and store.manifest.get('sources') == module_feature_store.source_fingerprint(path)
+            and store.manifest.get('no_shoppers', -1) == no_shoppers and store.manifest.get('end') == target_week - 1):
+        _asof_stores[(path, name)] = store
+        return store
+    
+    print('Building the as-of aggregates for week %d' % target_week)
+    #the aggregates may only use the weeks before the target week; as for week 90, the last observed week is left out of the temporal
+    #distribution and the average time between purchases (see module_lags)
+    shards = module_feature_store.shopper_shards(path, shard_size, no_shoppers)
+    store = store.build_in_shards(shards, 0, target_week - 1, no_shoppers, lag_max_week = target_week - 1)
+    #the population is part of the key of the store
+    store.manifest['no_shoppers'] = no_shoppers
+    store.write_manifest()
+    _asof_stores[(path, name)] = store
+    return store
+
+
+@stage()
+def build_scoring_set(path, target_week, candidates = None, min_frequency = 3, top_n = None, save = False, no_shoppers = 2000, store = None):
+    
+    """
+    input: 
+        path: path to datasets; the as-of aggregates are cached to path/feature_store/asof_<target_week>_s<no_shoppers>
+        target_week: week t+1 the scoring set is built for; only weeks up to t are used for the aggregates
+        candidates: default = None, DataFrame with the shopper x product pairs to score; by default the rows of lags.parquet for the
+                    target week if it is not observed yet (e.g. the simulated week 90), otherwise the pairs bought at least min_frequency times up to week t
+        min_frequency: default = 3, see candidates
+        top_n: default = None, if given only the top_n most promising candidates per shopper are kept (see module_candidates.prune_candidates)
+        save: default = False, whether to save the scoring set as /week<target_week>_s<no_shoppers>_final.parquet to path ('all' for None)
+        no_shoppers: default = 2000, only the shoppers with an id below this value are scored; None = all shoppers
+        store: default = None (as-of aggregates, see path), loaded module_feature_store.FeatureStore whose window ends with week target_week - 1
+               and that holds the shoppers below no_shoppers, e.g. the week90 store of module_feature_store.build_feature_store
+    output: 
+        scoring: dataset for target_week with the same 27 columns as week90_generate_dataset
+    
+    """
+    
+    if store is None:
+        store = asof_feature_store(path, target_week, no_shoppers)
+        store = module_feature_store.FeatureStore(path, store.name).load(grains = ['shopper', 'product', 'shopper_product'])
+    elif store.manifest['end'] != target_week - 1:
+        raise ValueError('Feature store %s ends with week %d, the scoring set for week %d needs the aggregates up to week %d.'
+                         % (store.name, store.manifest['end'], target_week, target_week - 1))
+    
+    if candidates is None:
+        filters = [('week', '==', target_week)] + ([('shopper', '<', no_shoppers)] if no_shoppers is not None else [])
+        candidates = pd.read_parquet(path + '/lags.parquet', filters = filters)
+        #rows of an observed week would leak which products were bought, coupons or negative samples in that week
+        if len(candidates) == 0 or candidates['product_bought'].notna().any():
+            pairs = store.tables['shopper_product']
+            candidates = pairs[pairs['no_products_bought_per_product'] >= min_frequency][['shopper', 'product']]
+        else:
+            candidates = candidates[['shopper', 'product']]
+    
+    scoring = gather_scoring_set(store, candidates, target_week)
+    
+    'Unit Test Block'
+    assert len(list(scoring.columns)) == 27
+    #all product_bought rows should be NaN but nothing else 
+    assert scoring.isna().sum().sum() == scoring.shape[0]
+    
+    scoring = scoring.sort_values(by = ['week', 'shopper', 'product']).reset_index(drop = True)
+    
+    if top_n is not None:
+        scoring = module_candidates.prune_candidates(scoring, top_n = top_n)
+    
+    if save:
+        scoring.to_parquet(path + '/week%d_s%s_final.parquet' % (target_week, 'all' if no_shoppers is None else no_shoppers))
+    
+    return scoring